@@ -1,20 +1,38 @@
-from flask import request, jsonify
+import json
+import os
+
+from flask import request, jsonify, Response
 from flask_restplus import Api, Resource, fields
 
 from app import app
-from parser.content_getter import ContentGetter
-from parser.crawler_cluster import PageCrawlerCluster as PageCrawler
+from parser.content_getter import ContentGetter, extract_flight
+from parser.crawler_cluster import PageCrawlerCluster as PageCrawler, crawl_flight
 from parser.extractor import DragnetPageExtractor, ReadabilityPageExtractor, GoosePageExtractor, \
     GooseDragnetPageExtractor, SelectivePageExtractor, AllTextPageExtractor
+from similarity.minhash import MinHashLSH
+from similarity.simhash_index import SimhashIndex
+from similarity.storage import get_index_storage
 from similarity_checker import SimilarityChecker, jaccard_similarity, cosine_similarity, \
-    fuzzy_similarity, simhash_similarity, tokenize_and_normalize_content
+    fuzzy_similarity, simhash_similarity, tokenize_and_normalize_content, token_cache, ngram_hash_cache, \
+    PreparedDocument, prepare_documents
+from util.deadline import Deadline
 
 api = Api(app, doc='/doc/', version='1.0', title='Web pages similarity')
 
-crawler = PageCrawler()
-extractor = DragnetPageExtractor()
-content_getter = ContentGetter(crawler=crawler, extractor=extractor)
-similarity_checker = SimilarityChecker(content_getter=content_getter, similarity=cosine_similarity)
+# every extracted page is added to these indexes
+duplicate_index = MinHashLSH(get_index_storage('minhash-lsh'), threshold=float(os.environ.get('LSH_THRESHOLD', 0.5)))
+fingerprint_index = SimhashIndex(get_index_storage('simhash'), k=int(os.environ.get('SIMHASH_MAX_DISTANCE', 3)))
+page_indexes = [duplicate_index, fingerprint_index]
+
+if os.environ.get('SINGLEFLIGHT_LOCK_TIME'):
+    # one crawl and extraction of a page for concurrent requests of all workers and replicas
+    crawl_flight.active_redis_lock(int(os.environ['SINGLEFLIGHT_LOCK_TIME']))
+    extract_flight.active_redis_lock(int(os.environ['SINGLEFLIGHT_LOCK_TIME']))
+
+if os.environ.get('TOKEN_CACHE_EXPIRE'):
+    # share tokenize results between workers and replicas
+    token_cache.active_redis_cache(int(os.environ['TOKEN_CACHE_EXPIRE']))
+    ngram_hash_cache.active_redis_cache(int(os.environ['TOKEN_CACHE_EXPIRE']))
 
 list_extractor = ['dragnet', 'goose', 'goose_dragnet', 'readability', 'selective', 'all_text']
 
@@ -36,6 +54,9 @@ def get_extractor(name):
         return None
 
 
+# settings of the pages added to the page indexes
+default_extractor_settings = get_extractor(list_extractor[0]).settings()
+
 list_selector_type = ['css', 'xpath']
 
 sim_check_params = api.model('sim_check_params', {
@@ -73,6 +94,201 @@ crawler_cluster_options = {'page_load_timeout': "Maximum number of milliseconds
                                                       "off of the page at this point. Default is %.1f" %
                                                       wait_after_last_request_default}
 
+cache_options = {'cache': 'Cache result for later use faster (integer), `0` is cache disabled, '
+                          '`others` is cache enabled. Default is non-cache',
+                 'expire_time': 'Expire time for cache of crawled pages (second), only effect when cache enabled. '
+                                'Default is `604800` seconds (7 days)',
+                 'extract_expire_time': 'Expire time for cache of extracted pages (second), only effect when cache '
+                                        'enabled. Default is `86400` seconds (1 day)'}
+cached_crawler_options = dict(crawler_cluster_options, **cache_options)
+
+request_deadline_default = float(os.environ.get('REQUEST_DEADLINE', 50))
+deadline_options = {'deadline': 'Maximum number of seconds to crawl, extract and score the pages, the pages not done '
+                                'in time are returned as timed out. Default is %d' % request_deadline_default}
+deadline_crawler_options = dict(cached_crawler_options, **deadline_options)
+
+
+def active_cache(content_getter, values=None):
+    """Enable the crawled and extracted pages cache levels of `content_getter` if the request asks for it"""
+    values = request.values if values is None else values
+    if int(values.get('cache', 0)) != 0:
+        content_getter.active_cache(expire_time=int(values.get('expire_time', 604800)),  # Seconds = 7 days
+                                    extract_expire_time=int(values.get('extract_expire_time', 86400)))
+
+
+def get_page_indexes(extractor):
+    """Indexes the pages of `extractor` are added to, only the whole pages of the default extractor are indexed so
+    the pages of other extractors or selectors do not replace the entries of their url"""
+    return page_indexes if extractor.settings() == default_extractor_settings else []
+
+
+def get_content_getter(values, extractor):
+    """Content getter with the crawler, cache and deadline options of the request `values`"""
+    user_agent = values.get('user_agent', user_agents[0])
+    page_load_timeout = values.get('page_load_timeout', page_load_timeout_default)
+    wait_after_last_request = values.get('wait_after_last_request', wait_after_last_request_default)
+    content_getter = ContentGetter(crawler=PageCrawler(user_agent=user_agent.strip(),
+                                                       page_load_timeout=page_load_timeout,
+                                                       wait_after_last_request=wait_after_last_request
+                                                       ),
+                                   extractor=extractor, indexes=get_page_indexes(extractor),
+                                   deadline=Deadline(float(values.get('deadline', request_deadline_default))))
+    active_cache(content_getter, values)
+    return content_getter
+
+
+def get_check_request(values, result):
+    """Return (similarity checker, main url, sub urls) of a check request, None with `result['error']` set if the
+    request `values` are invalid. Shared by the flask and the async resources."""
+    distance_metric = values.get('distance_metric') or 'cosine'
+    if distance_metric not in distance_metrics:
+        result['error'] = 'distance_metric must be in %s' % ', '.join(distance_metrics)
+        return None
+
+    main_url = values.get('main_url', '')
+    sub_url_string = values.get('sub_urls', '')
+    strip_chars = ' "\''
+    sub_urls = [u.strip(strip_chars) for u in sub_url_string.split(',') if u.strip(strip_chars)]
+    if not main_url:
+        result['error'] = 'main_url must not blank'
+        return None
+
+    if not sub_urls:
+        result['error'] = 'sub_urls must not blank'
+        return None
+
+    extractor_name = values.get('extractor', list_extractor[0])
+    s_extractor = get_extractor(extractor_name)
+    if not s_extractor:
+        result['error'] = "The extractor name '%s' does not support yet" % extractor_name
+        return None
+    main_page_selector = None
+    sub_page_selector = None
+    if extractor_name == 'selective':
+        s_extractor.selector_type = values.get('selector_type', list_extractor[0])
+        main_page_selector = values.get('main_page_selector')
+        sub_page_selector = values.get('sub_page_selector')
+        if not main_page_selector or not main_page_selector.strip():
+            result['error'] = "You must specify the 'main_page_selector' element when the 'extractor' " \
+                              "is 'selective'"
+            return None
+        if not sub_page_selector or not sub_page_selector.strip():
+            result['error'] = "You must specify the 'sub_page_selector' element when the 'extractor' is 'selective'"
+            return None
+
+    # a checker of this request only
+    s_similarity_checker = SimilarityChecker(content_getter=get_content_getter(values, s_extractor),
+                                             similarity=get_similarity_checker(distance_metric),
+                                             unit=values.get('unit', 'word'),
+                                             min_ngram=int(values.get('min_ngram', 1)),
+                                             max_ngram=int(values.get('max_ngram', 1)),
+                                             min_similarity=float(values.get('min_similarity', 0)),
+                                             top_k=int(values.get('top_k', 0)) or None,
+                                             main_page_selector=(main_page_selector or '').strip() or None,
+                                             sub_page_selector=(sub_page_selector or '').strip() or None)
+    return s_similarity_checker, main_url, sub_urls
+
+
+def get_cross_check_request(values, result):
+    """Return (similarity checker, url 1, url 2, url 3) of a cross check request, None with `result['error']` set
+    if the request `values` are invalid"""
+    distance_metric = values.get('distance_metric') or 'cosine'
+    if distance_metric not in distance_metrics:
+        result['error'] = 'distance_metric must be in %s' % ', '.join(distance_metrics)
+        return None
+
+    url_1 = values.get('url_1', '')
+    url_2 = values.get('url_2', '')
+    url_3 = values.get('url_3', '')
+    if not url_1:
+        result['error'] = 'url_1 must not blank'
+        return None
+
+    if not url_2:
+        result['error'] = 'url_2 must not blank'
+        return None
+
+    if not url_3:
+        result['error'] = 'url_3 must not blank'
+        return None
+
+    extractor_name = values.get('extractor', list_extractor[0])
+    s_extractor = get_extractor(extractor_name)
+    if not s_extractor:
+        result['error'] = "The extractor name '%s' does not support yet" % extractor_name
+        return None
+    url_1_selector = None
+    url_2_selector = None
+    url_3_selector = None
+    if extractor_name == 'selective':
+        s_extractor.selector_type = values.get('selector_type', list_extractor[0])
+        url_1_selector = values.get('url_1_selector')
+        url_2_selector = values.get('url_2_selector')
+        url_3_selector = values.get('url_3_selector')
+        if not url_1_selector or not url_1_selector.strip():
+            result['error'] = "You must specify the 'url_1_selector' element when the 'extractor' " \
+                              "is 'selective'"
+            return None
+        if not url_2_selector or not url_2_selector.strip():
+            result['error'] = "You must specify the 'url_2_selector' element when the 'extractor' is 'selective'"
+            return None
+        if not url_3_selector or not url_3_selector.strip():
+            result['error'] = "You must specify the 'url_3_selector' element when the 'extractor' is 'selective'"
+            return None
+
+    # a checker of this request only
+    s_similarity_checker = SimilarityChecker(content_getter=get_content_getter(values, s_extractor),
+                                             similarity=get_similarity_checker(distance_metric),
+                                             unit=values.get('unit', 'word'),
+                                             min_ngram=int(values.get('min_ngram', 1)),
+                                             max_ngram=int(values.get('max_ngram', 1)),
+                                             url_1_selector=url_1_selector, url_2_selector=url_2_selector,
+                                             url_3_selector=url_3_selector)
+    return s_similarity_checker, url_1, url_2, url_3
+
+
+def get_extract_request(values, result):
+    """Return (content getter, urls, selector) of an extract request, None with `result['error']` set if the
+    request `values` are invalid"""
+    urls = values.get('urls', '')
+    strip_chars = ' "\''
+    urls = [u.strip(strip_chars) for u in urls.split(',') if u.strip(strip_chars)]
+    if not urls:
+        result['error'] = 'urls must not be empty'
+        return None
+
+    extractor_name = values.get('extractor', list_extractor[0])
+    s_extractor = get_extractor(extractor_name)
+    if not s_extractor:
+        result['error'] = "The extractor name '%s' does not support yet" % extractor_name
+        return None
+    if extractor_name == 'selective':
+        s_extractor.selector_type = values.get('selector_type', list_extractor[0])
+        selector = values.get('selector')
+        if not selector or not selector.strip():
+            result['error'] = "You must specify the 'selector' element when the 'extractor' is 'selective'"
+            return None
+        selector = selector.strip()
+    else:
+        selector = None
+
+    return get_content_getter(values, s_extractor), urls, selector
+
+
+def tokenize_pages(pages, values):
+    """[(url, page)] of extracted pages, with the tokens of their content unless `show_tokens` is 0"""
+    unit = values.get('unit', 'word')
+    min_ngram = int(values.get('min_ngram', 1))
+    max_ngram = int(values.get('max_ngram', 1))
+    show_tokens = int(values.get('show_tokens', 1))
+    result = []
+    for url, page in pages.items():
+        if show_tokens:
+            page['tokens'] = tokenize_and_normalize_content(page['content'], unit=unit, min_ngram=min_ngram,
+                                                            max_ngram=max_ngram)
+        result.append((url, page))
+    return result
+
 
 @ns1.route('/check')
 class SimilarityCheckerResource(Resource):
@@ -95,8 +311,12 @@ class SimilarityCheckerResource(Resource):
                                                 'you must specify the `main_page_selector` element',
                           'sub_page_selector': 'Sub page selector, if extractor is `selective`, '
                                                'you must specify the `sub_page_selector` element',
+                          'min_similarity': 'Only return sub urls whose similarity percentage is at least this value, '
+                                            'default is 0',
+                          'top_k': 'Only return the `top_k` most similar sub urls (integer), `0` is all sub urls. '
+                                   'Default is `0`',
                           'user_agent': "The 'User-Agent' of crawler, default is `%s`" % user_agents[0]
-                          }, **crawler_cluster_options)
+                          }, **deadline_crawler_options)
              )
     @api.response(200, 'Success', model=sim_check_response)
     def post(self):
@@ -105,91 +325,103 @@ class SimilarityCheckerResource(Resource):
             'error': False,
             'similarity': []
         }
-        # get request params
-        unit = request.values.get('unit', 'word')
-        min_ngram = int(request.values.get('min_ngram', 1))
-        max_ngram = int(request.values.get('max_ngram', 1))
-        similarity_checker.unit = unit
-        similarity_checker.min_ngram = min_ngram
-        similarity_checker.max_ngram = max_ngram
-        distance_metric = request.values.get('distance_metric', '')
-        if not distance_metric:
-            similarity_checker.similarity = cosine_similarity
-        elif distance_metric not in distance_metrics:
-            result['error'] = 'distance_metric must be in %s' % ', '.join(distance_metrics)
+        check = get_check_request(request.values, result)
+        if not check:
             return result
 
-        elif distance_metric == 'jaccard':
-            similarity_checker.similarity = jaccard_similarity
+        # check similarity
+        s_similarity_checker, main_url, sub_urls = check
+        sims = s_similarity_checker.process(main_url=main_url, sub_urls=sub_urls)
+        if isinstance(sims, basestring):
+            result['error'] = sims
+        elif sims:
+            result['similarity'] = sims
+        else:
+            result['error'] = 'Main page is empty'
 
-        elif distance_metric == 'cosine':
-            similarity_checker.similarity = cosine_similarity
+        return jsonify(result)
 
-        elif distance_metric == 'fuzzy':
-            similarity_checker.similarity = fuzzy_similarity
 
-        elif distance_metric == 'simhash':
-            similarity_checker.similarity = simhash_similarity
+@ns1.route('/batch-check')
+class SimilarityBatchCheckerResource(Resource):
+    """Checking similarity of many groups of a main web page and other web pages in one request"""
 
-        main_url = request.values.get('main_url', '')
-        sub_url_string = request.values.get('sub_urls', '')
-        strip_chars = ' "\''
-        sub_urls = [u.strip(strip_chars) for u in sub_url_string.split(',') if u.strip(strip_chars)]
-        if not main_url:
-            result['error'] = 'main_url must not blank'
+    @api.doc(params=dict({'groups': 'Groups to be checked, a JSON array of objects with a `main_url` string and '
+                                    '`sub_urls` (array or urls separated by comma). Urls shared by several groups '
+                                    'are crawled and extracted once',
+                          'distance_metric': 'Distance metric to be used (currently support %s), default is `cosine`'
+                                             % ', '.join(distance_metrics),
+                          'unit': 'Unit of ngram, support value are word or character, default is `word`',
+                          'min_ngram': 'Minimum length of ngram elements, default is 1 (minimum is 1)',
+                          'max_ngram': 'Maximum length of ngram elements, default is 1 (maximum is 20)',
+                          'extractor': 'The name of extractor to be used, currently support `%s`, default `%s`' %
+                                       (', '.join(e for e in list_extractor if e != 'selective'), list_extractor[0]),
+                          'min_similarity': 'Only return sub urls whose similarity percentage is at least this value, '
+                                            'default is 0',
+                          'top_k': 'Only return the `top_k` most similar sub urls of each group (integer), `0` is '
+                                   'all sub urls. Default is `0`',
+                          'user_agent': "The 'User-Agent' of crawler, default is `%s`" % user_agents[0]
+                          }, **deadline_crawler_options)
+             )
+    @api.response(200, 'Success, one JSON object per line and group ({"index", "main_url", "error", "similarity"}) '
+                       'in the order the groups are checked')
+    def post(self):
+        """Post groups of web pages to check similarity percentage, results are streamed as groups are checked"""
+        result = {
+            'error': False,
+            'similarity': []
+        }
+        try:
+            groups = json.loads(request.values.get('groups') or '[]')
+            groups = [(group['main_url'], group['sub_urls']) for group in groups]
+        except (ValueError, TypeError, KeyError):
+            result['error'] = 'groups must be a JSON array of objects with main_url and sub_urls'
             return result
-
-        if not sub_urls:
-            result['error'] = 'sub_urls must not blank'
+        if not groups:
+            result['error'] = 'groups must not blank'
             return result
+        strip_chars = ' "\''
+        for i, (main_url, sub_urls) in enumerate(groups):
+            if not isinstance(sub_urls, list):
+                sub_urls = sub_urls.split(',')
+            sub_urls = [u.strip(strip_chars) for u in sub_urls if u.strip(strip_chars)]
+            if not main_url or not sub_urls:
+                result['error'] = 'main_url and sub_urls of group %d must not blank' % i
+                return result
+            groups[i] = (main_url, sub_urls)
 
-        # validate params type
-        if type(sub_urls) is not list:
-            result['error'] = 'sub_urls must be in array type'
+        distance_metric = request.values.get('distance_metric') or 'cosine'
+        if distance_metric not in distance_metrics:
+            result['error'] = 'distance_metric must be in %s' % ', '.join(distance_metrics)
             return result
 
         extractor_name = request.values.get('extractor', list_extractor[0])
         s_extractor = get_extractor(extractor_name)
-        if not extractor:
+        if not s_extractor or extractor_name == 'selective':
             result['error'] = "The extractor name '%s' does not support yet" % extractor_name
             return result
-        main_page_selector = None
-        sub_page_selector = None
-        if extractor_name == 'selective':
-            s_extractor.selector_type = request.values.get('selector_type', list_extractor[0])
-            main_page_selector = request.values.get('main_page_selector')
-            sub_page_selector = request.values.get('sub_page_selector')
-            if not main_page_selector or not main_page_selector.strip():
-                result['error'] = "You must specify the 'main_page_selector' element when the 'extractor' " \
-                                  "is 'selective'"
-                return result
-            if not sub_page_selector or not sub_page_selector.strip():
-                result[
-                    'error'] = "You must specify the 'sub_page_selector' element when the 'extractor' is 'selective'"
-                return result
-
-        user_agent = request.values.get('user_agent', user_agents[0])
-        page_load_timeout = request.values.get('page_load_timeout', page_load_timeout_default)
-        wait_after_last_request = request.values.get('wait_after_last_request', wait_after_last_request_default)
-        s_content_getter = ContentGetter(crawler=PageCrawler(user_agent=user_agent.strip(),
-                                                             page_load_timeout=page_load_timeout,
-                                                             wait_after_last_request=wait_after_last_request
-                                                             ),
-                                         extractor=s_extractor)
-
-        # check similarity
-        if not result['error']:
-            similarity_checker.content_getter = s_content_getter
-            if main_page_selector:
-                similarity_checker.main_page_selector = main_page_selector.strip()
-                similarity_checker.sub_page_selector = sub_page_selector.strip()
-            sims = similarity_checker.process(main_url=main_url, sub_urls=sub_urls)
-            if sims:
-                result['similarity'] = sims
-            else:
-                result['error'] = 'Main page is empty'
 
-        return jsonify(result)
+        # the whole batch shares the deadline of the request
+        s_content_getter = get_content_getter(request.values, s_extractor)
+        # own checker, the groups are streamed after the request returns
+        batch_checker = SimilarityChecker(content_getter=s_content_getter,
+                                          similarity=get_similarity_checker(distance_metric),
+                                          unit=request.values.get('unit', 'word'),
+                                          min_ngram=int(request.values.get('min_ngram', 1)),
+                                          max_ngram=int(request.values.get('max_ngram', 1)),
+                                          min_similarity=float(request.values.get('min_similarity', 0)),
+                                          top_k=int(request.values.get('top_k', 0)) or None)
+
+        def generate():
+            for index, sims in batch_checker.batch_process(groups):
+                group_result = {'index': index, 'main_url': groups[index][0], 'error': False, 'similarity': []}
+                if isinstance(sims, basestring):
+                    group_result['error'] = sims
+                else:
+                    group_result['similarity'] = sims
+                yield json.dumps(group_result) + '\n'
+
+        return Response(generate(), mimetype='application/x-ndjson')
 
 
 @ns1.route('/cross-check')
@@ -217,7 +449,7 @@ class SimilarityCrossCheckerResource(Resource):
                           'url_3_selector': 'Url 3 selector, if extractor is `selective`, '
                                             'you must specify the `url_3_selector` element',
                           'user_agent': "The 'User-Agent' of crawler, default is `%s`" % user_agents[0]
-                          }, **crawler_cluster_options)
+                          }, **deadline_crawler_options)
              )
     @api.response(200, 'Success')
     def post(self):
@@ -226,92 +458,138 @@ class SimilarityCrossCheckerResource(Resource):
             'error': False,
             'similarity': []
         }
-        # get request params
-        unit = request.values.get('unit', 'word')
-        min_ngram = int(request.values.get('min_ngram', 1))
-        max_ngram = int(request.values.get('max_ngram', 1))
-        similarity_checker.unit = unit
-        similarity_checker.min_ngram = min_ngram
-        similarity_checker.max_ngram = max_ngram
-        distance_metric = request.values.get('distance_metric', '')
-        if not distance_metric:
-            similarity_checker.similarity = cosine_similarity
-        elif distance_metric not in distance_metrics:
-            result['error'] = 'distance_metric must be in %s' % ', '.join(distance_metrics)
+        cross_check = get_cross_check_request(request.values, result)
+        if not cross_check:
             return result
 
-        elif distance_metric == 'jaccard':
-            similarity_checker.similarity = jaccard_similarity
+        # check similarity
+        s_similarity_checker, url_1, url_2, url_3 = cross_check
+        sims = s_similarity_checker.cross_process(url_1, url_2, url_3)
+        if sims:
+            result['similarity'] = sims
+
+        return jsonify(result)
 
-        elif distance_metric == 'cosine':
-            similarity_checker.similarity = cosine_similarity
 
-        elif distance_metric == 'fuzzy':
-            similarity_checker.similarity = fuzzy_similarity
+duplicate_metrics = ['jaccard', 'cosine']
 
-        elif distance_metric == 'simhash':
-            similarity_checker.similarity = simhash_similarity
 
-        url_1 = request.values.get('url_1', '')
-        url_2 = request.values.get('url_2', '')
-        url_3 = request.values.get('url_3', '')
-        if not url_1:
-            result['error'] = 'url_1 must not blank'
-            return result
+@ns1.route('/near-duplicates')
+class NearDuplicateResource(Resource):
+    """Finding near-duplicates of a web page among all web pages crawled so far"""
 
-        if not url_2:
-            result['error'] = 'url_2 must not blank'
+    @api.doc(params=dict({'url': 'Url to find near-duplicates of',
+                          'distance_metric': 'Distance metric to re-score candidates (currently support %s), '
+                                             'default is `jaccard`' % ', '.join(duplicate_metrics),
+                          'min_similarity': 'Minimum similarity percentage of returned pages, default is 0',
+                          'unit': 'Unit of ngram, support value are word or character, default is `word`',
+                          'min_ngram': 'Minimum length of ngram elements, default is 1 (minimum is 1)',
+                          'max_ngram': 'Maximum length of ngram elements, default is 1 (maximum is 20)',
+                          'extractor': 'The name of extractor to be used, currently support `%s`, default `%s`' %
+                                       (', '.join(e for e in list_extractor if e != 'selective'), list_extractor[0]),
+                          'user_agent': "The 'User-Agent' of crawler, default is `%s`" % user_agents[0]
+                          }, **deadline_crawler_options)
+             )
+    @api.response(200, 'Success', model=sim_check_response)
+    def post(self):
+        """Post a web page to find its near-duplicates"""
+        result = {
+            'error': False,
+            'similarity': []
+        }
+        url = request.values.get('url', '').strip()
+        if not url:
+            result['error'] = 'url must not blank'
             return result
 
-        if not url_3:
-            result['error'] = 'url_3 must not blank'
+        distance_metric = request.values.get('distance_metric', 'jaccard')
+        if distance_metric not in duplicate_metrics:
+            result['error'] = 'distance_metric must be in %s' % ', '.join(duplicate_metrics)
             return result
+        similarity = get_similarity_checker(distance_metric)
+        min_similarity = float(request.values.get('min_similarity', 0))
+        ngram_params = dict(unit=request.values.get('unit', 'word'),
+                            min_ngram=int(request.values.get('min_ngram', 1)),
+                            max_ngram=int(request.values.get('max_ngram', 1)))
 
         extractor_name = request.values.get('extractor', list_extractor[0])
         s_extractor = get_extractor(extractor_name)
-        if not extractor:
+        if not s_extractor or extractor_name == 'selective':
             result['error'] = "The extractor name '%s' does not support yet" % extractor_name
             return result
-        url_1_selector = None
-        url_2_selector = None
-        url_3_selector = None
-        if extractor_name == 'selective':
-            s_extractor.selector_type = request.values.get('selector_type', list_extractor[0])
-            url_1_selector = request.values.get('url_1_selector')
-            url_2_selector = request.values.get('url_2_selector')
-            url_3_selector = request.values.get('url_3_selector')
-            if not url_1_selector or not url_1_selector.strip():
-                result['error'] = "You must specify the 'url_1_selector' element when the 'extractor' " \
-                                  "is 'selective'"
-                return result
-            if not url_2_selector or not url_2_selector.strip():
-                result[
-                    'error'] = "You must specify the 'url_2_selector' element when the 'extractor' is 'selective'"
+
+        s_content_getter = get_content_getter(request.values, s_extractor)
+        page = s_content_getter.process([url])[url]
+        if page.get('error'):
+            result['error'] = page['error']
+            return result
+
+        # candidates from LSH buckets, then exact re-scoring of their pages, the index keeps signatures only
+        candidates = s_content_getter.process(duplicate_index.query(page['content'], exclude={url}))
+        main_doc = PreparedDocument(page['content'], **ngram_params)
+        sims = []
+        for candidate_url, candidate in candidates.items():
+            if candidate.get('error'):
+                continue
+            sim = similarity(main_doc, PreparedDocument(candidate['content'], **ngram_params))
+            if sim >= min_similarity:
+                sims.append([candidate_url, sim])
+
+        sims.sort(key=lambda x: x[1], reverse=True)
+        result['similarity'] = sims
+        return jsonify(result)
+
+
+@ns1.route('/simhash-lookup')
+class SimhashLookupResource(Resource):
+    """Finding web pages whose Simhash fingerprint is within a few bits of a web page fingerprint"""
+
+    @api.doc(params=dict({'url': 'Url to find similar pages of, ignored when `fingerprint` is specified',
+                          'fingerprint': 'Simhash fingerprint (64 bits hexadecimal) to find similar pages of',
+                          'max_distance': 'Maximum number of different bits of the fingerprints, default and '
+                                          'maximum is %d' % fingerprint_index.k,
+                          'extractor': 'The name of extractor to be used, currently support `%s`, default `%s`' %
+                                       (', '.join(e for e in list_extractor if e != 'selective'), list_extractor[0]),
+                          'user_agent': "The 'User-Agent' of crawler, default is `%s`" % user_agents[0]
+                          }, **deadline_crawler_options)
+             )
+    @api.response(200, 'Success', model=sim_check_response)
+    def post(self):
+        """Post a web page or a fingerprint to find the pages with a similar fingerprint"""
+        result = {
+            'error': False,
+            'fingerprint': '',
+            'similarity': []
+        }
+        url = request.values.get('url', '').strip()
+        fingerprint = request.values.get('fingerprint', '').strip()
+        max_distance = int(request.values.get('max_distance', fingerprint_index.k))
+        if fingerprint:
+            try:
+                fingerprint = int(fingerprint, 16)
+            except ValueError:
+                result['error'] = 'fingerprint must be a hexadecimal number'
                 return result
-            if not url_3_selector or not url_3_selector.strip():
-                result[
-                    'error'] = "You must specify the 'url_3_selector' element when the 'extractor' is 'selective'"
+        elif url:
+            extractor_name = request.values.get('extractor', list_extractor[0])
+            s_extractor = get_extractor(extractor_name)
+            if not s_extractor or extractor_name == 'selective':
+                result['error'] = "The extractor name '%s' does not support yet" % extractor_name
                 return result
 
-        user_agent = request.values.get('user_agent', user_agents[0])
-        page_load_timeout = request.values.get('page_load_timeout', page_load_timeout_default)
-        wait_after_last_request = request.values.get('wait_after_last_request', wait_after_last_request_default)
-        s_content_getter = ContentGetter(crawler=PageCrawler(user_agent=user_agent.strip(),
-                                                             page_load_timeout=page_load_timeout,
-                                                             wait_after_last_request=wait_after_last_request
-                                                             ),
-                                         extractor=s_extractor)
-
-        # check similarity
-        if not result['error']:
-            similarity_checker.content_getter = s_content_getter
-            similarity_checker.url_1_selector = url_1_selector
-            similarity_checker.url_2_selector = url_2_selector
-            similarity_checker.url_3_selector = url_3_selector
-            sims = similarity_checker.cross_process(url_1, url_2, url_3)
-            if sims:
-                result['similarity'] = sims
+            page = get_content_getter(request.values, s_extractor).process([url])[url]
+            if page.get('error'):
+                result['error'] = page['error']
+                return result
+            fingerprint = fingerprint_index.fingerprint(page['content'])
+        else:
+            result['error'] = 'url or fingerprint must not blank'
+            return result
 
+        result['fingerprint'] = '%016x' % fingerprint
+        # same scale as the `simhash` distance metric
+        result['similarity'] = [[match_url, 100 - distance] for match_url, distance in
+                                fingerprint_index.query(fingerprint, k=max_distance, exclude={url})]
         return jsonify(result)
 
 
@@ -365,11 +643,8 @@ class PageExtractorResource(Resource):
                                            (', '.join(list_selector_type), list_selector_type[0]),
                           'selector': 'If extractor is `selective`, you must specify the `selector` element',
                           'user_agent': "The 'User-Agent' of crawler, default is `%s`" % user_agents[0],
-                          'cache': 'Cache result for later use faster (integer), `0` is cache disabled, '
-                                   '`others` is cache enabled. Default is non-cache',
-                          'expire_time': 'Expire time for cache (second), only effect when cache enabled. '
-                                         'Default is `604800` seconds (7 days)'
-                          }, **crawler_cluster_options)
+                          'show_tokens': 'Return tokens of content (integer), `0` is disabled. Default is `1`'
+                          }, **deadline_crawler_options)
              )
     @api.response(200, 'Success', model='page_extractor_response')
     def post(self):
@@ -378,48 +653,12 @@ class PageExtractorResource(Resource):
             'error': False,
             'pages': []
         }
-        unit = request.values.get('unit', 'word')
-        min_ngram = int(request.values.get('min_ngram', 1))
-        max_ngram = int(request.values.get('max_ngram', 1))
-        urls = request.values.get('urls', '')
-        strip_chars = ' "\''
-        urls = [u.strip(strip_chars) for u in urls.split(',') if u.strip(strip_chars)]
-        if not urls:
-            result['error'] = 'urls must not be empty'
-
-        extractor_name = request.values.get('extractor', list_extractor[0])
-        s_extractor = get_extractor(extractor_name)
-        if not extractor:
-            result['error'] = "The extractor name '%s' does not support yet" % extractor_name
+        extract = get_extract_request(request.values, result)
+        if not extract:
             return result
-        if extractor_name == 'selective':
-            s_extractor.selector_type = request.values.get('selector_type', list_extractor[0])
-            selector = request.values.get('selector')
-            if not selector or not selector.strip():
-                result['error'] = "You must specify the 'selector' element when the 'extractor' is 'selective'"
-                return result
-            s_extractor.selector = selector.strip()
-
-        user_agent = request.values.get('user_agent', user_agents[0])
-        page_load_timeout = request.values.get('page_load_timeout', page_load_timeout_default)
-        wait_after_last_request = request.values.get('wait_after_last_request', wait_after_last_request_default)
-        s_crawler = PageCrawler(user_agent=user_agent.strip(),
-                                page_load_timeout=page_load_timeout,
-                                wait_after_last_request=wait_after_last_request)
-
-        cache = int(request.values.get('cache', 0))
-        if cache != 0:
-            expire_time = int(request.values.get('expire_time', 604800))  # Seconds = 7 days
-            s_crawler.active_redis_cache(expire_time)
-
-        s_content_getter = ContentGetter(crawler=s_crawler, extractor=s_extractor)
 
-        if not result['error']:
-            pages = result['pages']
-            for url, page in s_content_getter.process(urls).items():
-                page['tokens'] = tokenize_and_normalize_content(page['content'], unit=unit, min_ngram=min_ngram,
-                                                                max_ngram=max_ngram)
-                pages.append((url, page))
+        s_content_getter, urls, selector = extract
+        result['pages'] = tokenize_pages(s_content_getter.process(urls, selector), request.values)
 
         return jsonify(result)
 
@@ -476,7 +715,9 @@ class ContentSimilarityResource(Resource):
                                          % ', '.join(distance_metrics),
                      'unit': 'Unit of ngram, support value are `word` or `character`, default is `word`',
                      'min_ngram': 'Minimum length of ngram elements, default is 1 (minimum is 1)',
-                     'max_ngram': 'Maximum length of ngram elements, default is 1 (maximum is 20)'
+                     'max_ngram': 'Maximum length of ngram elements, default is 1 (maximum is 20)',
+                     'show_tokens': 'Return tokens of contents (integer), `0` is disabled, then `jaccard` and '
+                                    '`cosine` are computed on hashed ngrams only. Default is `1`'
                      }
              )
     @api.response(200, 'Success', model='content_sim_response')
@@ -491,19 +732,20 @@ class ContentSimilarityResource(Resource):
         unit = request.values.get('unit', 'word')
         min_ngram = int(request.values.get('min_ngram', 1))
         max_ngram = int(request.values.get('max_ngram', 1))
-        content_1 = tokenize_and_normalize_content(request.values.get('content_1', ''), unit=unit, min_ngram=min_ngram,
-                                                   max_ngram=max_ngram)
-        content_2 = tokenize_and_normalize_content(request.values.get('content_2', ''), unit=unit, min_ngram=min_ngram,
-                                                   max_ngram=max_ngram)
-        result['tokens_1'] = content_1
-        result['tokens_2'] = content_2
+        ngram_params = dict(unit=unit, min_ngram=min_ngram, max_ngram=max_ngram)
+        content_1 = request.values.get('content_1', '')
+        content_2 = request.values.get('content_2', '')
+        doc_1, doc_2 = prepare_documents([content_1, content_2], **ngram_params)
+        if int(request.values.get('show_tokens', 1)):
+            result['tokens_1'] = doc_1.tokens
+            result['tokens_2'] = doc_2.tokens
         selected_dm = request.values.get('distance_metrics', '')
         strip_chars = ' "\''
         selected_dm = [d.strip(strip_chars).lower() for d in selected_dm.split(',') if d.strip(strip_chars)]
         if not selected_dm:
             selected_dm = distance_metrics
 
-        result['distances'] = cal_distances(content_1, content_2, selected_dm)
+        result['distances'] = cal_distances(doc_1, doc_2, selected_dm)
 
         return jsonify(result)
 
@@ -519,7 +761,9 @@ class ContentCrossSimilarityResource(Resource):
                                          % ', '.join(distance_metrics),
                      'unit': 'Unit of ngram, support value are `word` or `character`, default is `word`',
                      'min_ngram': 'Minimum length of ngram elements, default is 1 (minimum is 1)',
-                     'max_ngram': 'Maximum length of ngram elements, default is 1 (maximum is 20)'
+                     'max_ngram': 'Maximum length of ngram elements, default is 1 (maximum is 20)',
+                     'show_tokens': 'Return tokens of contents (integer), `0` is disabled, then `jaccard` and '
+                                    '`cosine` are computed on hashed ngrams only. Default is `1`'
                      }
              )
     @api.response(200, 'Success')
@@ -537,15 +781,16 @@ class ContentCrossSimilarityResource(Resource):
         unit = request.values.get('unit', 'word')
         min_ngram = int(request.values.get('min_ngram', 1))
         max_ngram = int(request.values.get('max_ngram', 1))
-        content_1 = tokenize_and_normalize_content(request.values.get('content_1', ''), unit=unit, min_ngram=min_ngram,
-                                                   max_ngram=max_ngram)
-        content_2 = tokenize_and_normalize_content(request.values.get('content_2', ''), unit=unit, min_ngram=min_ngram,
-                                                   max_ngram=max_ngram)
-        content_3 = tokenize_and_normalize_content(request.values.get('content_3', ''), unit=unit, min_ngram=min_ngram,
-                                                   max_ngram=max_ngram)
-        result['tokens_1'] = content_1
-        result['tokens_2'] = content_2
-        result['tokens_3'] = content_3
+        ngram_params = dict(unit=unit, min_ngram=min_ngram, max_ngram=max_ngram)
+        content_1 = request.values.get('content_1', '')
+        content_2 = request.values.get('content_2', '')
+        content_3 = request.values.get('content_3', '')
+        # each content is prepared once for all pairs and metrics
+        doc_1, doc_2, doc_3 = prepare_documents([content_1, content_2, content_3], **ngram_params)
+        if int(request.values.get('show_tokens', 1)):
+            result['tokens_1'] = doc_1.tokens
+            result['tokens_2'] = doc_2.tokens
+            result['tokens_3'] = doc_3.tokens
         selected_dm = request.values.get('distance_metrics', '')
         strip_chars = ' "\''
         selected_dm = [d.strip(strip_chars).lower() for d in selected_dm.split(',') if d.strip(strip_chars)]
@@ -553,20 +798,20 @@ class ContentCrossSimilarityResource(Resource):
             selected_dm = distance_metrics
 
         result.update({
-            'distances12': cal_distances(content_1, content_2, selected_dm),
-            'distances23': cal_distances(content_2, content_3, selected_dm),
-            'distances13': cal_distances(content_1, content_3, selected_dm)
+            'distances12': cal_distances(doc_1, doc_2, selected_dm),
+            'distances23': cal_distances(doc_2, doc_3, selected_dm),
+            'distances13': cal_distances(doc_1, doc_3, selected_dm)
         })
 
         return jsonify(result)
 
 
-def cal_distances(content_1, content_2, selected_dm):
+def cal_distances(doc_1, doc_2, selected_dm):
     distances = []
     for dm_name in selected_dm:
         sim_checker = get_similarity_checker(dm_name)
         if sim_checker:
-            distances.append({dm_name: sim_checker(content_1, content_2)})
+            distances.append({dm_name: sim_checker(doc_1, doc_2)})
         else:
             distances.append({dm_name: 'Distance metric %s do not existed, we support only %s' %
                                        (dm_name, ', '.join(distance_metrics))})
@@ -0,0 +1,102 @@
+import json
+import os
+from multiprocessing import cpu_count
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
+from tornado.web import Application, RequestHandler
+
+from api import get_check_request, get_cross_check_request, get_extract_request, tokenize_pages
+from util.wsgi import WSGIResource
+
+# CPU-bound work of the async resources (extraction, tokenizing and scoring), the IOLoop only waits on crawls
+cpu_executor = ThreadPoolExecutor(int(os.environ.get('ASYNC_CPU_THREADS', cpu_count())))
+# requests of the flask resources, which block while they crawl
+wsgi_executor = ThreadPoolExecutor(int(os.environ.get('WSGI_THREADS', 8)))
+
+
+class RequestValues(object):
+    """`request.values` of flask for a tornado request: query and form arguments"""
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def get(self, name, default=None):
+        # the first value of a repeated argument, query arguments first, not stripped, like flask
+        values = self.handler.get_arguments(name, strip=False)
+        return values[0] if values else default
+
+
+class AsyncResource(RequestHandler):
+
+    def write_result(self, result):
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(result))
+
+
+class SimilarityCheckerAsyncResource(AsyncResource):
+    """Async /similarity/check, see `api.SimilarityCheckerResource`"""
+
+    @gen.coroutine
+    def post(self):
+        result = {
+            'error': False,
+            'similarity': []
+        }
+        check = get_check_request(RequestValues(self), result)
+        if check:
+            s_similarity_checker, main_url, sub_urls = check
+            sims = yield s_similarity_checker.process_async(main_url, sub_urls, cpu_executor)
+            if isinstance(sims, basestring):
+                result['error'] = sims
+            elif sims:
+                result['similarity'] = sims
+            else:
+                result['error'] = 'Main page is empty'
+        self.write_result(result)
+
+
+class SimilarityCrossCheckerAsyncResource(AsyncResource):
+    """Async /similarity/cross-check, see `api.SimilarityCrossCheckerResource`"""
+
+    @gen.coroutine
+    def post(self):
+        result = {
+            'error': False,
+            'similarity': []
+        }
+        cross_check = get_cross_check_request(RequestValues(self), result)
+        if cross_check:
+            s_similarity_checker, url_1, url_2, url_3 = cross_check
+            sims = yield s_similarity_checker.cross_process_async(url_1, url_2, url_3, cpu_executor)
+            if sims:
+                result['similarity'] = sims
+        self.write_result(result)
+
+
+class PageExtractorAsyncResource(AsyncResource):
+    """Async /page/extract, see `api.PageExtractorResource`"""
+
+    @gen.coroutine
+    def post(self):
+        result = {
+            'error': False,
+            'pages': []
+        }
+        values = RequestValues(self)
+        extract = get_extract_request(values, result)
+        if extract:
+            s_content_getter, urls, selector = extract
+            pages = yield s_content_getter.process_async(urls, cpu_executor, selector)
+            result['pages'] = yield cpu_executor.submit(tokenize_pages, pages, values)
+        self.write_result(result)
+
+
+def make_application(wsgi_application):
+    """Tornado application of the async resources, the other requests go to the flask `wsgi_application`"""
+    return Application([
+        (r'/similarity/check/?', SimilarityCheckerAsyncResource),
+        (r'/similarity/cross-check/?', SimilarityCrossCheckerAsyncResource),
+        (r'/page/extract/?', PageExtractorAsyncResource),
+        (r'.*', WSGIResource, dict(wsgi_application=wsgi_application, executor=wsgi_executor)),
+    ])
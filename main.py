@@ -1,6 +1,10 @@
 from app import app
 from web import web
 import api
+from async_api import make_application
+
+# served by the tornado workers: the check and extract resources are async, the others run the flask app on threads
+application = make_application(app)
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=8888)
@@ -1,17 +1,236 @@
+import os
+import threading
+from Queue import Empty, Full, Queue
+
+from tornado import gen
+
+from util.cache import TieredCache
+from util.deadline import NO_DEADLINE, Deadline, timed_out_page
+from util.redis_client import get_redis_executor
+from util.singleflight import SingleFlight
 from util.utils import get_logger
 
+# extracted pages keyed by (url, crawler settings, extractor settings), so a cache hit skips both crawling and
+# extraction
+extraction_cache = TieredCache('extracted', max_size=int(os.environ.get('EXTRACT_CACHE_SIZE', 1024)),
+                               max_cost=int(os.environ.get('EXTRACT_CACHE_MAX_CHARS', 50000000)),
+                               cost=lambda page: len(page.get('content') or ''))
+# concurrent crawls and extractions of the same page with the same crawler and extractor settings
+extract_flight = SingleFlight('extract')
+# shares of the remaining request deadline given to crawling, then to extracting the crawled pages, the rest of the
+# deadline is left for tokenizing and scoring
+CRAWL_DEADLINE_SHARE = float(os.environ.get('CRAWL_DEADLINE_SHARE', 0.6))
+EXTRACT_DEADLINE_SHARE = float(os.environ.get('EXTRACT_DEADLINE_SHARE', 0.75))
+
+
+class PageIndexer(object):
+    """Adds extracted pages to the page indexes from a thread of the process, off the request path
+
+    The pages are indexed by batches of at most `batch_size` pages, so each index reads and writes its storage once
+    per batch. At most `max_pending` pages wait, the pages extracted while it is full are not indexed. The thread is
+    started by the first page of the process and again after a fork.
+    """
+
+    def __init__(self, max_pending=10000, batch_size=100):
+        self.logger = get_logger(self.__class__.__name__)
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def add(self, indexes, pages):
+        """Queue {url: content} pages to be added to `indexes`"""
+        queue = self._get_queue()
+        for url, content in pages.items():
+            try:
+                queue.put_nowait((indexes, url, content))
+            except Full:
+                self.logger.warning('Index queue is full, page %s is not indexed' % url)
+
+    def _get_queue(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = Queue(self.max_pending)
+                thread = threading.Thread(target=self._run, args=(self._queue,), name='page-indexer')
+                thread.setDaemon(True)
+                thread.start()
+                self._pid = os.getpid()
+            return self._queue
+
+    def _run(self, queue):
+        while True:
+            batch = [queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(queue.get_nowait())
+                except Empty:
+                    break
+            self.index(batch)
+
+    def index(self, batch):
+        """Add the (indexes, url, content) pages of a batch to their indexes"""
+        pages_by_index = {}
+        for indexes, url, content in batch:
+            for index in indexes:
+                pages_by_index.setdefault(index, {})[url] = content
+        for index, pages in pages_by_index.items():
+            try:
+                index.add_many(pages)
+            except Exception as ex:
+                self.logger.exception('Index %d pages error: %s' % (len(pages), ex))
+
+
+page_indexer = PageIndexer(max_pending=int(os.environ.get('INDEX_QUEUE_SIZE', 10000)))
+
 
 class ContentGetter(object):
 
-    def __init__(self, crawler, extractor):
+    def __init__(self, crawler, extractor, indexes=None, deadline=None):
         self.crawler = crawler
         self.extractor = extractor
+        # page indexes (e.g. near-duplicate index) which every successfully extracted page is added to
+        self.indexes = indexes or []
+        self.extract_expire_time = None
+        # `util.deadline.Deadline` of the request, the pages not fetched in time are marked as timed out
+        self.deadline = deadline or NO_DEADLINE
         self.logger = get_logger(self.__class__.__name__)
 
-    def process(self, urls):
-        # crawl pages
-        result = self.crawler.process(urls)
-        # extract content from pages
-        result = self.extractor.process(result)
+    def active_cache(self, expire_time, extract_expire_time=None):
+        """Cache raw pages for `expire_time` seconds and extracted pages for `extract_expire_time` seconds"""
+        self.crawler.active_redis_cache(expire_time)
+        self.extract_expire_time = extract_expire_time or expire_time
+        if extraction_cache.redis is None:
+            extraction_cache.active_redis_cache(self.extract_expire_time)
+
+    def process(self, urls, selector=None):
+        """Crawled and extracted pages of urls, `selector` is the selector of a selective extractor"""
+        return self.process_groups([(urls, selector)])[0]
+
+    def process_groups(self, groups):
+        """[pages of the urls of each group] of a list of (urls, selector) groups
+
+        The urls of all the groups are crawled once, in one batch, and a copy of each crawled page is extracted with
+        the selector of every group it belongs to.
+        """
+        results, group_keys, targets = self._get_cached(groups)
+        if not targets:
+            return results
+
+        # pages being fetched by concurrent requests are not fetched again
+        def fetch(flight_keys):
+            pages = self.fetch([targets[key] for key in flight_keys])
+            return {key: pages.get(targets[key]) for key in flight_keys}
+
+        pages = extract_flight.do_many(targets.keys(), fetch, self.deadline.remaining())
+        return self._add_fetched(results, group_keys, pages)
+
+    @gen.coroutine
+    def process_async(self, urls, executor, selector=None):
+        """Coroutine version of `process`, pages are crawled on the IOLoop and extracted on `executor`"""
+        results = yield self.process_groups_async([(urls, selector)], executor)
+        raise gen.Return(results[0])
+
+    @gen.coroutine
+    def process_groups_async(self, groups, executor):
+        """Coroutine version of `process_groups`"""
+        results, group_keys, targets = yield get_redis_executor().submit(self._get_cached, groups)
+        if not targets:
+            raise gen.Return(results)
+
+        @gen.coroutine
+        def fetch(flight_keys):
+            pages = yield self.fetch_async([targets[key] for key in flight_keys], executor)
+            raise gen.Return({key: pages.get(targets[key]) for key in flight_keys})
+
+        pages = yield extract_flight.do_many_async(targets.keys(), fetch, self.deadline.remaining())
+        raise gen.Return(self._add_fetched(results, group_keys, pages))
+
+    def _get_cached(self, groups):
+        """Return ([cached pages of each group], [{url: extraction cache key} of each group to be fetched],
+        {extraction cache key: (url, selector)} to be fetched)"""
+        group_keys = []
+        for urls, selector in groups:
+            settings = self.settings(selector)
+            group_keys.append({url: extraction_cache.make_key(url, *settings) for url in set(urls)})
+        cached = {}
+        if self.extract_expire_time:
+            cached = extraction_cache.get_many(list({key for keys in group_keys for key in keys.values()}))
+        results = []
+        fetched_keys = []
+        targets = {}
+        for (urls, selector), keys in zip(groups, group_keys):
+            # copy, callers add fields (e.g. tokens) to the returned pages
+            results.append({url: dict(cached[key]) for url, key in keys.items() if key in cached})
+            fetched_keys.append({url: key for url, key in keys.items() if key not in cached})
+            targets.update((key, (url, selector)) for url, key in fetched_keys[-1].items())
+        if self.extract_expire_time:
+            self.logger.info('Num of cached extracted pages: %d, remain: %d' %
+                             (sum(len(result) for result in results), len(targets)))
+        return results, fetched_keys, targets
+
+    @staticmethod
+    def _add_fetched(results, group_keys, pages):
+        for result, keys in zip(results, group_keys):
+            for url, key in keys.items():
+                page = pages.get(key)
+                if page is None:
+                    # not crawled before the deadline, by this request or the concurrent one fetching it
+                    result[url] = timed_out_page('Crawling')
+                else:
+                    # copy, the pages are shared with the groups and the concurrent requests
+                    result[url] = dict(page)
+        return results
+
+    def fetch(self, targets):
+        """{(url, selector): page} of (url, selector) targets, each url is crawled once"""
+        urls = list({url for url, _ in targets})
+        return self.extract_targets(self.crawler.process(urls, self.deadline.share(CRAWL_DEADLINE_SHARE)), targets)
+
+    @gen.coroutine
+    def fetch_async(self, targets, executor):
+        urls = list({url for url, _ in targets})
+        pages = yield self.crawler.process_async(urls, self.deadline.share(CRAWL_DEADLINE_SHARE))
+        pages = yield executor.submit(self.extract_targets, pages, targets)
+        raise gen.Return(pages)
+
+    def extract_targets(self, pages, targets):
+        """{(url, selector): page} of the crawled pages extracted with the selector of each target"""
+        urls_by_selector = {}
+        for url, selector in targets:
+            urls_by_selector.setdefault(selector, []).append(url)
+        # the selectors share the extraction part of the deadline
+        budget = Deadline(self.deadline.share(EXTRACT_DEADLINE_SHARE))
+        result = {}
+        for i, (selector, urls) in enumerate(urls_by_selector.items()):
+            # copy, the raw page may be extracted with other selectors too
+            extracted = self.extract({url: dict(pages[url]) for url in urls if url in pages}, selector,
+                                     budget.share(1.0 / (len(urls_by_selector) - i)))
+            result.update(((url, selector), page) for url, page in extracted.items())
         return result
 
+    def extract(self, pages, selector=None, timeout=None):
+        """Extract, index and cache crawled pages, the pages not extracted within `timeout` seconds time out"""
+        # extract content from pages
+        pages = self.extractor.process(pages, selector, timeout)
+        # index pages, in the background
+        if self.indexes:
+            self.index_pages(pages)
+        if self.extract_expire_time:
+            extraction_cache.set_many({extraction_cache.make_key(url, *self.settings(selector)): dict(page)
+                                       for url, page in pages.items() if self.is_valid(page)},
+                                      self.extract_expire_time)
+        return pages
+
+    def settings(self, selector=None):
+        """Everything an extracted page depends on, besides the url: the page rendered with other crawler options
+        (e.g. user agent) is another page"""
+        return self.crawler.settings() + self.extractor.settings(selector)
+
+    @staticmethod
+    def is_valid(page):
+        return page.get('ok') and not page.get('error') and page.get('content')
+
+    def index_pages(self, pages):
+        """Queue the valid pages to be indexed by the page indexer"""
+        page_indexer.add(self.indexes, {url: page['content'] for url, page in pages.items() if self.is_valid(page)})
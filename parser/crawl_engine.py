@@ -0,0 +1,95 @@
+import os
+import threading
+from datetime import timedelta
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from tornado import gen, locks
+from tornado.concurrent import chain_future
+from tornado.ioloop import IOLoop
+
+from util.deadline import Deadline
+from util.utils import get_logger
+
+
+class CrawlEngine(object):
+    """Event loop crawl engine shared by all crawlers of a process
+
+    Crawl coroutines run on one tornado IOLoop thread. The blocking fetches run on one shared executor, so
+    `max_concurrency` is the global limit of in-flight fetches of the process, and every call is bounded to
+    `max_fan_out` in-flight fetches so a big batch can not starve the other requests.
+    """
+
+    def __init__(self, max_concurrency=64, max_fan_out=16):
+        self.logger = get_logger(self.__class__.__name__)
+        self.max_concurrency = max_concurrency
+        self.max_fan_out = max_fan_out
+        self.io_loop = None
+        self.executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        # start lazily and again after a fork (e.g. gunicorn workers), threads do not survive fork
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.executor = ThreadPoolExecutor(self.max_concurrency)
+            self.io_loop = IOLoop(make_current=False)
+            thread = threading.Thread(target=self.io_loop.start, name='crawl-engine')
+            thread.setDaemon(True)
+            thread.start()
+            self._pid = os.getpid()
+            self.logger.info('Crawl engine started: max_concurrency=%d, max_fan_out=%d' %
+                             (self.max_concurrency, self.max_fan_out))
+
+    @gen.coroutine
+    def crawl_async(self, crawl_page, urls, max_fan_out=None, timeout=None):
+        """Coroutine crawling `urls` with `crawl_page(url) -> {url: page}`, must run on the engine loop
+
+        With a `timeout`, the pages crawled within `timeout` seconds are returned, the urls not started by then are
+        not crawled.
+        """
+        semaphore = locks.Semaphore(min(max_fan_out or self.max_fan_out, self.max_concurrency))
+        deadline = Deadline(timeout)
+        result = {}
+
+        @gen.coroutine
+        def crawl_one(url):
+            with (yield semaphore.acquire()):
+                if not deadline.expired():
+                    result.update((yield self.executor.submit(crawl_page, url)))
+
+        crawls = gen.multi_future([crawl_one(url) for url in urls])
+        if timeout is None:
+            yield crawls
+        else:
+            try:
+                yield gen.with_timeout(timedelta(seconds=deadline.remaining()), crawls)
+            except gen.TimeoutError:
+                self.logger.info('Crawl timeout: %d of %d urls crawled' % (len(result), len(urls)))
+        raise gen.Return(dict(result))
+
+    def submit(self, crawl_page, urls, max_fan_out=None, timeout=None):
+        """Thread-safe, schedule the crawl on the engine loop and return a `concurrent.futures.Future` of pages"""
+        self.start()
+        future = Future()
+        self.io_loop.add_callback(lambda: chain_future(self.crawl_async(crawl_page, urls, max_fan_out, timeout),
+                                                       future))
+        return future
+
+    def crawl(self, crawl_page, urls, max_fan_out=None, timeout=None):
+        """Synchronous adapter of `crawl_async`, for the crawlers called from request threads"""
+        return self.submit(crawl_page, urls, max_fan_out, timeout).result()
+
+
+_crawl_engine = None
+_crawl_engine_lock = threading.Lock()
+
+
+def get_crawl_engine():
+    global _crawl_engine
+    with _crawl_engine_lock:
+        if _crawl_engine is None:
+            _crawl_engine = CrawlEngine(max_concurrency=int(os.environ.get('CRAWL_CONCURRENCY', 64)),
+                                        max_fan_out=int(os.environ.get('CRAWL_FAN_OUT', 16)))
+    return _crawl_engine
@@ -1,17 +1,20 @@
-import json
-import os
-from multiprocessing import cpu_count
-from multiprocessing.dummy import Pool
 from datetime import datetime
 
 import requests
-from redis import StrictRedis
-
-from timeout_decorator import timeout, TimeoutError
 
+from parser.crawl_engine import get_crawl_engine
+from parser.page_cache import get_cached_pages, cache_pages
+from parser.http_session import get_session
+from util.deadline import Deadline
+from util.redis_client import get_redis
 from util.utils import get_logger, get_unicode
 
 
+def get_pages_session():
+    # crawled pages are spread over many hosts, keep a pool for each of the most recent ones
+    return get_session('pages', pool_size=get_crawl_engine().max_concurrency, pool_connections=100)
+
+
 class PageCrawler(object):
 
     def __init__(self, user_agent='Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 '
@@ -21,25 +24,24 @@ class PageCrawler(object):
         self.redis = None
         self.expire_time = None
 
+    def settings(self):
+        """Everything the crawled page depends on, besides the url, e.g. for cache keys"""
+        return 'http', self.user_agent
+
     def active_redis_cache(self, expire_time):
         self.logger.info('Cache is enabled')
         self.expire_time = expire_time
         if self.redis is None:
-            self.redis = StrictRedis(
-                db=3, host=os.environ.get('REDIS_HOST', 'localhost'), port=os.environ.get('REDIS_PORT', 6379))
+            self.redis = get_redis(3)
 
-    def process(self, urls):
+    def process(self, urls, timeout=None):
+        """Crawled pages of urls, the urls not crawled within `timeout` seconds are left out"""
         result = {}
         urls = list(set(urls))
 
         if self.redis:
             # Get crawled pages
-            for url in urls:
-                page = self.redis.get(url)
-                if not page:
-                    continue
-                self.logger.debug('Url was crawled: %s', url)
-                result[url] = json.loads(get_unicode(page))
+            result.update(get_cached_pages(self.redis, urls))
 
             self.logger.info("Num of crawled urls: %s" % len(result))
             # filter crawled page
@@ -52,33 +54,22 @@ class PageCrawler(object):
                 return result
 
         # Crawl new urls
-        if len(urls) > 2:
-            # use multi thread to crawl pages
-            pool = Pool(cpu_count() * 2)
-            pool_results = pool.map(self._crawl_page, urls)
-            # get results
-            for r in pool_results:
-                result.update(r)
-
-            pool.terminate()
-        else:
-            for url in urls:
-                result.update(self._crawl_page(url))
+        deadline = Deadline(timeout)
+        result.update(get_crawl_engine().crawl(lambda url: self._crawl_page(url, deadline.remaining()), urls,
+                                               timeout=timeout))
 
         if self.redis:
-            # Cache result
-            for url in urls:
-                page = result[url]
-                page['crawled_date'] = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-                self.redis.set(url, json.dumps(page, ensure_ascii=False, encoding='utf-8'), ex=self.expire_time)
+            # Cache result, the pages which timed out may be crawled next time
+            cache_pages(self.redis, {url: result[url] for url in urls
+                                     if url in result and not result[url].get('timed_out')}, self.expire_time)
 
         return result
 
-    @timeout(5, use_signals=False)
-    def _get_page(self, url, headers):
-        return requests.get(url, verify=False, timeout=5, headers=headers)
+    def _get_page(self, url, headers, timeout=None):
+        timeout = 5 if timeout is None else max(min(timeout, 5), 0.01)
+        return get_pages_session().get(url, verify=False, timeout=timeout, headers=headers)
 
-    def _crawl_page(self, url):
+    def _crawl_page(self, url, timeout=None):
         self.logger.debug('Start crawl %s...' % url)
         result = {
             url: {
@@ -89,7 +80,7 @@ class PageCrawler(object):
         if url:
             try:
                 headers = {'User-Agent': self.user_agent}
-                response = self._get_page(url, headers)
+                response = self._get_page(url, headers, timeout)
                 # raise exception when something error
                 if response.ok:
                     result[url]['content'] = response.content
@@ -101,8 +92,9 @@ class PageCrawler(object):
 
             except Exception as ex:
                 self.logger.error('crawl_page error: %s' % ex.message)
-                if isinstance(ex, TimeoutError):
+                if isinstance(ex, requests.Timeout):
                     result[url]['error'] = "Web page read timeout"
+                    result[url]['timed_out'] = True
                 else:
                     result[url]['error'] = str(ex.message)
 
@@ -142,20 +134,8 @@ class PageCrawlerWithStorage(object):
             self.logger.info('All urls has been crawled')
             return result
 
-        if len(urls) > 2:
-            # use multi thread to crawl pages
-            pool = Pool(cpu_count() * 2)
-            self.logger.debug('Have to crawl these urls: %s' % urls)
-            pool_results = pool.map(self._crawl_page, urls)
-            # get results
-            for r in pool_results:
-                result.update(r)
-
-            pool.close()
-            pool.terminate()
-        else:
-            for url in urls:
-                result.update(self._crawl_page(url))
+        self.logger.debug('Have to crawl these urls: %s' % urls)
+        result.update(get_crawl_engine().crawl(self._crawl_page, urls))
 
         return result
 
@@ -175,7 +155,7 @@ class PageCrawlerWithStorage(object):
 
             try:
                 headers = {'User-Agent': self.user_agent}
-                response = requests.get(url, verify=False, timeout=5, headers=headers)
+                response = get_pages_session().get(url, verify=False, timeout=5, headers=headers)
                 # raise exception when something error
                 if response.status_code == requests.codes.ok:
                     result['content'] = response.content
@@ -1,14 +1,30 @@
 import json
 import os
-from datetime import datetime
-from multiprocessing import cpu_count
-from multiprocessing.dummy import Pool
 
-import requests
-from redis import StrictRedis
-from timeout_decorator import timeout, TimeoutError
+from requests.exceptions import Timeout
+from tornado import gen
+from tornado.httpclient import HTTPRequest
+from tornado.httputil import url_concat
 
-from util.utils import get_logger, get_unicode
+from parser.crawl_engine import get_crawl_engine
+from parser.page_cache import get_cached_pages, cache_pages
+from parser.http_session import get_session, get_async_client, connection_stats
+from util.deadline import Deadline
+from util.redis_client import get_redis, get_redis_executor
+from util.singleflight import SingleFlight
+from util.utils import get_logger
+
+# concurrent render cluster calls of the same url with the same options
+crawl_flight = SingleFlight('crawl')
+# in-flight render cluster requests of the async crawls of a process, they do not take a thread each
+ASYNC_CRAWL_CONCURRENCY = int(os.environ.get('ASYNC_CRAWL_CONCURRENCY', 256))
+# seconds a crawl waits for the render cluster, less when the deadline of the request is closer
+CRAWL_REQUEST_TIMEOUT = float(os.environ.get('CRAWL_REQUEST_TIMEOUT', 50))
+
+
+def request_timeout(timeout):
+    """Timeout of a render cluster request, at least a little so it fails as a timeout"""
+    return CRAWL_REQUEST_TIMEOUT if timeout is None else max(min(timeout, CRAWL_REQUEST_TIMEOUT), 0.01)
 
 
 class PageCrawlerCluster(object):
@@ -23,25 +39,60 @@ class PageCrawlerCluster(object):
         self.page_load_timeout = page_load_timeout
         self.wait_after_last_request = wait_after_last_request
 
+    def settings(self):
+        """Everything the rendered page depends on, besides the url, e.g. for cache keys"""
+        return 'render-cluster', self.user_agent, self.page_load_timeout, self.wait_after_last_request
+
     def active_redis_cache(self, expire_time):
         self.logger.info('Cache is enabled')
         self.expire_time = expire_time
         if self.redis is None:
-            self.redis = StrictRedis(
-                db=3, host=os.environ.get('REDIS_HOST', 'localhost'), port=os.environ.get('REDIS_PORT', 6379))
-
-    def process(self, urls):
+            self.redis = get_redis(3)
+
+    def process(self, urls, timeout=None):
+        """Crawled pages of urls, the urls not crawled within `timeout` seconds are left out"""
+        result, urls = self._get_cached(urls)
+        if not urls:
+            return result
+
+        # Crawl new urls, the urls being crawled by concurrent requests are not crawled again
+        deadline = Deadline(timeout)
+        keys = self._flight_keys(urls)
+        pages = crawl_flight.do_many(keys.keys(), lambda flight_keys: {
+            key: page for key, page in zip(flight_keys, self._crawl([keys[key] for key in flight_keys],
+                                                                    deadline.remaining()))}, timeout)
+        self.logger.info('Render cluster connections: %d requests over %d connections' %
+                         connection_stats(self.session))
+        return self._add_crawled(result, urls, keys, pages)
+
+    @gen.coroutine
+    def process_async(self, urls, timeout=None):
+        """Coroutine version of `process`, the pages are crawled on the current IOLoop without blocking it"""
+        result, urls = yield get_redis_executor().submit(self._get_cached, urls)
+        if not urls:
+            raise gen.Return(result)
+
+        deadline = Deadline(timeout)
+        keys = self._flight_keys(urls)
+
+        @gen.coroutine
+        def crawl(flight_keys):
+            # the requests end by themselves at the deadline
+            pages = yield [self._crawl_page_async(keys[key], deadline.remaining()) for key in flight_keys]
+            raise gen.Return({key: page[keys[key]] for key, page in zip(flight_keys, pages)})
+
+        pages = yield crawl_flight.do_many_async(keys.keys(), crawl, timeout)
+        result = yield get_redis_executor().submit(self._add_crawled, result, urls, keys, pages)
+        raise gen.Return(result)
+
+    def _get_cached(self, urls):
+        """Return (cached pages, urls to be crawled)"""
         result = {}
         urls = list(set(urls))
 
         if self.redis:
             # Get crawled pages
-            for url in urls:
-                page = self.redis.get(url)
-                if not page:
-                    continue
-                self.logger.debug('Url was crawled: %s', url)
-                result[url] = json.loads(get_unicode(page))
+            result.update(get_cached_pages(self.redis, urls))
 
             self.logger.info("Num of crawled urls: %s" % len(result))
             # filter crawled page
@@ -51,41 +102,48 @@ class PageCrawlerCluster(object):
 
             if not urls:
                 self.logger.info('All urls has been crawled')
-                return result
-
-        # Crawl new urls
-        if len(urls) > 2:
-            # use multi thread to crawl pages
-            pool = Pool(cpu_count() * 2)
-            pool_results = pool.map(self._crawl_page, urls)
-            # get results
-            for r in pool_results:
-                result.update(r)
-
-            pool.terminate()
-        else:
-            for url in urls:
-                result.update(self._crawl_page(url))
+        return result, urls
+
+    def _flight_keys(self, urls):
+        return {crawl_flight.make_key(url, *self.settings()): url for url in urls}
+
+    def _add_crawled(self, result, urls, keys, pages):
+        # copy, the pages are shared with the concurrent requests
+        result.update((keys[key], dict(page)) for key, page in pages.items() if page is not None)
 
         if self.redis:
-            # Cache result
-            for url in urls:
-                page = result[url]
-                page['crawled_date'] = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-                self.redis.set(url, json.dumps(page, ensure_ascii=False, encoding='utf-8'), ex=self.expire_time)
+            # Cache result, the pages which timed out may be crawled next time
+            cache_pages(self.redis, {url: result[url] for url in urls
+                                     if url in result and not result[url].get('timed_out')}, self.expire_time)
 
         return result
 
-    # @timeout(15, use_signals=False)
-    def _get_page(self, url):
-        headers = {'Access-Key': self.access_key}
-        params = {'url': url,
-                  'userAgent': self.user_agent,
-                  'pageLoadTimeout': self.page_load_timeout,
-                  'waitAfterLastRequest': self.wait_after_last_request}
-        return requests.get(self.cluster, params=params, headers=headers)
+    def _crawl(self, urls, timeout=None):
+        """Crawled pages of urls in the same order, None for the urls not crawled within `timeout` seconds"""
+        deadline = Deadline(timeout)
+        pages = get_crawl_engine().crawl(lambda url: self._crawl_page(url, deadline.remaining()), urls,
+                                         timeout=timeout)
+        return [pages.get(url) for url in urls]
 
-    def _crawl_page(self, url):
+    def _get_page(self, url, timeout=None):
+        return self.session.get(self.cluster, params=self._render_params(url), headers=self._render_headers(),
+                                timeout=request_timeout(timeout))
+
+    def _render_params(self, url):
+        return {'url': url,
+                'userAgent': self.user_agent,
+                'pageLoadTimeout': self.page_load_timeout,
+                'waitAfterLastRequest': self.wait_after_last_request}
+
+    def _render_headers(self):
+        return {'Access-Key': self.access_key}
+
+    @property
+    def session(self):
+        # all requests go to the same render cluster host, keep as many connections as concurrent crawls
+        return get_session('render-cluster', pool_size=get_crawl_engine().max_concurrency)
+
+    def _crawl_page(self, url, timeout=None):
         self.logger.debug('Start crawl %s...' % url)
         result = {
             url: {
@@ -95,32 +153,64 @@ class PageCrawlerCluster(object):
         }
         if url:
             try:
-                response = self._get_page(url)
-                # raise exception when something error
-                if response.ok:
-                    payload = response.json()
-                    if not payload['pageTimeoutFlag']:
-                        result[url]['content'] = payload['html']
-                    else:
-                        result[url]['error'] = 'Crawling error: %s' % 'pageTimeoutFlag=true'
-
-                else:
-                    result[url]['error'] = 'Crawling error: %s' % response.reason
-
-                result[url]['code'] = response.status_code
-                result[url]['ok'] = response.ok and not result[url]['error']
-
+                response = self._get_page(url, timeout)
+                result[url].update(self._read_response(response.status_code, response.reason, response.content))
             except Exception as ex:
-                self.logger.error('crawl_page error: %s' % ex.message)
-                if isinstance(ex, TimeoutError):
-                    result[url]['error'] = "Web page read timeout"
-                else:
-                    result[url]['error'] = str(ex.message)
-
-                result[url]['code'] = 408
-                result[url]['ok'] = False
+                result[url].update(self._crawl_error(ex))
         else:
             result[url]['error'] = 'url is empty'
 
         self.logger.debug('End crawl %s...' % url)
         return result
+
+    @gen.coroutine
+    def _crawl_page_async(self, url, timeout=None):
+        self.logger.debug('Start async crawl %s...' % url)
+        result = {
+            url: {
+                'content': '',
+                'error': False
+            }
+        }
+        if url:
+            try:
+                request = HTTPRequest(url_concat(self.cluster, self._render_params(url)),
+                                      headers=self._render_headers(), request_timeout=request_timeout(timeout))
+                client = get_async_client('render-cluster', max_clients=ASYNC_CRAWL_CONCURRENCY)
+                response = yield client.fetch(request, raise_error=False)
+                if response.code == 599:
+                    # no response, e.g. connection error or timeout
+                    raise response.error
+                result[url].update(self._read_response(response.code, response.reason, response.body))
+            except Exception as ex:
+                result[url].update(self._crawl_error(ex))
+        else:
+            result[url]['error'] = 'url is empty'
+
+        self.logger.debug('End async crawl %s...' % url)
+        raise gen.Return(result)
+
+    @staticmethod
+    def _read_response(status_code, reason, body):
+        """Page fields of a render cluster response"""
+        page = {'error': False}
+        ok = status_code < 400
+        if ok:
+            payload = json.loads(body)
+            if not payload['pageTimeoutFlag']:
+                page['content'] = payload['html']
+            else:
+                page['error'] = 'Crawling error: %s' % 'pageTimeoutFlag=true'
+
+        else:
+            page['error'] = 'Crawling error: %s' % reason
+
+        page['code'] = status_code
+        page['ok'] = ok and not page['error']
+        return page
+
+    def _crawl_error(self, ex):
+        self.logger.error('crawl_page error: %s' % ex)
+        if isinstance(ex, Timeout) or getattr(ex, 'code', None) == 599 and 'Timeout' in str(ex):
+            return {'error': "Web page read timeout", 'code': 408, 'ok': False, 'timed_out': True}
+        return {'error': str(ex), 'code': 408, 'ok': False}
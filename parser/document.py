@@ -0,0 +1,106 @@
+import re
+from urlparse import urlparse
+
+from lxml import etree, html
+from lxml.cssselect import CSSSelector
+
+from util.utils import get_logger, get_unicode
+
+logger = get_logger(__name__)
+
+# text directly inside these elements is not visible
+INVISIBLE_TAGS = {'style', 'script', 'head', 'title'}
+# lxml refuses unicode strings with an encoding declaration
+XML_DECLARATION = re.compile(r'^\s*<\?xml[^>]*\?>')
+
+
+def get_text_from_url(url):
+    try:
+        parse_result = urlparse(url)
+        if not parse_result:
+            return ''
+        path = ' '.join([t.strip() for t in parse_result.path.split('/') if t and t.strip() and '.' not in t]) \
+            if parse_result.path else ''
+        path = re.sub(r'[^A-Za-z0-9]', ' ', path)
+        netloc_parts = parse_result.netloc.replace('www.', '').split('.')
+        root_name = netloc_parts[0] if len(netloc_parts) > 0 else ''
+        return get_unicode(root_name + ' ' + path)
+    except Exception as ex:
+        logger.exception('Error when get text from url')
+
+    return ''
+
+
+class ParsedDocument(object):
+    """HTML page parsed once with lxml, shared by all extraction steps of the page"""
+
+    def __init__(self, url, raw_html):
+        self.url = url
+        self.raw_html = raw_html
+        self._tree = None
+        self._parsed = False
+
+    @property
+    def tree(self):
+        """Root element of the page, None if the page can not be parsed"""
+        if not self._parsed:
+            self._parsed = True
+            raw_html = self.raw_html
+            if isinstance(raw_html, unicode):
+                # the declared encoding is the one of the bytes the page was decoded from
+                raw_html = XML_DECLARATION.sub(u'', raw_html, count=1)
+            try:
+                self._tree = html.document_fromstring(raw_html)
+            except Exception as ex:
+                logger.error('Parse page %s error: %s' % (self.url, ex))
+        return self._tree
+
+    @property
+    def title(self):
+        if self.tree is None:
+            return u''
+        title = self.tree.find('.//title')
+        return get_unicode(title.text) if title is not None and title.text else u''
+
+    def get_meta(self, name):
+        """Content of the first meta tag whose name (or property) matches `name`"""
+        if self.tree is None:
+            return u''
+        for meta in self.tree.iter('meta'):
+            element_name = meta.get('name') or meta.get('property')
+            if element_name and re.search(name, element_name, re.IGNORECASE):
+                return get_unicode(meta.get('content', ''))
+        return u''
+
+    @property
+    def url_text(self):
+        return get_text_from_url(self.url)
+
+    def common_info(self):
+        """Title, description, keywords and url text of the page"""
+        return [e for e in [self.title, self.get_meta('description'), self.get_meta('keywords'), self.url_text]
+                if e]
+
+    def visible_texts(self):
+        """All text nodes of the page in document order, except scripts, styles, comments and head elements"""
+        if self.tree is None:
+            return []
+        texts = []
+        for event, element in etree.iterwalk(self.tree, events=('start', 'end')):
+            if event == 'start':
+                if isinstance(element.tag, basestring) and element.tag not in INVISIBLE_TAGS and element.text:
+                    texts.append(element.text)
+            else:
+                # the tail of an element (comments included) is a text of its parent
+                parent = element.getparent()
+                if element.tail and parent is not None and parent.tag not in INVISIBLE_TAGS:
+                    texts.append(element.tail)
+        return texts
+
+    def select(self, selector, selector_type='css'):
+        """Elements matching the css or xpath `selector`"""
+        if self.tree is None:
+            return []
+        if selector_type == 'xpath':
+            return self.tree.xpath(selector)
+        return CSSSelector(selector)(self.tree)
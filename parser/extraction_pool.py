@@ -0,0 +1,231 @@
+import math
+import os
+import select
+import threading
+import time
+from Queue import Empty, Queue
+from multiprocessing import Pipe, Process, cpu_count
+
+from util.deadline import DeadlineExceeded, check_deadline, deadline
+from util.utils import get_logger
+
+logger = get_logger(__name__)
+
+
+def run_task(func, task, timeout):
+    """Return func(task) of a `(url, raw_content, ...)` task, `(url, None)` once the deadline of `timeout` seconds is
+    exceeded. The deadline is cooperative: the extraction functions check it between their steps."""
+    with deadline(timeout):
+        try:
+            check_deadline('extraction')
+            return func(task)
+        except DeadlineExceeded as ex:
+            logger.error('Extract page timeout: %s (%s)' % (task[0], ex))
+            return task[0], None
+
+
+def _work(conn):
+    """Loop of a worker process: run the (func, task, timeout) received on its pipe until None or the pipe closes"""
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+        func, task, timeout = message
+        try:
+            conn.send((run_task(func, task, timeout), None))
+        except Exception as ex:
+            conn.send((None, '%s: %s' % (ex.__class__.__name__, ex)))
+
+
+class ExtractionWorker(object):
+    """Worker process of the extraction pool, with a pipe of its own: killing it leaves no lock held that other
+    workers need"""
+
+    def __init__(self):
+        self.conn, child_conn = Pipe()
+        self.process = Process(target=_work, args=(child_conn,), name='extraction-worker')
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (IOError, OSError):
+            pass
+        self.conn.close()
+
+    def kill(self):
+        self.process.terminate()
+        self.conn.close()
+
+
+class ExtractionPool(object):
+    """Warm process pool extracting the pages of all requests of a process
+
+    The pool is created on first use and again after a fork, so every gunicorn worker owns one. Worker processes
+    are replaced after `max_tasks_per_child` pages to bound the memory leaked by the extraction libraries.
+
+    Each page is extracted with a cooperative deadline of `task_timeout` seconds, or less when the batch has to end
+    before. A worker still running a page a little after its deadline is stuck inside one step: it is killed and
+    replaced. Every worker has its own pipe, so a kill never leaves the other workers or the pool unusable.
+    """
+
+    def __init__(self, size=None, max_tasks_per_child=200, parallel_min_bytes=20000, task_timeout=5):
+        self.logger = get_logger(self.__class__.__name__)
+        self.size = size or cpu_count()
+        self.max_tasks_per_child = max_tasks_per_child or None
+        self.parallel_min_bytes = parallel_min_bytes
+        self.task_timeout = task_timeout
+        # idle workers, taken by the batches for one page at a time
+        self._idle = None
+        self._workers = set()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def workers(self):
+        """Worker processes of the pool of this process"""
+        self._start()
+        with self._lock:
+            return set(self._workers)
+
+    def _start(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._idle = Queue()
+                self._workers = set()
+                for _ in range(self.size):
+                    self._add_worker()
+                self._pid = os.getpid()
+                self.logger.info('Extraction pool started: size=%d, max_tasks_per_child=%s' %
+                                 (self.size, self.max_tasks_per_child))
+
+    def _add_worker(self):
+        worker = ExtractionWorker()
+        self._workers.add(worker)
+        self._idle.put(worker)
+
+    def _replace(self, worker, kill=False):
+        if kill:
+            worker.kill()
+        else:
+            worker.stop()
+        with self._lock:
+            self._workers.discard(worker)
+            self._add_worker()
+
+    def _release(self, worker):
+        worker.tasks += 1
+        if self.max_tasks_per_child and worker.tasks >= self.max_tasks_per_child:
+            self._replace(worker)
+        else:
+            self._idle.put(worker)
+
+    def should_parallelize(self, tasks):
+        """Parallel extraction pays off once the batch has enough HTML, whatever the number of pages"""
+        return len(tasks) > 1 and sum(len(task[1]) for task in tasks) >= self.parallel_min_bytes
+
+    def run(self, func, task):
+        """func(task) in this process, with the deadline of a pool task"""
+        return run_task(func, task, self.task_timeout)
+
+    def map(self, func, tasks, timeout=None):
+        """Return [func(task)] of the `(url, raw_content, ...)` tasks, `(url, None)` for the timed out ones
+
+        The batch takes at most `timeout` seconds.
+        """
+        self._start()
+        # every worker extracts its share of the batch one page after another
+        expire_at = time.time() + self.task_timeout * math.ceil(float(len(tasks)) / self.size)
+        if timeout is not None:
+            expire_at = min(expire_at, time.time() + timeout)
+        results = [None] * len(tasks)
+        pending = list(reversed(range(len(tasks))))
+        # {worker: (index of its task, deadline of its task)}
+        running = {}
+        error = None
+        while pending or running:
+            # a waiting batch takes the next idle worker, a running one only the idle workers at hand
+            while pending and time.time() < expire_at:
+                try:
+                    worker = self._idle.get(timeout=max(expire_at - time.time(), 0)) if not running else \
+                        self._idle.get_nowait()
+                except Empty:
+                    break
+                index = pending.pop()
+                budget = max(min(self.task_timeout, expire_at - time.time()), 0)
+                try:
+                    worker.conn.send((func, tasks[index], budget))
+                except (IOError, OSError):
+                    pending.append(index)
+                    self._replace(worker, kill=True)
+                    continue
+                running[worker] = (index, time.time() + budget)
+            if not running:
+                break
+
+            # a little longer than the deadline of the workers, which return by themselves once it is exceeded
+            wait = max(min(task_deadline for _, task_deadline in running.values()) + 0.1 - time.time(), 0)
+            ready, _, _ = select.select(list(running), [], [], wait)
+            for worker in ready:
+                index, _ = running.pop(worker)
+                try:
+                    results[index], task_error = worker.conn.recv()
+                except (EOFError, IOError, OSError) as ex:
+                    # the worker died, e.g. killed by the os
+                    self.logger.error('Extraction worker %d died: %s' % (worker.process.pid, ex))
+                    results[index] = (tasks[index][0], None)
+                    self._replace(worker, kill=True)
+                    continue
+                error = error or task_error
+                self._release(worker)
+            now = time.time()
+            for worker, (index, task_deadline) in running.items():
+                if now >= task_deadline + 0.1:
+                    self.logger.error('Kill extraction worker %d, stuck on %s' % (worker.process.pid,
+                                                                                   tasks[index][0]))
+                    del running[worker]
+                    results[index] = (tasks[index][0], None)
+                    self._replace(worker, kill=True)
+
+        for index in pending:
+            # no worker was free before the end of the batch
+            self.logger.error('Extract page timeout: %s' % tasks[index][0])
+            results[index] = (tasks[index][0], None)
+        if error:
+            raise RuntimeError('Extract pages error: %s' % error)
+        return results
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                for worker in self._workers:
+                    worker.kill()
+            self._workers = set()
+            self._idle = None
+            self._pid = None
+
+
+_extraction_pool = None
+_extraction_pool_lock = threading.Lock()
+
+
+def get_extraction_pool():
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is None:
+            _extraction_pool = ExtractionPool(size=int(os.environ.get('EXTRACT_POOL_SIZE', 0)) or None,
+                                              max_tasks_per_child=int(os.environ.get('EXTRACT_MAX_TASKS_PER_CHILD',
+                                                                                     200)),
+                                              parallel_min_bytes=int(os.environ.get('EXTRACT_PARALLEL_MIN_BYTES',
+                                                                                    20000)),
+                                              task_timeout=float(os.environ.get('EXTRACT_TIMEOUT', 5)))
+    return _extraction_pool
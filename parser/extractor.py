@@ -1,140 +1,87 @@
-import re
-from multiprocessing import Pool, cpu_count
-from urlparse import urlparse
-
-from bs4 import BeautifulSoup
-from bs4.element import Comment
 from dragnet import content_comments_extractor
+from readability.cleaners import html_cleaner
 from readability.readability import Document
 from goose import Goose
-from abc import ABCMeta, abstractmethod
+from abc import ABCMeta
 
-from timeout_decorator import timeout
+from parser.document import ParsedDocument, get_text_from_url
+from parser.extraction_pool import get_extraction_pool
+from util.deadline import check_deadline, deadline, timed_out_page
 from util.utils import get_logger, get_unicode
 
-from lxml import etree
-from lxml.cssselect import CSSSelector
-
 logger = get_logger(__name__)
 
 
 class PageExtractor(object):
     __metaclass__ = ABCMeta
+    name = None
+    # picklable extraction function of a task, run by the extraction pool
+    func = None
 
     def __init__(self):
         self.logger = get_logger(__name__)
 
-    def process(self, pages):
+    def settings(self, selector=None):
+        """Everything the extracted content depends on, besides the page, e.g. for cache keys"""
+        return self.name,
+
+    def task(self, url, raw_content, selector=None):
+        """Argument of `func` (and `extract`) for a page"""
+        return url, raw_content
+
+    def process(self, pages, selector=None, timeout=None):
+        """Extract the content of pages, `selector` overrides the selector of the extractor for this call only
+
+        The pages not extracted within `timeout` seconds are marked as timed out.
+        """
         self.logger.debug('Start extract pages: %s' % pages.keys())
-        item_num = len(pages)
-        if item_num > 10:
-            # get function
-            func = dragnet_extractor
-            if isinstance(self, DragnetPageExtractor):
-                func = dragnet_extractor
-            elif isinstance(self, ReadabilityPageExtractor):
-                func = readability_extractor
-            elif isinstance(self, GoosePageExtractor):
-                func = goose_extractor
-            elif isinstance(self, GooseDragnetPageExtractor):
-                func = goose_dragnet_extractor
-            elif isinstance(self, SelectivePageExtractor):
-                func = selective_extractor
-            elif isinstance(self, AllTextPageExtractor):
-                func = all_text_extractor
-            # use multi thread to crawl pages
-            pool = Pool(cpu_count())
-            if isinstance(self, SelectivePageExtractor):
-                data = [(get_unicode(url), page.get('content', ''), self.selector, self.selector_type)
-                        for url, page in pages.items() if page.get('content')]
+        raw_pages = []
+        for url, page in pages.items():
+            if page.get('timed_out'):
+                continue
+            if page.get('content'):
+                raw_pages.append((url, page['content']))
             else:
-                data = [(get_unicode(url), page.get('content', '')) for url, page in pages.items() if
-                        page.get('ok') and page.get('content')]
-            pool_results = pool.map(func, data)
-            # get results
-            for r in pool_results:
-                pages[r[0]]['content'] = r[1]
-
-            pool.close()
-            pool.terminate()
-            for url, page in pages.items():
-                if not page['content']:
-                    page['content'] = url
-                    continue
-                page['content'] = ', '.join(c for c in [page['content']] if c)
+                page['content'] = url
+
+        tasks = [self.task(url, raw_content, selector) for url, raw_content in raw_pages]
+        pool = get_extraction_pool()
+        if pool.should_parallelize(raw_pages):
+            results = pool.map(self.func, tasks, timeout)
         else:
-            for url, page in pages.items():
-                if not page['content']:
-                    page['content'] = url
-                    continue
-                page['content'] = ', '.join(c for c in [self.extract((url, page['content']))[1]] if c)
+            with deadline(timeout):
+                results = [self.extract(task) for task in tasks]
+        for url, content in results:
+            if content is None:
+                pages[url].update(timed_out_page('Extraction'))
+            else:
+                pages[url]['content'] = content
 
         self.logger.debug('End extract pages: %s' % pages.keys())
         return pages
-    
-    @abstractmethod
-    def extract(self, (url, raw_content)):
-        pass
-
-
-def get_soup_meta(soup, name):
-    metas = soup.findAll('meta')
-    for meta in metas:
-        element_name = str(meta.get('name'))
-        if not element_name:
-            element_name = str(meta.get('property'))
-        if re.findall(name, element_name, re.IGNORECASE):
-            return get_unicode(meta.get('content', ''))
 
-    return u''
+    def extract(self, task):
+        """Extract a task in this process, with the same deadline as in the pool"""
+        return get_extraction_pool().run(self.func, task)
 
 
-def build_sup(raw_content):
-    return BeautifulSoup(raw_content, 'html.parser')
-
-
-def get_common_info(url, raw_html):
+def get_common_info(url, raw_html, doc=None):
     try:
-        soup = build_sup(raw_html)
-        title = soup.title.string if soup.title else u''
-        title = get_unicode(title) if title else u''
-        description = get_soup_meta(soup, 'description')
-        keywords = get_soup_meta(soup, 'keywords')
+        doc = doc or ParsedDocument(url, raw_html)
+        return doc.common_info()
     except Exception as ex:
         logger.exception('Error when get common info')
         return []
 
-    return [e for e in [title, description, keywords, get_text_from_url(url)] if e]
-
-
-def get_text_from_url(url):
-    try:
-        parse_result = urlparse(url)
-        if not parse_result:
-            return ''
-        path = ' '.join([t.strip() for t in parse_result.path.split('/') if t and t.strip() and '.' not in t]) \
-            if parse_result.path else ''
-        path = re.sub(r'[^A-Za-z0-9]', ' ', path)
-        netloc_parts = parse_result.netloc.replace('www.', '').split('.')
-        root_name = netloc_parts[0] if len(netloc_parts) > 0 else ''
-        return get_unicode(root_name + ' ' + path)
-    except Exception as ex:
-        logger.exception('Error when get text from url')
-
-    return ''
-
 
-@timeout(5, use_signals=False)
-def dragnet_extractor((url, raw_content)):
+def _dragnet_extractor((url, raw_content)):
     logger.debug('Start dragnet_extractor: %s' % url)
-    elements = []
-    try:
-        elements = get_common_info(url, raw_content)
-    except Exception as ex:
-        logger.exception('Unicode issue: %s' % ex.message)
+    elements = get_common_info(url, raw_content)
+    check_deadline('dragnet')
 
     result = ''
     try:
+        # dragnet only analyzes raw html
         content = content_comments_extractor.analyze(raw_content)
         elements.append(get_unicode(content))
         result = ', '.join(get_unicode(c) for c in elements if c)
@@ -146,29 +93,14 @@ def dragnet_extractor((url, raw_content)):
     return url, result
 
 
-def visible(element):
-    if element.parent.name in ['style', 'script', '[document]', 'head', 'title']:
-        return False
-    if isinstance(element, Comment):
-        return False
-    elif re.match(r'<!--.*-->', get_unicode(element)):
-        return False
-    return True
-
-
-@timeout(5, use_signals=False)
-def all_text_extractor((url, raw_content)):
+def _all_text_extractor((url, raw_content)):
     logger.debug('Start all_text_extractor: %s' % url)
     result = ''
     try:
-        soup = build_sup(raw_content)
-        texts = soup.findAll(text=True)
-        # Get all visible text
-        visible_texts = filter(visible, texts)
-        # Get common info
-        common_texts = get_common_info(url, raw_content)
-
-        all_texts = common_texts + visible_texts
+        doc = ParsedDocument(url, raw_content)
+        all_texts = get_common_info(url, raw_content, doc)
+        check_deadline('visible texts')
+        all_texts += doc.visible_texts()
         result = ', '.join(get_unicode(t.strip()) for t in all_texts if t and t.strip())
     except Exception as ex:
         logger.exception('All text extractor: %s' % ex.message)
@@ -177,21 +109,16 @@ def all_text_extractor((url, raw_content)):
     return url, result
 
 
-@timeout(5, use_signals=False)
-def selective_extractor((url, raw_content, selector, selector_type)):
+def _selective_extractor((url, raw_content, selector, selector_type)):
     logger.debug('Start selective_extractor: %s' % url)
     result = ''
     elem = ''
     try:
-        tree = etree.HTML(raw_content)
-        if selector_type == 'xpath':
-            elem = tree.xpath(selector)
-        elif selector_type == 'css':
-            css_selector = CSSSelector(selector)
-            elem = css_selector(tree)
+        elem = ParsedDocument(url, raw_content).select(selector, selector_type)
 
         if type(elem) is list:
             for e in elem:
+                check_deadline('selected texts')
                 result += ' '.join(get_unicode(x.text) for x in e.iter() if x.text) + ' '
         else:
             result = ' '.join(get_unicode(x.text) for x in elem.iter() if x.text)
@@ -205,40 +132,55 @@ def selective_extractor((url, raw_content, selector, selector_type)):
 
 
 class DragnetPageExtractor(PageExtractor):
+    name = 'dragnet'
+    func = staticmethod(_dragnet_extractor)
 
     def __init__(self):
         super(DragnetPageExtractor, self).__init__()
 
-    def extract(self, (url, raw_content)):
-        return dragnet_extractor((url, raw_content))
 
+class TreeDocument(Document):
+    """Readability document reusing the tree of a parsed document instead of parsing the html again"""
 
-@timeout(5, use_signals=False)
-def readability_extractor((url, raw_content)):
+    def __init__(self, doc, **options):
+        # old-style class
+        Document.__init__(self, doc.raw_html, **options)
+        self.doc = doc
+
+    def _parse(self, input):
+        if self.doc.tree is None:
+            return Document._parse(self, input)
+        # readability modifies the tree, cleaning returns a copy so the parsed document is left untouched
+        doc = html_cleaner.clean_html(self.doc.tree)
+        doc.resolve_base_href()
+        return doc
+
+
+def _readability_extractor((url, raw_content)):
     logger.debug('Start readability_extractor: %s' % url)
+    doc = ParsedDocument(url, raw_content)
     content = ''
     try:
-        doc = Document(raw_content)
-        content = doc.summary()
+        content = TreeDocument(doc).summary()
     except Exception as ex:
         logger.exception('readability extract_page_content error: %s' % ex.message)
         logger.error('url: %s' % url)
+    check_deadline('common info')
 
-    elements = get_common_info(url, raw_content)
+    elements = get_common_info(url, raw_content, doc)
     elements.append(get_unicode(content))
     result = ', '.join(c for c in elements if c)
     logger.debug('End readability_extractor: %s' % url)
-    return result
+    return url, result
 
 
 class ReadabilityPageExtractor(PageExtractor):
+    name = 'readability'
+    func = staticmethod(_readability_extractor)
 
     def __init__(self):
         super(ReadabilityPageExtractor, self).__init__()
 
-    def extract(self, (url, raw_content)):
-        return readability_extractor((url, raw_content))
-
 
 def get_goose_content(url, doc, name):
     result = ''
@@ -263,14 +205,14 @@ def get_goose_doc(raw_content):
     return Goose().extract(raw_html=raw_content)
 
 
-@timeout(5, use_signals=False)
-def goose_extractor((url, raw_content)):
+def _goose_extractor((url, raw_content)):
     logger.debug('Start goose_extractor: %s' % url)
     result = ''
     try:
         if raw_content and raw_content.strip():
             try:
                 doc = get_goose_doc(raw_content)
+                check_deadline('common info')
                 cleaned_text = get_goose_content(url, doc, 'cleaned_text')
                 elements = get_common_info(url, raw_content)
                 elements.append(get_unicode(cleaned_text))
@@ -288,22 +230,21 @@ def goose_extractor((url, raw_content)):
 
 
 class GoosePageExtractor(PageExtractor):
+    name = 'goose'
+    func = staticmethod(_goose_extractor)
 
     def __init__(self):
         super(GoosePageExtractor, self).__init__()
 
-    def extract(self, (url, raw_content)):
-        return goose_extractor((url, raw_content))
-
 
-@timeout(5, use_signals=False)
-def goose_dragnet_extractor((url, raw_content)):
+def _goose_dragnet_extractor((url, raw_content)):
     logger.debug('Start goose_dragnet_extractor: %s' % url)
     content = ''
     try:
         content = content_comments_extractor.analyze(raw_content)
     except Exception as ex:
         logger.exception('dragnet extract page content and comment error: %s' % ex.message)
+    check_deadline('goose')
 
     meta_text = ''
     try:
@@ -331,32 +272,32 @@ def goose_dragnet_extractor((url, raw_content)):
 
 
 class GooseDragnetPageExtractor(PageExtractor):
+    name = 'goose_dragnet'
+    func = staticmethod(_goose_dragnet_extractor)
 
     def __init__(self):
         super(GooseDragnetPageExtractor, self).__init__()
 
-    def extract(self, (url, raw_content)):
-        return goose_dragnet_extractor((url, raw_content))
-
 
 class AllTextPageExtractor(PageExtractor):
+    name = 'all_text'
+    func = staticmethod(_all_text_extractor)
 
     def __init__(self):
         super(AllTextPageExtractor, self).__init__()
 
-    def extract(self, (url, raw_content)):
-        return all_text_extractor((url, raw_content))
-
 
 class SelectivePageExtractor(PageExtractor):
+    name = 'selective'
+    func = staticmethod(_selective_extractor)
 
     def __init__(self, selector, selector_type='css'):
         super(SelectivePageExtractor, self).__init__()
         self.selector = selector
         self.selector_type = selector_type
 
-    def extract(self, (url, raw_content)):
-        return selective_extractor((url, raw_content, self.selector, self.selector_type))
-
-
+    def task(self, url, raw_content, selector=None):
+        return url, raw_content, selector or self.selector, self.selector_type
 
+    def settings(self, selector=None):
+        return self.name, selector or self.selector, self.selector_type
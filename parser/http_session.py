@@ -0,0 +1,104 @@
+import cookielib
+import os
+import socket
+import threading
+import time
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+
+from util.utils import get_logger
+
+logger = get_logger(__name__)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+# {io loop: {name: client}}
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_session(name, pool_size, pool_connections=10):
+    """Keep-alive `requests.Session` shared by all threads of the process
+
+    `pool_size` is the number of connections kept per host, it should match the crawl concurrency. Cookies are
+    never stored, so pages crawled for different requests do not leak state into each other.
+    """
+    key = (os.getpid(), name)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            install_dns_cache()
+            session = requests.Session()
+            session.cookies.set_policy(cookielib.DefaultCookiePolicy(allowed_domains=[]))
+            adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[key] = session
+            logger.info('Created http session %s: pool_size=%d' % (name, pool_size))
+    return session
+
+
+def get_async_client(name, max_clients):
+    """Own `AsyncHTTPClient` of the current IOLoop, with up to `max_clients` requests in flight
+
+    The shared client of the loop may have been created with other options (default 10 clients), so each name gets
+    its own instance. Must be called on the loop thread.
+    """
+    io_loop = IOLoop.current()
+    clients = _async_clients.setdefault(io_loop, {})
+    client = clients.get(name)
+    if client is None:
+        install_dns_cache()
+        client = AsyncHTTPClient(force_instance=True, max_clients=max_clients)
+        clients[name] = client
+        logger.info('Created async http client %s: max_clients=%d' % (name, max_clients))
+    return client
+
+
+def connection_stats(session):
+    """Return (number of requests, number of new connections) sent through the session pools"""
+    num_requests = 0
+    num_connections = 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+    return num_requests, num_connections
+
+
+_getaddrinfo = socket.getaddrinfo
+_dns_cache = {}
+_dns_cache_lock = threading.Lock()
+_dns_cache_ttl = None
+
+
+def _cached_getaddrinfo(*args, **kwargs):
+    key = (args, tuple(sorted(kwargs.items())))
+    now = time.time()
+    entry = _dns_cache.get(key)
+    if entry and entry[0] > now:
+        return entry[1]
+    result = _getaddrinfo(*args, **kwargs)
+    with _dns_cache_lock:
+        if len(_dns_cache) >= 10000:
+            _dns_cache.clear()
+        _dns_cache[key] = (now + _dns_cache_ttl, result)
+    return result
+
+
+def install_dns_cache(ttl=None):
+    """Cache DNS results of the process for `ttl` seconds (env DNS_CACHE_TTL, default 300, 0 disables)"""
+    global _dns_cache_ttl
+    if ttl is None:
+        ttl = int(os.environ.get('DNS_CACHE_TTL', 300))
+    if not ttl or socket.getaddrinfo is _cached_getaddrinfo:
+        return
+    _dns_cache_ttl = ttl
+    socket.getaddrinfo = _cached_getaddrinfo
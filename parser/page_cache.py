@@ -0,0 +1,27 @@
+import json
+from datetime import datetime
+
+from util.utils import get_unicode
+
+
+def get_cached_pages(redis, urls, batch_size=500):
+    """Get the cached pages of urls, one MGET round trip per `batch_size` urls"""
+    result = {}
+    for start in range(0, len(urls), batch_size):
+        batch = urls[start:start + batch_size]
+        for url, page in zip(batch, redis.mget(batch)):
+            if page:
+                result[url] = json.loads(get_unicode(page))
+    return result
+
+
+def cache_pages(redis, pages, expire_time):
+    """Cache crawled pages with `SET ... EX`, all in one pipelined round trip"""
+    if not pages:
+        return
+    crawled_date = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    pipe = redis.pipeline(transaction=False)
+    for url, page in pages.items():
+        page['crawled_date'] = crawled_date
+        pipe.set(url, json.dumps(page, ensure_ascii=False, encoding='utf-8'), ex=expire_time)
+    pipe.execute()
@@ -0,0 +1,71 @@
+import math
+import re
+from collections import Counter, defaultdict
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+
+def analyze(content):
+    """Lowercase word tokens of the content, like the `standard` analyzer of Elasticsearch"""
+    if type(content) is not unicode:
+        content = unicode(content, 'utf-8', errors='ignore')
+    return TOKEN_PATTERN.findall(content.lower())
+
+
+class BM25Index(object):
+    """In-process inverted index scoring `match` queries with BM25, the way Lucene does
+
+    score(q, d) = sum over query tokens t of idf(t) * tf(t, d) * (k1 + 1) / (tf(t, d) + k1 * (1 - b + b * |d| / avgdl))
+    with idf(t) = log(1 + (N - df(t) + 0.5) / (df(t) + 0.5)). A token repeated in the query counts once per
+    occurrence, like the should clauses of a `match` query.
+    """
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        # token -> {doc id: term frequency}
+        self.postings = defaultdict(dict)
+        self.lengths = {}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def add(self, doc_id, content):
+        if doc_id in self.lengths:
+            self.remove(doc_id)
+        tokens = analyze(content)
+        for token, tf in Counter(tokens).iteritems():
+            self.postings[token][doc_id] = tf
+        self.lengths[doc_id] = len(tokens)
+        self.total_length += len(tokens)
+
+    def remove(self, doc_id):
+        length = self.lengths.pop(doc_id, None)
+        if length is None:
+            return
+        self.total_length -= length
+        for token in self.postings.keys():
+            docs = self.postings[token]
+            if docs.pop(doc_id, None) is not None and not docs:
+                del self.postings[token]
+
+    def idf(self, token):
+        df = len(self.postings.get(token, ()))
+        return math.log(1 + (len(self.lengths) - df + 0.5) / (df + 0.5))
+
+    def search(self, content):
+        """Return [(doc id, score)] of the documents sharing a token with the query, highest score first"""
+        if not self.lengths:
+            return []
+        avgdl = float(self.total_length) / len(self.lengths)
+        scores = defaultdict(float)
+        for token, query_tf in Counter(analyze(content)).iteritems():
+            docs = self.postings.get(token)
+            if not docs:
+                continue
+            weight = query_tf * self.idf(token) * (self.k1 + 1)
+            for doc_id, tf in docs.iteritems():
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[doc_id] / avgdl)
+                scores[doc_id] += weight * tf / (tf + norm)
+        return sorted(scores.iteritems(), key=lambda x: x[1], reverse=True)
@@ -0,0 +1,58 @@
+from fuzzywuzzy import fuzz
+
+# below this many character pairs the C implementation of `fuzz.ratio` is faster
+MIN_BOUNDED_CELLS = 250000
+
+
+def ratio_score(lcs, total_length):
+    """`fuzz.ratio` of two strings of `total_length` characters sharing a longest common subsequence of `lcs`"""
+    return int(round(100 * (float(2 * lcs) / total_length)))
+
+
+def min_lcs(min_score, total_length):
+    """Smallest longest common subsequence scoring at least `min_score`"""
+    lcs = max(int((min_score - 0.5) * total_length / 200), 0)
+    while ratio_score(lcs, total_length) < min_score:
+        lcs += 1
+    return lcs
+
+
+def bounded_ratio(s1, s2, min_score=0, check_every=256, min_cells=MIN_BOUNDED_CELLS):
+    """`fuzz.ratio` of the strings if it is at least `min_score`, else 0
+
+    `fuzz.ratio` is 2 * LCS / (len(s1) + len(s2)) (indel distance of python-Levenshtein). Pairs whose length
+    ratio can not reach `min_score` are rejected without comparing them. The others are compared with the
+    bit-parallel LCS algorithm (Hyyro), which stops as soon as the LCS can no longer reach the score.
+    """
+    if not s1 or not s2 or s1 == s2:
+        score = fuzz.ratio(s1, s2)
+        return score if score >= min_score else 0
+
+    if len(s1) > len(s2):
+        s1, s2 = s2, s1
+    n, m = len(s1), len(s2)
+    total_length = n + m
+    # length filter, the LCS is at most the length of the shortest string
+    if ratio_score(n, total_length) < min_score:
+        return 0
+    if n * m < min_cells:
+        score = fuzz.ratio(s1, s2)
+        return score if score >= min_score else 0
+
+    required = min_lcs(min_score, total_length)
+    # bit i of the match mask of a character is set when s1[i] is that character
+    masks = {}
+    for i, c in enumerate(s1):
+        masks[c] = masks.get(c, 0) | (1 << i)
+    full = (1 << n) - 1
+    v = full
+    for j, c in enumerate(s2, 1):
+        u = v & masks.get(c, 0)
+        v = ((v + u) | (v - u)) & full
+        if j % check_every == 0:
+            # zero bits of v are the LCS of s1 and s2[:j], each remaining character adds at most 1
+            if n - bin(v).count('1') + (m - j) < required:
+                return 0
+
+    lcs = n - bin(v).count('1')
+    return ratio_score(lcs, total_length) if lcs >= required else 0
@@ -0,0 +1,82 @@
+import numpy as np
+from scipy import sparse
+
+from similarity.ngram import is_hashed
+
+
+def build_token_matrix(token_lists):
+    """Build a binary sparse matrix (one row per document, one column per distinct token)"""
+    if token_lists and all(is_hashed(tokens) for tokens in token_lists):
+        return build_hash_matrix(token_lists)
+
+    vocabulary = {}
+    indices = []
+    indptr = [0]
+    for tokens in token_lists:
+        columns = {vocabulary.setdefault(t, len(vocabulary)) for t in tokens}
+        indices.extend(columns)
+        indptr.append(len(indices))
+
+    data = np.ones(len(indices), dtype=np.int32)
+    shape = (len(token_lists), max(len(vocabulary), 1))
+    return sparse.csr_matrix((data, np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int32)),
+                             shape=shape)
+
+
+def build_hash_matrix(hash_lists):
+    """Same as `build_token_matrix` for hashed n-grams, without any python level loop over the tokens"""
+    rows = [np.unique(hashes) for hashes in hash_lists]
+    indptr = np.concatenate([[0], np.cumsum([len(row) for row in rows])]).astype(np.int32)
+    vocabulary, indices = np.unique(np.concatenate(rows), return_inverse=True)
+    data = np.ones(len(indices), dtype=np.int32)
+    return sparse.csr_matrix((data, indices.astype(np.int32), indptr),
+                             shape=(len(hash_lists), max(len(vocabulary), 1)))
+
+
+def overlap_counts(main_tokens, token_lists):
+    """Return (main size, sizes, overlaps) of the main token set against every token set in `token_lists`"""
+    matrix = build_token_matrix([main_tokens] + list(token_lists))
+    sizes = np.diff(matrix.indptr).astype(np.float64)
+    overlaps = (matrix[1:] * matrix[0].T).toarray().ravel().astype(np.float64)
+    return sizes[0], sizes[1:], overlaps
+
+
+def set_overlap_counts(main_set, sets):
+    """Same as `overlap_counts` for sorted distinct hashes, one binary search in the main set per hash"""
+    sizes = np.array([len(s) for s in sets], dtype=np.float64)
+    if not len(main_set):
+        return 0.0, sizes, np.zeros(len(sets))
+    all_hashes = np.concatenate(sets)
+    owners = np.repeat(np.arange(len(sets)), sizes.astype(np.int64))
+    positions = np.minimum(np.searchsorted(main_set, all_hashes), len(main_set) - 1)
+    shared = main_set[positions] == all_hashes
+    overlaps = np.bincount(owners[shared], minlength=len(sets)).astype(np.float64)
+    return float(len(main_set)), sizes, overlaps
+
+
+def cosine_similarity_batch(main_tokens, token_lists, sets=False):
+    """Vectorized `cosine_similarity` of main tokens against many token lists, the scores are the same
+
+    With `sets`, the tokens are sorted distinct hashes (`PreparedDocument.token_set`).
+    """
+    if not token_lists:
+        return []
+    main_size, sizes, overlaps = (set_overlap_counts if sets else overlap_counts)(main_tokens, token_lists)
+    denominators = np.sqrt(main_size) * np.sqrt(sizes)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = overlaps / denominators * 100
+    return [round(float(s), 2) if d else 0.0 for s, d in zip(scores, denominators)]
+
+
+def jaccard_similarity_batch(main_tokens, token_lists, sets=False):
+    """Vectorized `jaccard_similarity` of main tokens against many token lists, the scores are the same
+
+    With `sets`, the tokens are sorted distinct hashes (`PreparedDocument.token_set`).
+    """
+    if not token_lists:
+        return []
+    main_size, sizes, overlaps = (set_overlap_counts if sets else overlap_counts)(main_tokens, token_lists)
+    unions = main_size + sizes - overlaps
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = overlaps / unions * 100
+    return [round(float(s), 2) if u else 0.0 for s, u in zip(scores, unions)]
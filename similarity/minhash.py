@@ -0,0 +1,90 @@
+import hashlib
+import random
+
+import numpy as np
+
+from similarity.storage import content_digest
+from similarity_checker import tokenize_and_normalize_content
+from util.utils import get_logger
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+class MinHasher(object):
+    """MinHash signatures of hashed n-grams, (a * x + b) mod p permutations computed with numpy"""
+
+    def __init__(self, num_perm=128, seed=1, block_size=4096):
+        rnd = random.Random(seed)
+        self.num_perm = num_perm
+        self.block_size = block_size
+        self.a = np.array([rnd.randint(1, (1 << 61) - 2) for _ in range(num_perm)], dtype=np.uint64)
+        self.b = np.array([rnd.randint(0, (1 << 61) - 2) for _ in range(num_perm)], dtype=np.uint64)
+
+    def signature(self, hashes):
+        signature = np.empty(self.num_perm, dtype=np.uint64)
+        signature.fill(MAX_HASH)
+        values = np.unique(np.asarray(hashes, dtype=np.uint64)) & MAX_HASH
+        # permute by blocks, so memory stays bounded on very large pages
+        for start in range(0, len(values), self.block_size):
+            block = values[start:start + self.block_size]
+            permuted = ((block[:, np.newaxis] * self.a + self.b) % MERSENNE_PRIME) & MAX_HASH
+            signature = np.minimum(signature, permuted.min(axis=0))
+        return signature
+
+
+def optimal_bands(threshold, num_perm):
+    """Choose (bands, rows) whose LSH S-curve (1 / bands) ^ (1 / rows) is the closest to the threshold"""
+    params = [(b, num_perm // b) for b in range(1, num_perm + 1) if num_perm % b == 0]
+    return min(params, key=lambda p: abs((1.0 / p[0]) ** (1.0 / p[1]) - threshold))
+
+
+class MinHashLSH(object):
+    """Banded LSH index of MinHash signatures, answers near-duplicate candidates of a content in sub-linear time
+
+    Each page record keeps its signature only, a page sharing a band with the content is a candidate as long as
+    the bands of its current signature share one. Candidates are re-scored exactly from their extracted pages.
+    """
+
+    def __init__(self, storage, threshold=0.5, num_perm=128, unit='word', min_ngram=1, max_ngram=1):
+        self.logger = get_logger(self.__class__.__name__)
+        self.storage = storage
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm=num_perm)
+        self.bands, self.rows = optimal_bands(threshold, num_perm)
+        self.unit = unit
+        self.min_ngram = min_ngram
+        self.max_ngram = max_ngram
+
+    def signature(self, content):
+        return self.hasher.signature(tokenize_and_normalize_content(
+            content, unit=self.unit, min_ngram=self.min_ngram, max_ngram=self.max_ngram, hashed=True))
+
+    def band_keys(self, signature):
+        signature = np.asarray(signature, dtype=np.uint64)
+        return ['%d:%s' % (i, hashlib.md5(signature[i * self.rows:(i + 1) * self.rows].tostring()).hexdigest())
+                for i in range(self.bands)]
+
+    def add(self, url, content):
+        self.add_many({url: content})
+
+    def add_many(self, pages):
+        """Index {url: content} pages, the pages whose content did not change since they were indexed are skipped"""
+        urls = list(pages)
+        entries = []
+        for url, indexed_digest in zip(urls, self.storage.get_digests(urls)):
+            digest = content_digest(pages[url])
+            if digest == indexed_digest:
+                continue
+            signature = self.signature(pages[url])
+            entries.append((url, digest, self.band_keys(signature), {'signature': signature.tolist()}))
+        self.storage.set_entries(entries)
+        self.logger.debug('Indexed %d pages, %d unchanged' % (len(entries), len(urls) - len(entries)))
+
+    def query(self, content, exclude=()):
+        """Return urls of the indexed pages sharing at least one band with the content"""
+        bands = set(self.band_keys(self.signature(content)))
+        candidates = [url for url in self.storage.get_members(bands) if url not in exclude]
+        # the buckets of the previous signature of a changed page keep it until they expire
+        return [url for url, record in zip(candidates, self.storage.get_records(candidates))
+                if record and bands.intersection(self.band_keys(record['signature']))]
@@ -0,0 +1,72 @@
+import hashlib
+import struct
+
+import numpy as np
+
+# multiplier of the polynomial (Rabin-Karp style) hash, arithmetic is modulo 2^64 (numpy uint64 wraps around)
+BASE = np.uint64(1099511628211)
+GOLDEN = 0x9E3779B97F4A7C15
+MASK_64 = (1 << 64) - 1
+
+
+def word_hash(word):
+    """Stable 64-bit hash of a word (same value in every process, unlike `hash`)"""
+    if isinstance(word, unicode):
+        word = word.encode('utf-8')
+    return struct.unpack('<Q', hashlib.md5(word).digest()[:8])[0]
+
+
+def unit_hashes(words, unit='word'):
+    """Hash the n-gram units: one value per word, or one value (code point) per character"""
+    if unit == 'character':
+        text = u''.join(words)
+        return np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    return np.fromiter((word_hash(w) for w in words), dtype=np.uint64)
+
+
+def mix(values):
+    """splitmix64 finalizer, spreads the polynomial hash over all 64 bits"""
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return values ^ (values >> np.uint64(31))
+
+
+def iter_ngram_hashes(units, min_ngram=1, max_ngram=1):
+    """Yield, for each n in [min_ngram, max_ngram], an array of 64-bit hashes of all n-grams of `units`
+
+    The polynomial hash of every window is extended by one unit per n (h_n[i] = h_(n-1)[i] * BASE + u[i+n-1]),
+    so no n-gram string is ever built and only one order of n-grams is alive at a time.
+    """
+    units = np.asarray(units, dtype=np.uint64)
+    windows = units
+    for n in range(1, max_ngram + 1):
+        if n > 1:
+            windows = windows[:-1] * BASE + units[n - 1:]
+        if not len(windows):
+            return
+        if n >= min_ngram:
+            yield mix(windows ^ np.uint64(n * GOLDEN & MASK_64))
+
+
+def ngram_hashes(units, min_ngram=1, max_ngram=1):
+    chunks = list(iter_ngram_hashes(units, min_ngram, max_ngram))
+    if not chunks:
+        return np.empty(0, dtype=np.uint64)
+    return np.concatenate(chunks)
+
+
+def is_hashed(tokens):
+    return isinstance(tokens, np.ndarray)
+
+
+def token_set_sizes(tokens_1, tokens_2):
+    """Return (number of distinct tokens 1, number of distinct tokens 2, number of common distinct tokens)"""
+    if is_hashed(tokens_1) and is_hashed(tokens_2):
+        tokens_1 = np.unique(tokens_1)
+        tokens_2 = np.unique(tokens_2)
+        overlap = len(np.intersect1d(tokens_1, tokens_2, assume_unique=True))
+        return len(tokens_1), len(tokens_2), overlap
+
+    tokens_1 = set(tokens_1.tolist() if is_hashed(tokens_1) else tokens_1)
+    tokens_2 = set(tokens_2.tolist() if is_hashed(tokens_2) else tokens_2)
+    return len(tokens_1), len(tokens_2), len(tokens_1 & tokens_2)
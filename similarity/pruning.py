@@ -0,0 +1,56 @@
+import math
+
+import numpy as np
+
+from similarity.fuzzy import ratio_score
+
+
+def jaccard_bound(size_1, size_2):
+    """Highest jaccard similarity of two sets of these sizes"""
+    if not size_1 or not size_2:
+        return 0.0
+    return 100.0 * min(size_1, size_2) / max(size_1, size_2)
+
+
+def cosine_bound(size_1, size_2):
+    """Highest cosine similarity of two sets of these sizes"""
+    if not size_1 or not size_2:
+        return 0.0
+    return 100.0 * math.sqrt(float(min(size_1, size_2)) / max(size_1, size_2))
+
+
+def fuzzy_bound(length_1, length_2):
+    """Highest `fuzz.ratio` of two strings of these lengths"""
+    if not length_1 or not length_2:
+        return 0 if length_1 != length_2 else 100
+    return ratio_score(min(length_1, length_2), length_1 + length_2)
+
+
+def min_overlap(size, min_similarity, overlap_ratio):
+    """Number of distinct n-grams of a set of `size` a candidate shares at least to score `min_similarity`"""
+    # scores are rounded to 2 decimals
+    ratio = overlap_ratio(max(min_similarity - 0.005, 0) / 100.0)
+    return int(math.ceil(ratio * size - 1e-9))
+
+
+def prefix_filter(main_set, candidate_sets, overlap):
+    """Return indexes of the candidate sets which may share at least `overlap` n-grams with the main set
+
+    Such a candidate shares at least one of any `len(main_set) - overlap + 1` n-grams of the main set. The rarest
+    n-grams among the candidates are chosen, so most candidates share none of them and are skipped.
+    """
+    if overlap <= 0:
+        return range(len(candidate_sets))
+    prefix_size = len(main_set) - overlap + 1
+    if prefix_size <= 0 or not candidate_sets:
+        return []
+
+    all_tokens = np.concatenate(candidate_sets)
+    owners = np.repeat(np.arange(len(candidate_sets)), [len(s) for s in candidate_sets])
+    positions = np.minimum(np.searchsorted(main_set, all_tokens), len(main_set) - 1)
+    shared = main_set[positions] == all_tokens
+    # number of candidates containing each n-gram of the main set
+    frequencies = np.bincount(positions[shared], minlength=len(main_set))
+    prefix = np.zeros(len(main_set), dtype=bool)
+    prefix[np.argsort(frequencies, kind='mergesort')[:prefix_size]] = True
+    return np.unique(owners[shared & prefix[positions]]).tolist()
@@ -0,0 +1,78 @@
+from similarity.storage import content_digest
+from similarity_checker import PreparedDocument
+from util.utils import get_logger
+
+
+def hamming_distance(fingerprint_1, fingerprint_2):
+    return bin(fingerprint_1 ^ fingerprint_2).count('1')
+
+
+class SimhashIndex(object):
+    """Hamming distance index of the Simhash fingerprints of pages, answers all fingerprints within `k` bits
+
+    Fingerprints are split into `k + 1` blocks of bits. Two fingerprints differing by at most `k` bits have at
+    least one identical block, so each fingerprint is put in one bucket per block and only the fingerprints
+    sharing a bucket are compared, instead of scanning all of them.
+    """
+
+    def __init__(self, storage, k=3, unit='word', min_ngram=1, max_ngram=1, f=64):
+        self.logger = get_logger(self.__class__.__name__)
+        self.storage = storage
+        self.k = k
+        self.f = f
+        self.unit = unit
+        self.min_ngram = min_ngram
+        self.max_ngram = max_ngram
+        # (offset, mask) of each block, the first blocks take the remaining bits
+        self.blocks = []
+        offset = 0
+        for i in range(k + 1):
+            width = f // (k + 1) + (1 if i < f % (k + 1) else 0)
+            self.blocks.append((offset, (1 << width) - 1))
+            offset += width
+
+    def fingerprint(self, content):
+        return PreparedDocument(content, unit=self.unit, min_ngram=self.min_ngram, max_ngram=self.max_ngram) \
+            .simhash.value
+
+    def block_keys(self, fingerprint):
+        return ['%d:%x' % (i, (fingerprint >> offset) & mask) for i, (offset, mask) in enumerate(self.blocks)]
+
+    def add(self, url, content):
+        self.add_many({url: content})
+
+    def add_many(self, pages):
+        """Index {url: content} pages, the pages whose content did not change since they were indexed are skipped"""
+        urls = list(pages)
+        entries = []
+        for url, indexed_digest in zip(urls, self.storage.get_digests(urls)):
+            digest = content_digest(pages[url])
+            if digest == indexed_digest:
+                continue
+            fingerprint = self.fingerprint(pages[url])
+            entries.append((url, digest, self.block_keys(fingerprint), {'fingerprint': fingerprint}))
+        self.storage.set_entries(entries)
+        self.logger.debug('Indexed fingerprints of %d pages, %d unchanged' % (len(entries), len(urls) - len(entries)))
+
+    def add_fingerprint(self, url, fingerprint):
+        # without content, the page is indexed again when it is added with its content
+        self.storage.set_entries([(url, '%016x' % fingerprint, self.block_keys(fingerprint),
+                                   {'fingerprint': fingerprint})])
+
+    def query(self, fingerprint, k=None, exclude=()):
+        """Return [(url, hamming distance)] of the indexed pages within `k` bits (at most the index `k`)"""
+        k = self.k if k is None else min(k, self.k)
+        urls = [url for url in self.storage.get_members(self.block_keys(fingerprint)) if url not in exclude]
+        result = []
+        for url, record in zip(urls, self.storage.get_records(urls)):
+            if not record:
+                continue
+            distance = hamming_distance(fingerprint, record['fingerprint'])
+            if distance <= k:
+                result.append((url, distance))
+        result.sort(key=lambda x: x[1])
+        return result
+
+    def get_fingerprint(self, url):
+        record = self.storage.get_record(url)
+        return record['fingerprint'] if record else None
@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from collections import defaultdict
+
+from util.redis_client import get_redis
+from util.utils import get_logger
+
+# seconds the entries of the page indexes are kept after the page was last indexed
+INDEX_EXPIRE_TIME = int(os.environ.get('INDEX_EXPIRE_TIME', 604800))
+
+
+def content_digest(content):
+    """Digest of the content of an indexed page, a page whose digest did not change is not indexed again"""
+    return hashlib.sha1(content.encode('utf-8') if isinstance(content, unicode) else content).hexdigest()
+
+
+class MemoryIndexStorage(object):
+    """Buckets, records and digests of an index kept in memory, with a pickle snapshot on disk
+
+    The index is private to the process, so it only suits a single worker process. The snapshot is written by a
+    background thread every `snapshot_interval` seconds with changes, not by the requests adding pages. Entries
+    expire `expire_time` seconds after they were last set, the expired ones are purged while entries are set.
+    """
+
+    def __init__(self, snapshot_path=None, snapshot_interval=60, expire_time=INDEX_EXPIRE_TIME):
+        self.logger = get_logger(self.__class__.__name__)
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.expire_time = expire_time
+        # {bucket: {member: expire time}}, {key: (digest, record, expire time)}
+        self.buckets = defaultdict(dict)
+        self.records = {}
+        self._changes = 0
+        self._purge_at = 0
+        self._lock = threading.RLock()
+        self._snapshot_pid = None
+        self.load()
+
+    def get_digests(self, keys):
+        now = time.time()
+        with self._lock:
+            entries = [self.records.get(key) for key in keys]
+        return [entry[0] if entry and entry[2] > now else None for entry in entries]
+
+    def set_entries(self, entries):
+        """Set the (key, digest, buckets, record) entries, the key stays in the buckets of its previous entry until
+        they expire"""
+        if not entries:
+            return
+        now = time.time()
+        expire_at = now + self.expire_time
+        with self._lock:
+            for key, digest, buckets, record in entries:
+                for bucket in buckets:
+                    self.buckets[bucket][key] = expire_at
+                self.records[key] = (digest, record, expire_at)
+            self._changes += len(entries)
+            if now >= self._purge_at:
+                self._purge(now)
+        if self.snapshot_path and self._snapshot_pid != os.getpid():
+            self._start_snapshots()
+
+    def _purge(self, now):
+        for bucket, members in self.buckets.items():
+            for member, expire_at in members.items():
+                if expire_at <= now:
+                    del members[member]
+            if not members:
+                del self.buckets[bucket]
+        for key, entry in self.records.items():
+            if entry[2] <= now:
+                del self.records[key]
+        self._purge_at = now + min(self.expire_time, 600)
+
+    def get_members(self, buckets):
+        now = time.time()
+        result = set()
+        with self._lock:
+            for bucket in buckets:
+                result.update(member for member, expire_at in self.buckets.get(bucket, {}).items() if expire_at > now)
+        return result
+
+    def get_record(self, key):
+        return self.get_records([key])[0]
+
+    def get_records(self, keys):
+        now = time.time()
+        with self._lock:
+            entries = [self.records.get(key) for key in keys]
+        return [entry[1] if entry and entry[2] > now else None for entry in entries]
+
+    def _start_snapshots(self):
+        # started by the first change of the process, threads do not survive fork
+        with self._lock:
+            if self._snapshot_pid == os.getpid():
+                return
+            self._snapshot_pid = os.getpid()
+        thread = threading.Thread(target=self._save_periodically, name='index-snapshot')
+        thread.setDaemon(True)
+        thread.start()
+
+    def _save_periodically(self):
+        while True:
+            time.sleep(self.snapshot_interval)
+            if self._changes:
+                try:
+                    self.save()
+                except Exception as ex:
+                    self.logger.exception('Save index snapshot %s error: %s' % (self.snapshot_path, ex))
+
+    def save(self):
+        if not self.snapshot_path:
+            return
+        with self._lock:
+            # copy under the lock, pickle outside of it so the requests adding pages do not wait
+            buckets = {bucket: dict(members) for bucket, members in self.buckets.items()}
+            records = dict(self.records)
+            self._changes = 0
+        snapshot_dir = os.path.dirname(self.snapshot_path)
+        if snapshot_dir and not os.path.exists(snapshot_dir):
+            os.makedirs(snapshot_dir)
+        tmp_path = '%s.%d.tmp' % (self.snapshot_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((buckets, records), f, pickle.HIGHEST_PROTOCOL)
+        # atomic replace, readers never see a partial snapshot
+        os.rename(tmp_path, self.snapshot_path)
+        self.logger.debug('Saved index snapshot %s: %d records' % (self.snapshot_path, len(records)))
+
+    def load(self):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                buckets, records = pickle.load(f)
+            if any(not isinstance(entry, tuple) for entry in records.values()):
+                raise ValueError('snapshot of a previous format, the records kept the page contents')
+        except Exception as ex:
+            self.logger.exception('Load index snapshot %s error: %s' % (self.snapshot_path, ex))
+            return
+        with self._lock:
+            self.buckets = defaultdict(dict, buckets)
+            self.records = records
+        self.logger.info('Loaded index snapshot %s: %d records' % (self.snapshot_path, len(records)))
+
+
+class RedisIndexStorage(object):
+    """Buckets (redis sorted sets), records and digests (redis strings) of an index shared by all replicas
+
+    Entries expire `expire_time` seconds after they were last set: records and digests with their redis TTL, the
+    members of a bucket by their score, their expire time, and the expired ones are removed when the bucket is set.
+    """
+
+    def __init__(self, redis, prefix, expire_time=INDEX_EXPIRE_TIME):
+        self.redis = redis
+        self.prefix = prefix
+        self.expire_time = expire_time
+
+    def _bucket_key(self, bucket):
+        return '%s:bucket:%s' % (self.prefix, bucket)
+
+    def _record_key(self, key):
+        return '%s:record:%s' % (self.prefix, key)
+
+    def _digest_key(self, key):
+        return '%s:digest:%s' % (self.prefix, key)
+
+    def get_digests(self, keys):
+        if not keys:
+            return []
+        return self.redis.mget([self._digest_key(key) for key in keys])
+
+    def set_entries(self, entries):
+        """Set the (key, digest, buckets, record) entries in one round trip, the key stays in the buckets of its
+        previous entry until they expire"""
+        if not entries:
+            return
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        for key, digest, buckets, record in entries:
+            for bucket in buckets:
+                bucket_key = self._bucket_key(bucket)
+                pipe.zadd(bucket_key, now + self.expire_time, key)
+                pipe.zremrangebyscore(bucket_key, '-inf', now)
+                pipe.expire(bucket_key, self.expire_time)
+            pipe.set(self._record_key(key), json.dumps(record), ex=self.expire_time)
+            pipe.set(self._digest_key(key), digest, ex=self.expire_time)
+        pipe.execute()
+
+    def get_members(self, buckets):
+        buckets = list(buckets)
+        if not buckets:
+            return set()
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        for bucket in buckets:
+            pipe.zrangebyscore(self._bucket_key(bucket), now, '+inf')
+        return {m.decode('utf-8') for members in pipe.execute() for m in members}
+
+    def get_record(self, key):
+        return self.get_records([key])[0]
+
+    def get_records(self, keys):
+        if not keys:
+            return []
+        return [json.loads(r) if r else None for r in self.redis.mget([self._record_key(key) for key in keys])]
+
+    def save(self):
+        pass
+
+
+def get_index_storage(name):
+    """Storage of the index `name`: redis, shared by all worker processes and replicas, or memory with a snapshot in
+    INDEX_DIR when INDEX_STORAGE=memory, for a single worker process"""
+    if os.environ.get('INDEX_STORAGE', 'redis') == 'memory':
+        return MemoryIndexStorage(snapshot_path=os.path.join(os.environ.get('INDEX_DIR', 'data'), '%s.pickle' % name))
+
+    return RedisIndexStorage(get_redis(5), prefix=name)
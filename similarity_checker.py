@@ -1,5 +1,10 @@
+import heapq
 import math
-from fuzzywuzzy import fuzz
+import os
+from collections import namedtuple
+
+import numpy as np
+from fuzzywuzzy.utils import full_process
 from nltk.stem.porter import PorterStemmer
 
 from util.utils import get_logger
@@ -10,17 +15,40 @@ from nltk.tokenize.toktok import ToktokTokenizer
 from nltk.util import ngrams
 import string
 from simhash import Simhash
+from tornado import gen
+
+from similarity.bm25 import BM25Index
+from similarity.fuzzy import bounded_ratio
+from similarity.matrix import cosine_similarity_batch, jaccard_similarity_batch
+from similarity.pruning import cosine_bound, jaccard_bound, fuzzy_bound, min_overlap, prefix_filter
+from similarity.ngram import ngram_hashes, unit_hashes, token_set_sizes, is_hashed
+from util.cache import TieredCache
+from util.deadline import NO_DEADLINE, DeadlineExceeded
 
 
 tokenize = ToktokTokenizer().tokenize
 stemmer = PorterStemmer()
 
+# cache of tokenize results shared by all requests of the process, bounded by total number of tokens
+token_cache = TieredCache('tokens', max_size=int(os.environ.get('TOKEN_CACHE_SIZE', 1024)),
+                          max_cost=int(os.environ.get('TOKEN_CACHE_MAX_TOKENS', 5000000)))
+# same for hashed n-grams, stored as raw uint64 bytes in the Redis tier
+ngram_hash_cache = TieredCache('ngram-hashes', max_size=int(os.environ.get('TOKEN_CACHE_SIZE', 1024)),
+                               max_cost=int(os.environ.get('TOKEN_CACHE_MAX_TOKENS', 5000000)),
+                               dumps=lambda hashes: hashes.tostring(),
+                               loads=lambda value: np.frombuffer(value, dtype=np.uint64))
+
 
 def pre_process_urls(urls):
     return [url.strip() for url in urls]
 
 
-def tokenize_and_normalize_content(content, unit='word', min_ngram=1, max_ngram=1):
+def tokenize_and_normalize_content(content, unit='word', min_ngram=1, max_ngram=1, hashed=False):
+    """Tokenize content into n-grams
+
+    When `hashed` is True, return a read-only numpy array of 64-bit n-gram hashes instead of the n-gram strings,
+    `cosine_similarity` and `jaccard_similarity` accept both.
+    """
     # pre check condition
     if max_ngram < 1:
         max_ngram = 1
@@ -36,15 +64,29 @@ def tokenize_and_normalize_content(content, unit='word', min_ngram=1, max_ngram=
     if type(content) is not unicode:
         content = unicode(content, 'utf-8', errors='ignore')
 
+    if hashed:
+        key = ngram_hash_cache.make_key(content, unit, min_ngram, max_ngram)
+        result = ngram_hash_cache.get(key)
+        if result is None:
+            result = ngram_hashes(unit_hashes(iter_normalized_words(content), unit), min_ngram, max_ngram)
+            result.flags.writeable = False
+            ngram_hash_cache.set(key, result)
+        return result
+
+    key = token_cache.make_key(content, unit, min_ngram, max_ngram)
+    result = token_cache.get(key)
+    if result is None:
+        result = tuple(_tokenize_and_normalize_content(content, unit, min_ngram, max_ngram))
+        token_cache.set(key, result)
+
+    return list(result)
+
+
+def _tokenize_and_normalize_content(content, unit, min_ngram, max_ngram):
     result = []
 
     # pre tokenize
-    words = []
-    for word in tokenize(content):
-        word = normalize(word)
-        if not word:
-            continue
-        words.append(word)
+    words = list(iter_normalized_words(content))
 
     # generate ngram
     if unit == 'character':
@@ -61,18 +103,111 @@ def tokenize_and_normalize_content(content, unit='word', min_ngram=1, max_ngram=
     return result
 
 
+def iter_normalized_words(content):
+    for word in tokenize(content):
+        word = normalize(word)
+        if word:
+            yield word
+
+
 def normalize(word):
     return stemmer.stem(word.strip(string.punctuation).lower())
 
 
+class PreparedDocument(object):
+    """Content prepared once for all similarity functions
+
+    The n-grams and every representation built from them (set of hashes, norm, Simhash fingerprint, sorted
+    n-gram text) are computed on first use only, so comparing a document with many others or with many
+    similarity functions prepares it once.
+    """
+
+    def __init__(self, content, unit='word', min_ngram=1, max_ngram=1):
+        self.content = content
+        self.unit = unit
+        self.min_ngram = min_ngram
+        self.max_ngram = max_ngram
+        self._tokens = None
+        self._hashes = None
+        self._token_set = None
+        self._simhash = None
+        self._sorted_text = None
+
+    @property
+    def tokens(self):
+        """N-gram strings"""
+        if self._tokens is None:
+            self._tokens = tokenize_and_normalize_content(self.content, unit=self.unit, min_ngram=self.min_ngram,
+                                                          max_ngram=self.max_ngram)
+        return self._tokens
+
+    @property
+    def hashes(self):
+        """N-gram hashes"""
+        if self._hashes is None:
+            self._hashes = tokenize_and_normalize_content(self.content, unit=self.unit, min_ngram=self.min_ngram,
+                                                          max_ngram=self.max_ngram, hashed=True)
+        return self._hashes
+
+    @property
+    def token_set(self):
+        """Sorted distinct n-gram hashes"""
+        if self._token_set is None:
+            self._token_set = np.unique(self.hashes)
+        return self._token_set
+
+    @property
+    def norm(self):
+        return math.sqrt(len(self.token_set))
+
+    @property
+    def simhash(self):
+        if self._simhash is None:
+            self._simhash = Simhash(self.tokens)
+        return self._simhash
+
+    @property
+    def sorted_text(self):
+        if self._sorted_text is None:
+            self._sorted_text = sorted_token_text(self.tokens)
+        return self._sorted_text
+
+    def overlap(self, other):
+        """Number of distinct n-grams shared with `other`"""
+        return len(np.intersect1d(self.token_set, other.token_set, assume_unique=True))
+
+
+def prepare_documents(contents, unit='word', min_ngram=1, max_ngram=1):
+    return [PreparedDocument(content, unit=unit, min_ngram=min_ngram, max_ngram=max_ngram) for content in contents]
+
+
+def is_prepared(tokens):
+    return isinstance(tokens, PreparedDocument)
+
+
+def as_hashes(tokens):
+    return tokens.hashes if is_prepared(tokens) else tokens
+
+
+def set_sizes(tokens_1, tokens_2):
+    """`token_set_sizes` of n-grams or prepared documents"""
+    if is_prepared(tokens_1) and is_prepared(tokens_2):
+        return len(tokens_1.token_set), len(tokens_2.token_set), tokens_1.overlap(tokens_2)
+    if is_prepared(tokens_1):
+        tokens_1 = tokens_1.hashes if is_hashed(tokens_2) else tokens_1.tokens
+    if is_prepared(tokens_2):
+        tokens_2 = tokens_2.hashes if is_hashed(tokens_1) else tokens_2.tokens
+    return token_set_sizes(tokens_1, tokens_2)
+
+
+def sorted_token_text(tokens):
+    """N-grams as compared by `fuzz.token_sort_ratio`: processed, sorted and joined"""
+    return u' '.join(sorted(full_process(u' '.join(tokens), force_ascii=True).split())).strip()
+
+
 def cosine_similarity(tokens_1, tokens_2):
-    vec_1 = {w: 1 for w in tokens_1}
-    vec_2 = {w: 1 for w in tokens_2}
-    intersection = set(vec_1.keys()) & set(vec_2.keys())
-    numerator = sum([vec_1[x] * vec_2[x] for x in intersection])
-    sum_1 = sum([vec_1[x]**2 for x in vec_1.keys()])
-    sum_2 = sum([vec_2[x]**2 for x in vec_2.keys()])
-    denominator = math.sqrt(sum_1) * math.sqrt(sum_2)
+    size_1, size_2, numerator = set_sizes(tokens_1, tokens_2)
+    denominator = math.sqrt(size_1) * math.sqrt(size_2)
 
     if not denominator:
         return 0.0
@@ -81,154 +216,331 @@ def cosine_similarity(tokens_1, tokens_2):
 
 
 def jaccard_similarity(tokens_1, tokens_2):
-    tokens_1 = set(tokens_1)
-    tokens_2 = set(tokens_2)
-    union = len(tokens_1 | tokens_2)
+    size_1, size_2, intersection = set_sizes(tokens_1, tokens_2)
+    union = size_1 + size_2 - intersection
     if not union:
         return 0.0
 
-    return round(float(len(tokens_1 & tokens_2)) / union * 100, 2)
+    return round(float(intersection) / union * 100, 2)
 
 
-def fuzzy_similarity(tokens_1, tokens_2):
-    return fuzz.token_sort_ratio(' '.join(tokens_1), ' '.join(tokens_2))
+def fuzzy_similarity(tokens_1, tokens_2, min_score=0):
+    """`fuzz.token_sort_ratio` of the joined n-grams, 0 when it is lower than `min_score`"""
+    text_1 = tokens_1.sorted_text if is_prepared(tokens_1) else sorted_token_text(tokens_1)
+    text_2 = tokens_2.sorted_text if is_prepared(tokens_2) else sorted_token_text(tokens_2)
+    return bounded_ratio(text_1, text_2, min_score)
 
 
 def simhash_similarity(tokens_1, tokens_2):
-    if not tokens_1 or not tokens_2:
+    if not (tokens_1.tokens if is_prepared(tokens_1) else tokens_1) or \
+            not (tokens_2.tokens if is_prepared(tokens_2) else tokens_2):
         return 0
-    return 100 - Simhash(tokens_1).distance(Simhash(tokens_2))
+    simhash_1 = tokens_1.simhash if is_prepared(tokens_1) else Simhash(tokens_1)
+    simhash_2 = tokens_2.simhash if is_prepared(tokens_2) else Simhash(tokens_2)
+    return 100 - simhash_1.distance(simhash_2)
+
+
+# similarity functions which can score one main page against many pages in a single sparse product
+batch_similarities = {
+    cosine_similarity: cosine_similarity_batch,
+    jaccard_similarity: jaccard_similarity_batch,
+}
+
+# similarity functions which take a minimum score, and skip the exact computation of the lower ones
+bounded_similarities = {fuzzy_similarity}
+
+# (size of a prepared document, highest similarity of two documents of these sizes) of each similarity function
+similarity_bounds = {
+    cosine_similarity: (lambda doc: len(doc.token_set), cosine_bound),
+    jaccard_similarity: (lambda doc: len(doc.token_set), jaccard_bound),
+    fuzzy_similarity: (lambda doc: len(doc.sorted_text), fuzzy_bound),
+}
+
+# share of the main document n-grams a candidate needs to score at least a similarity (0..1)
+overlap_ratios = {
+    cosine_similarity: lambda similarity: similarity * similarity,
+    jaccard_similarity: lambda similarity: similarity,
+}
+
+
+# options of a similarity check, immutable so a checker can be shared by concurrent requests
+CheckConfig = namedtuple('CheckConfig', ['similarity', 'unit', 'min_ngram', 'max_ngram', 'min_similarity', 'top_k',
+                                         'batch', 'main_page_selector', 'sub_page_selector', 'url_1_selector',
+                                         'url_2_selector', 'url_3_selector'])
 
 
 class SimilarityChecker(object):
-    def __init__(self, content_getter, similarity, unit='word', min_ngram=1, max_ngram=1, main_page_selector=None,
-                 sub_page_selector=None, url_1_selector=None, url_2_selector=None, url_3_selector=None):
-        self.similarity = similarity
+    """Checks the similarity of pages with the options of its `config`
+
+    The checker keeps no state between calls: the options are read from the immutable `config` and the selectors are
+    passed to the content getter with each call, so requests can run concurrently.
+    """
+
+    def __init__(self, content_getter, similarity=None, unit='word', min_ngram=1, max_ngram=1,
+                 main_page_selector=None, sub_page_selector=None, url_1_selector=None, url_2_selector=None,
+                 url_3_selector=None, batch=True, min_similarity=0, top_k=None, config=None):
         self.content_getter = content_getter
-        self.main_page_selector = main_page_selector
-        self.sub_page_selector = sub_page_selector
-        self.url_1_selector = url_1_selector
-        self.url_2_selector = url_2_selector
-        self.url_3_selector = url_3_selector
-        self.unit = unit
-        self.min_ngram = min_ngram
-        self.max_ngram = max_ngram
+        self.config = config or CheckConfig(similarity=similarity or cosine_similarity, unit=unit,
+                                            min_ngram=min_ngram, max_ngram=max_ngram, min_similarity=min_similarity,
+                                            top_k=top_k, batch=batch, main_page_selector=main_page_selector,
+                                            sub_page_selector=sub_page_selector, url_1_selector=url_1_selector,
+                                            url_2_selector=url_2_selector, url_3_selector=url_3_selector)
         self.logger = get_logger(self.__class__.__name__)
 
     def process(self, main_url, sub_urls):
-        result = []
-        # pre process urls
-        sub_urls = pre_process_urls(sub_urls)
-        main_url = pre_process_urls([main_url])[0]
-        # crawl and extract page content
-        pages = {}
-        whole_content_urls = []
-        if self.main_page_selector:
-            self.content_getter.extractor.selector = self.main_page_selector
-            pages.update(self.content_getter.process([main_url]))
-        else:
-            whole_content_urls.append(main_url)
-
-        if self.sub_page_selector:
-            self.content_getter.extractor.selector = self.sub_page_selector
-            pages.update(self.content_getter.process(sub_urls))
-        else:
-            whole_content_urls.extend(sub_urls)
-
-        if whole_content_urls:
-            pages = self.content_getter.process(whole_content_urls)
-
+        main_url, sub_urls = pre_process_urls([main_url])[0], pre_process_urls(sub_urls)
+        # crawl every url once, then extract it with the selector of its group
+        main_pages, sub_pages = self.content_getter.process_groups(self._check_groups(main_url, sub_urls))
+        return self.check_pages(main_pages[main_url], sub_urls, sub_pages)
+
+    @gen.coroutine
+    def process_async(self, main_url, sub_urls, executor):
+        """Coroutine version of `process`, pages are fetched on the IOLoop and scored on `executor`"""
+        main_url, sub_urls = pre_process_urls([main_url])[0], pre_process_urls(sub_urls)
+        main_pages, sub_pages = yield self.content_getter.process_groups_async(self._check_groups(main_url, sub_urls),
+                                                                               executor)
+        result = yield executor.submit(self.check_pages, main_pages[main_url], sub_urls, sub_pages)
+        raise gen.Return(result)
+
+    def _check_groups(self, main_url, sub_urls):
+        """(urls, selector) groups of the main page and the sub pages"""
+        return [([main_url], self.config.main_page_selector), (sub_urls, self.config.sub_page_selector)]
+
+    def _cross_check_groups(self, url_1, url_2, url_3):
+        return [([url_1], self.config.url_1_selector), ([url_2], self.config.url_2_selector),
+                ([url_3], self.config.url_3_selector)]
+
+    def check_pages(self, main_page, sub_urls, pages):
+        """`process` result of the fetched main page and sub pages, an error message when the main page timed out"""
         # verify main page
-        main_page = pages[main_url]['content']
-        if not main_page:
+        if main_page.get('timed_out'):
+            return 'Main page timed out'
+        if not main_page['content']:
             result = []
             return result
-        # tokenize content into words
+        # prepare content of each page once, it is tokenized on first use
+        main_doc = self.prepare(main_page['content'])
         for url, page in pages.items():
-            page['content'] = tokenize_and_normalize_content(page['content'], unit=self.unit,
-                                                             min_ngram=self.min_ngram, max_ngram=self.max_ngram)
+            page['content'] = self.prepare(page['content'])
 
-        # check similarity
-        main_tokens = pages[main_url]['content']
-        for url, page in pages.items():
-            if url not in sub_urls:
-                continue
-            sub_tokens = page['content']
+        return self.check(main_doc, sub_urls, pages)
+
+    def prepare(self, content):
+        return PreparedDocument(content, unit=self.config.unit, min_ngram=self.config.min_ngram,
+                                max_ngram=self.config.max_ngram)
+
+    def check(self, main_doc, sub_urls, pages):
+        """[[sub url, similarity or error]] of the prepared main document and pages, the most similar first"""
+        result = []
+        sub_url_set = set(sub_urls)
+        scored_urls = []
+        for url in sub_url_set:
+            page = pages[url]
             if page.get('error'):
-                result.append([url, 'Page not found'])
+                result.append([url, 'Timed out' if page.get('timed_out') else 'Page not found'])
                 continue
+            scored_urls.append(url)
 
-            sim = self.similarity(main_tokens, sub_tokens)
-            result.append([url, sim])
+        try:
+            ranked = self.rank(main_doc, [pages[url]['content'] for url in scored_urls], self.config.min_similarity,
+                               self.config.top_k, getattr(self.content_getter, 'deadline', NO_DEADLINE))
+            result.extend([scored_urls[i], sim] for i, sim in ranked)
+        except DeadlineExceeded as ex:
+            # the scores of a part of the pages are not the ranking of the request, none is returned
+            self.logger.info('%s, %d sub urls not scored' % (ex, len(scored_urls)))
+            result.extend([url, 'Timed out'] for url in scored_urls)
 
         # sort result
         result.sort(key=lambda x: x[1], reverse=True)
         self.logger.debug('Similarity result: %s' % result)
         return result
 
-    def cross_process(self, url_1, url_2, url_3):
-        result = {}
-        # pre process urls
-        url_1 = pre_process_urls([url_1])[0]
-        url_2 = pre_process_urls([url_2])[0]
-        url_3 = pre_process_urls([url_3])[0]
-        # crawl and extract page content
-        pages = {}
-        whole_content_urls = []
-        if self.url_1_selector:
-            self.content_getter.extractor.selector = self.url_1_selector
-            pages.update(self.content_getter.process([url_1]))
-        else:
-            whole_content_urls.append(url_1)
-
-        if self.url_2_selector:
-            self.content_getter.extractor.selector = self.url_2_selector
-            pages.update(self.content_getter.process([url_2]))
-        else:
-            whole_content_urls.append(url_2)
+    def batch_process(self, groups, fetch_size=200):
+        """Check many (main url, sub urls) groups, yield (group index, result) as each group is scored
+
+        Each url is crawled, extracted and tokenized once for all the groups it belongs to. Groups are fetched in
+        waves of about `fetch_size` new urls, so the first results are ready before all pages are crawled, and a
+        page is released once the last group using it is scored. The result is the `process` result, or an error
+        message when the main page timed out or is empty.
+        """
+        groups = [(pre_process_urls([main_url])[0], pre_process_urls(sub_urls)) for main_url, sub_urls in groups]
+        # number of groups not scored yet using each url
+        references = {}
+        for main_url, sub_urls in groups:
+            for url in set([main_url] + sub_urls):
+                references[url] = references.get(url, 0) + 1
 
-        if self.url_3_selector:
-            self.content_getter.extractor.selector = self.url_3_selector
-            pages.update(self.content_getter.process([url_3]))
-        else:
-            whole_content_urls.append(url_3)
+        pages = {}
+        start = 0
+        while start < len(groups):
+            # next wave of groups
+            end = start
+            new_urls = []
+            seen = set()
+            while end < len(groups) and (not new_urls or len(new_urls) < fetch_size):
+                main_url, sub_urls = groups[end]
+                for url in [main_url] + sub_urls:
+                    if url not in pages and url not in seen:
+                        seen.add(url)
+                        new_urls.append(url)
+                end += 1
+
+            if new_urls:
+                for url, page in self.content_getter.process(new_urls).items():
+                    page['content'] = self.prepare(page['content'])
+                    pages[url] = page
+                self.logger.debug('Fetched %d urls for groups %d to %d' % (len(new_urls), start, end - 1))
+
+            for index in range(start, end):
+                main_url, sub_urls = groups[index]
+                if pages[main_url].get('timed_out'):
+                    yield index, 'Main page timed out'
+                elif pages[main_url].get('error') or not pages[main_url]['content'].content:
+                    yield index, 'Main page is empty'
+                else:
+                    yield index, self.check(pages[main_url]['content'], sub_urls, pages)
+                for url in set([main_url] + sub_urls):
+                    references[url] -= 1
+                    if not references[url]:
+                        del pages[url]
+            start = end
+
+    def score(self, main_doc, sub_docs, min_score=0):
+        """Similarities of the main document against each sub document, n-grams or prepared documents"""
+        batch_similarity = batch_similarities.get(self.config.similarity) if self.config.batch else None
+        if batch_similarity and len(sub_docs) > 1:
+            if is_prepared(main_doc) and all(is_prepared(doc) for doc in sub_docs):
+                return batch_similarity(main_doc.token_set, [doc.token_set for doc in sub_docs], sets=True)
+            return batch_similarity(as_hashes(main_doc), [as_hashes(doc) for doc in sub_docs])
+        if min_score and self.config.similarity in bounded_similarities:
+            return [self.config.similarity(main_doc, sub_doc, min_score) for sub_doc in sub_docs]
+        return [self.config.similarity(main_doc, sub_doc) for sub_doc in sub_docs]
+
+    def rank(self, main_doc, sub_docs, min_similarity=0, top_k=None, deadline=NO_DEADLINE, chunk_size=256):
+        """Return [(index, similarity)] of the prepared sub documents scoring at least `min_similarity`
+
+        Only the `top_k` best are returned when it is set. Sub documents whose size bound can not reach the minimum
+        similarity (or the k-th best similarity so far) are not scored. `deadline` is checked while the documents are
+        tokenized and between the scored chunks, `DeadlineExceeded` is raised once it is over.
+        """
+        indexes = range(len(sub_docs))
+        bounds = None
+        if self.config.similarity in similarity_bounds:
+            size, bound = similarity_bounds[self.config.similarity]
+            deadline.check('tokenizing')
+            main_size = size(main_doc)
+            bounds = []
+            for doc in sub_docs:
+                # the size of a prepared document tokenizes it
+                deadline.check('tokenizing')
+                bounds.append(bound(main_size, size(doc)))
+            # scores are rounded to 2 decimals
+            indexes = [i for i in indexes if bounds[i] >= min_similarity - 0.005]
+        pairwise = not (self.config.batch and self.config.similarity in batch_similarities)
+        if min_similarity and indexes and pairwise and self.config.similarity in overlap_ratios:
+            overlap = min_overlap(len(main_doc.token_set), min_similarity, overlap_ratios[self.config.similarity])
+            # the filter costs about one vectorized exact scoring, so it only pays off for pairwise scoring with a
+            # short prefix (less than half of the main document n-grams)
+            if overlap * 2 > len(main_doc.token_set):
+                indexes = [indexes[i] for i in prefix_filter(main_doc.token_set,
+                                                             [sub_docs[i].token_set for i in indexes], overlap)]
+
+        if not top_k:
+            result = []
+            for start in range(0, len(indexes), chunk_size):
+                deadline.check('scoring')
+                chunk = indexes[start:start + chunk_size]
+                result.extend((i, sim) for i, sim in zip(chunk, self.score(main_doc, [sub_docs[i] for i in chunk],
+                                                                           min_similarity)) if sim >= min_similarity)
+            return result
 
-        if whole_content_urls:
-            pages = self.content_getter.process(whole_content_urls)
+        if bounds:
+            # best candidates first, so the k-th best similarity rises quickly and prunes the others
+            indexes.sort(key=lambda i: bounds[i], reverse=True)
+        if pairwise:
+            chunk_size = 1
+        heap = []
+        for start in range(0, len(indexes), chunk_size):
+            deadline.check('scoring')
+            chunk = indexes[start:start + chunk_size]
+            threshold = max(min_similarity, heap[0][0] if len(heap) == top_k else 0)
+            if bounds and bounds[chunk[0]] < threshold - 0.005:
+                break
+            for i, sim in zip(chunk, self.score(main_doc, [sub_docs[i] for i in chunk], threshold)):
+                if sim < min_similarity:
+                    continue
+                if len(heap) < top_k:
+                    heapq.heappush(heap, (sim, -i))
+                elif (sim, -i) > heap[0]:
+                    heapq.heapreplace(heap, (sim, -i))
+        return [(-i, sim) for sim, i in sorted(heap, reverse=True)]
 
-        # tokenize content into words
-        for url, page in pages.items():
-            page['content'] = tokenize_and_normalize_content(page['content'], unit=self.unit,
-                                                             min_ngram=self.min_ngram, max_ngram=self.max_ngram)
+    def cross_process(self, url_1, url_2, url_3):
+        # pre process urls
+        url_1, url_2, url_3 = pre_process_urls([url_1, url_2, url_3])
+        # crawl every url once, then extract it with its own selector
+        groups = self.content_getter.process_groups(self._cross_check_groups(url_1, url_2, url_3))
+        return self.cross_check_pages([url_1, url_2, url_3], groups)
+
+    @gen.coroutine
+    def cross_process_async(self, url_1, url_2, url_3, executor):
+        """Coroutine version of `cross_process`, pages are fetched on the IOLoop and scored on `executor`"""
+        url_1, url_2, url_3 = pre_process_urls([url_1, url_2, url_3])
+        groups = yield self.content_getter.process_groups_async(self._cross_check_groups(url_1, url_2, url_3),
+                                                                executor)
+        result = yield executor.submit(self.cross_check_pages, [url_1, url_2, url_3], groups)
+        raise gen.Return(result)
+
+    def cross_check_pages(self, urls, groups):
+        """`cross_process` result of the 3 urls and their fetched groups of pages"""
+        result = {}
+        pages = [group[url] for group, url in zip(groups, urls)]
+        # prepare content of each page once, it is tokenized on first use
+        for page in pages:
+            page['content'] = self.prepare(page['content'])
 
         # check similarity
         result.update({
-            'sim12': cal_sim(pages, url_1, url_2, self.similarity),
-            'sim23': cal_sim(pages, url_2, url_3, self.similarity),
-            'sim13': cal_sim(pages, url_1, url_3, self.similarity),
+            'sim12': cal_sim(pages[0], pages[1], urls[0], urls[1], self.config.similarity),
+            'sim23': cal_sim(pages[1], pages[2], urls[1], urls[2], self.config.similarity),
+            'sim13': cal_sim(pages[0], pages[2], urls[0], urls[2], self.config.similarity),
         })
         self.logger.debug('Similarity result: %s' % result)
         return result
 
 
-def cal_sim(pages, url_1, url_2, sim_func):
-    page_1 = pages[url_1]
-    page_2 = pages[url_2]
-    if page_1.get('error'):
-        return 'Page not found: %s' % url_1
-    if page_2.get('error'):
-        return 'Page not found: %s' % url_2
+def cal_sim(page_1, page_2, url_1, url_2, sim_func):
+    for url, page in ((url_1, page_1), (url_2, page_2)):
+        if page.get('error'):
+            return '%s: %s' % ('Timed out' if page.get('timed_out') else 'Page not found', url)
     return sim_func(page_1['content'], page_2['content'])
 
 
 class CosineSimilarity(object):
-    def __init__(self, content_getter, es_client):
+    """Scores sub pages with the relevance score of the main page content as query, normalized by the best score
+
+    `backend` is 'elasticsearch' (a temporary index per request, scored with the default similarity of the cluster,
+    default) or 'bm25' (in-process BM25 index, opt-in with COSINE_SIMILARITY_BACKEND=bm25, its scores differ from the
+    ones of an elasticsearch 2 cluster).
+    """
+    backends = ['bm25', 'elasticsearch']
+
+    def __init__(self, content_getter, es_client=None, backend=None):
         self.content_getter = content_getter
         self.es_client = es_client
+        self.backend = backend or os.environ.get('COSINE_SIMILARITY_BACKEND', 'elasticsearch')
+        if self.backend not in self.backends:
+            raise ValueError('Unknown backend %s, expect one of %s' % (self.backend, self.backends))
         self.logger = get_logger(self.__class__.__name__)
         self.index_name = 'web'
         self.doc_type = 'page'
 
+    # mapping of the page content in the elasticsearch index, scored with the default similarity of the cluster
+    content_mapping = {
+        'type': 'string',
+        'analyzer': 'standard'
+    }
+
     def create_index(self):
         # create new index
         self.index_name = str(uuid.uuid1())
@@ -241,10 +553,7 @@ class CosineSimilarity(object):
             'mappings': {
                 self.doc_type: {
                     'properties': {
-                        'content': {
-                            'type': 'string',
-                            'analyzer': 'standard'
-                        },
+                        'content': self.content_mapping,
                         'url': {
                             'type': 'string',
                             'index': 'not_analyzed'
@@ -292,15 +601,18 @@ class CosineSimilarity(object):
         # crawl and extract page content
         pages = self.content_getter.process(urls)
         # check similarity
-        try:
-            self.create_index()
-            self.index_pages(pages)
-            result = self.similarity(pages[main_url]['content'], sub_urls)
-            self.delete_index()
-        except Exception as ex:
-            tb = traceback.format_exc()
-            self.logger.error('Elasticsearch error (%s): %s' % (ex, tb))
-            self.delete_index()
+        if self.backend == 'bm25':
+            result = self.bm25_similarity(pages, main_url, sub_urls)
+        else:
+            try:
+                self.create_index()
+                self.index_pages(pages)
+                result = self.similarity(pages[main_url]['content'], sub_urls)
+                self.delete_index()
+            except Exception as ex:
+                tb = traceback.format_exc()
+                self.logger.error('Elasticsearch error (%s): %s' % (ex, tb))
+                self.delete_index()
 
         # append error page
         del pages[main_url]
@@ -343,3 +655,25 @@ class CosineSimilarity(object):
 
         self.logger.debug('Similarity info: %s' % result)
         return result
+
+    def bm25_similarity(self, pages, main_url, sub_urls):
+        """Same scores as `similarity`, from an in-process index of the pages instead of Elasticsearch"""
+        index = BM25Index()
+        for url, page in pages.items():
+            if not page['content'] or page['error']:
+                # ignore empty page or error page
+                continue
+            index.add(url, page['content'])
+
+        result = []
+        hits = index.search(pages[main_url]['content'] or '')
+        if not hits or not hits[0][1]:
+            return result
+        max_score = hits[0][1]
+        sub_urls = set(sub_urls)
+        for url, score in hits:
+            if url in sub_urls:
+                result.append([url, round(score / max_score * 100, 2)])
+
+        self.logger.debug('Similarity info: %s' % result)
+        return result
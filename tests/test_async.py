@@ -0,0 +1,198 @@
+import json
+import threading
+import time
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, jsonify
+from tornado import gen
+from tornado.testing import AsyncTestCase, AsyncHTTPTestCase, gen_test
+from tornado.web import Application, RequestHandler
+
+from parser.content_getter import ContentGetter
+from parser.crawler_cluster import PageCrawlerCluster
+from similarity_checker import SimilarityChecker
+from util.singleflight import SingleFlight
+from util.wsgi import WSGIResource
+
+
+class AsyncCrawler(object):
+
+    def __init__(self, contents):
+        self.contents = contents
+        self.crawled = []
+
+    def settings(self):
+        return 'async',
+
+    def process(self, urls, timeout=None):
+        self.crawled.extend(urls)
+        return {url: {'content': self.contents.get(url, ''), 'ok': True, 'error': False} for url in urls}
+
+    @gen.coroutine
+    def process_async(self, urls, timeout=None):
+        self.crawled.extend(urls)
+        yield gen.sleep(0.1)
+        raise gen.Return({url: {'content': self.contents.get(url, ''), 'ok': True, 'error': False} for url in urls})
+
+
+class ThreadExtractor(object):
+    name = 'thread'
+
+    def __init__(self):
+        self.threads = []
+
+    def settings(self, selector=None):
+        return self.name,
+
+    def process(self, pages, selector=None, timeout=None):
+        self.threads.append(threading.current_thread().name)
+        return pages
+
+
+class AsyncTestCaseBase(AsyncTestCase):
+
+    def setUp(self):
+        super(AsyncTestCaseBase, self).setUp()
+        self.executor = ThreadPoolExecutor(2)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        super(AsyncTestCaseBase, self).tearDown()
+
+
+class SingleFlightAsyncTestCase(AsyncTestCaseBase):
+
+    @gen_test
+    def test_concurrent_calls_are_coalesced(self):
+        flight = SingleFlight('test-async')
+        calls = []
+
+        @gen.coroutine
+        def slow_square(keys):
+            calls.append(sorted(keys))
+            yield gen.sleep(0.1)
+            raise gen.Return({key: key * key for key in keys})
+
+        # a thread is working on key 3
+        thread_result = self.executor.submit(flight.do_many, [3], lambda keys: time.sleep(0.2) or {3: 9})
+        yield gen.sleep(0.05)
+        results = yield [flight.do_many_async([1, 2], slow_square), flight.do_many_async([2, 3], slow_square)]
+        self.assertEqual([{1: 1, 2: 4}, {2: 4, 3: 9}], results)
+        self.assertEqual([[1, 2]], calls)
+        self.assertEqual({3: 9}, thread_result.result())
+        self.assertEqual({}, flight._calls)
+
+
+class ContentGetterAsyncTestCase(AsyncTestCaseBase):
+
+    @gen_test
+    def test_pages_are_extracted_on_the_executor(self):
+        crawler = AsyncCrawler({'http://example.com/1': u'one', 'http://example.com/2': u'two'})
+        extractor = ThreadExtractor()
+        content_getter = ContentGetter(crawler, extractor)
+        urls = ['http://example.com/1', 'http://example.com/2']
+        results = yield [content_getter.process_async(urls, self.executor) for _ in range(4)]
+        # one crawl and extraction for the concurrent calls
+        self.assertEqual(sorted(urls), sorted(crawler.crawled))
+        self.assertEqual(1, len(extractor.threads))
+        self.assertNotEqual(threading.current_thread().name, extractor.threads[0])
+        for result in results:
+            self.assertEqual(u'two', result['http://example.com/2']['content'])
+        self.assertIsNot(results[0]['http://example.com/1'], results[1]['http://example.com/1'])
+
+    @gen_test
+    def test_same_result_as_process(self):
+        contents = {'http://main': u'the cat sat on the mat', 'http://1': u'the cat sat on a mat',
+                    'http://2': u'a dog ran in the park', 'http://3': u''}
+        checker = SimilarityChecker(ContentGetter(AsyncCrawler(contents), ThreadExtractor()))
+        sub_urls = ['http://1', 'http://2', 'http://3']
+        result = yield checker.process_async('http://main', sub_urls, self.executor)
+        self.assertEqual(checker.process('http://main', sub_urls), result)
+        result = yield checker.cross_process_async('http://main', 'http://1', 'http://2', self.executor)
+        self.assertEqual(checker.cross_process('http://main', 'http://1', 'http://2'), result)
+
+
+class RenderHandler(RequestHandler):
+
+    @gen.coroutine
+    def get(self):
+        yield gen.sleep(0.2)
+        url = self.get_argument('url')
+        if url.endswith('/timeout'):
+            self.write({'html': '', 'pageTimeoutFlag': True})
+        else:
+            self.write({'html': '<p>%s</p>' % url, 'pageTimeoutFlag': False})
+
+
+class CrawlerAsyncTestCase(AsyncHTTPTestCase):
+
+    def get_app(self):
+        return Application([(r'/execute', RenderHandler)])
+
+    @gen_test
+    def test_renders_are_in_flight_together(self):
+        crawler = PageCrawlerCluster()
+        crawler.cluster = self.get_url('/execute')
+        urls = ['http://example.com/%d' % i for i in range(100)] + ['http://example.com/timeout']
+        start = time.time()
+        pages = yield crawler.process_async(urls)
+        # 101 renders of 0.2 seconds, without a thread each
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(set(urls), set(pages))
+        self.assertEqual('<p>http://example.com/7</p>', pages['http://example.com/7']['content'])
+        self.assertTrue(pages['http://example.com/7']['ok'])
+        self.assertEqual('Crawling error: pageTimeoutFlag=true', pages['http://example.com/timeout']['error'])
+        self.assertFalse(pages['http://example.com/timeout']['ok'])
+
+
+flask_app = Flask(__name__)
+
+
+@flask_app.route('/json')
+def json_resource():
+    time.sleep(0.2)
+    return jsonify({'error': False})
+
+
+@flask_app.route('/stream')
+def stream_resource():
+    return Response(('%d\n' % i for i in range(3)), mimetype='application/x-ndjson')
+
+
+class WSGIResourceTestCase(AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(4)
+        super(WSGIResourceTestCase, self).setUp()
+
+    def tearDown(self):
+        super(WSGIResourceTestCase, self).tearDown()
+        self.executor.shutdown()
+
+    def get_app(self):
+        return Application([(r'.*', WSGIResource, dict(wsgi_application=flask_app, executor=self.executor))])
+
+    @gen_test
+    def test_requests_run_concurrently(self):
+        start = time.time()
+        responses = yield [self.http_client.fetch(self.get_url('/json')) for _ in range(4)]
+        self.assertLess(time.time() - start, 0.6)
+        for response in responses:
+            self.assertEqual({'error': False}, json.loads(response.body))
+            self.assertEqual('application/json', response.headers['Content-Type'])
+
+    @gen_test
+    def test_streamed_response(self):
+        response = yield self.http_client.fetch(self.get_url('/stream'))
+        self.assertEqual('0\n1\n2\n', response.body)
+        self.assertEqual('application/x-ndjson', response.headers['Content-Type'])
+
+    @gen_test
+    def test_not_found(self):
+        response = yield self.http_client.fetch(self.get_url('/missing'), raise_error=False)
+        self.assertEqual(404, response.code)
+
+
+if __name__ == '__main__':
+    unittest.main()
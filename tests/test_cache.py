@@ -0,0 +1,241 @@
+import json
+import time
+import unittest
+from pprint import pprint
+
+from redis import ConnectionError
+
+from parser.content_getter import ContentGetter, extraction_cache
+from parser.page_cache import get_cached_pages, cache_pages
+from similarity_checker import tokenize_and_normalize_content, _tokenize_and_normalize_content, token_cache
+from util.cache import LRUCache
+from util.deadline import Deadline
+from util.redis_client import get_redis
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_evict_least_recently_used(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+
+    def test_evict_by_cost(self):
+        cache = LRUCache(max_size=10, max_cost=5)
+        cache.set('a', [1, 2, 3])
+        cache.set('b', [1, 2])
+        cache.set('c', [1])
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(3, cache.total_cost)
+        # an entry bigger than the whole cache is not kept
+        cache.set('d', range(6))
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual([1, 2], cache.get('b'))
+
+    def test_expire_time(self):
+        cache = LRUCache(max_size=10, max_cost=10)
+        cache.set('a', [1, 2], expire_time=0.05)
+        cache.set('b', [1])
+        self.assertEqual([1, 2], cache.get('a'))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual([1], cache.get('b'))
+        self.assertEqual(1, cache.total_cost)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        token_cache.clear()
+
+    def test_cached_tokens_are_the_same(self):
+        text = u'What are you doing, are you cooking?'
+        expected = _tokenize_and_normalize_content(text, 'word', 1, 2)
+        self.assertEqual(expected, tokenize_and_normalize_content(text, min_ngram=1, max_ngram=2))
+        self.assertEqual(1, len(token_cache.local))
+        tokens = tokenize_and_normalize_content(text, min_ngram=1, max_ngram=2)
+        self.assertEqual(expected, tokens)
+        # caller can not corrupt the cached entry
+        tokens.append('foo')
+        self.assertEqual(expected, tokenize_and_normalize_content(text, min_ngram=1, max_ngram=2))
+
+    def test_cache_key_depends_on_ngram_settings(self):
+        text = 'what are you doing'
+        words = tokenize_and_normalize_content(text)
+        characters = tokenize_and_normalize_content(text, unit='character', min_ngram=1, max_ngram=3)
+        self.assertNotEqual(words, characters)
+        self.assertEqual(2, len(token_cache.local))
+
+
+class FakeCrawler(object):
+
+    def __init__(self, user_agent='bot'):
+        self.user_agent = user_agent
+        self.crawled = []
+
+    def active_redis_cache(self, expire_time):
+        pass
+
+    def settings(self):
+        return 'fake', self.user_agent
+
+    def process(self, urls, timeout=None):
+        self.crawled.extend(urls)
+        return {url: {'content': '<p>%s</p>' % url, 'ok': True, 'error': False} for url in urls}
+
+
+class FakeExtractor(object):
+    name = 'fake'
+
+    def __init__(self):
+        self.selector = None
+        self.extracted = []
+
+    def settings(self, selector=None):
+        return self.name, selector or self.selector
+
+    def process(self, pages, selector=None, timeout=None):
+        for url, page in pages.items():
+            self.extracted.append(url)
+            page['content'] = u'%s %s' % (selector or self.selector, url)
+        return pages
+
+
+class PartialCrawler(FakeCrawler):
+    """Crawler whose slow pages are not crawled before the deadline"""
+
+    def __init__(self):
+        super(PartialCrawler, self).__init__()
+        self.timeouts = []
+
+    def process(self, urls, timeout=None):
+        self.timeouts.append(timeout)
+        pages = super(PartialCrawler, self).process(urls, timeout)
+        return {url: page for url, page in pages.items() if not url.endswith('/slow')}
+
+
+class ExtractionCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        extraction_cache.clear()
+        self.crawler = FakeCrawler()
+        self.extractor = FakeExtractor()
+        self.content_getter = ContentGetter(self.crawler, self.extractor)
+        # local tier only, the redis tier is enabled once the cache has an expire time
+        self.content_getter.extract_expire_time = 60
+
+    def tearDown(self):
+        extraction_cache.clear()
+
+    def test_hit_skips_crawl_and_extraction(self):
+        urls = ['http://example.com/1', 'http://example.com/2']
+        first = self.content_getter.process(urls)
+        first['http://example.com/1']['tokens'] = ['foo']
+        second = self.content_getter.process(urls + ['http://example.com/3'])
+        self.assertEqual(sorted(urls + ['http://example.com/3']), sorted(self.crawler.crawled))
+        self.assertEqual(3, len(self.extractor.extracted))
+        self.assertEqual(u'None http://example.com/1', second['http://example.com/1']['content'])
+        # callers can not corrupt the cached pages
+        self.assertNotIn('tokens', second['http://example.com/1'])
+
+    def test_key_depends_on_extractor_settings(self):
+        self.content_getter.process(['http://example.com/1'])
+        self.extractor.selector = '#main'
+        page = self.content_getter.process(['http://example.com/1'])['http://example.com/1']
+        self.assertEqual(u'#main http://example.com/1', page['content'])
+        self.assertEqual(2, len(self.crawler.crawled))
+
+    def test_key_depends_on_crawler_settings(self):
+        self.content_getter.process(['http://example.com/1'])
+        # rendered with another user agent
+        self.crawler.user_agent = 'other bot'
+        self.content_getter.process(['http://example.com/1'])
+        self.assertEqual(2, len(self.crawler.crawled))
+
+    def test_selector_of_the_call(self):
+        page = self.content_getter.process(['http://example.com/1'], '#main')['http://example.com/1']
+        self.assertEqual(u'#main http://example.com/1', page['content'])
+        # the extractor is not changed by the call
+        self.assertIsNone(self.extractor.selector)
+        page = self.content_getter.process(['http://example.com/1'])['http://example.com/1']
+        self.assertEqual(u'None http://example.com/1', page['content'])
+
+    def test_groups_crawl_each_url_once(self):
+        groups = self.content_getter.process_groups([(['http://example.com/1'], '#main'),
+                                                     (['http://example.com/1', 'http://example.com/2'], '.sub'),
+                                                     (['http://example.com/2'], None)])
+        self.assertEqual(['http://example.com/1', 'http://example.com/2'], sorted(self.crawler.crawled))
+        self.assertEqual(u'#main http://example.com/1', groups[0]['http://example.com/1']['content'])
+        self.assertEqual(u'.sub http://example.com/1', groups[1]['http://example.com/1']['content'])
+        self.assertEqual(u'.sub http://example.com/2', groups[1]['http://example.com/2']['content'])
+        self.assertEqual(u'None http://example.com/2', groups[2]['http://example.com/2']['content'])
+        # every (url, selector) is cached
+        self.content_getter.process(['http://example.com/1', 'http://example.com/2'], '.sub')
+        self.assertEqual(2, len(self.crawler.crawled))
+        self.assertEqual(4, len(extraction_cache.local))
+
+    def test_timed_out_pages_are_marked_and_not_cached(self):
+        crawler = PartialCrawler()
+        content_getter = ContentGetter(crawler, self.extractor, deadline=Deadline(10))
+        content_getter.extract_expire_time = 60
+        pages = content_getter.process(['http://example.com/1', 'http://example.com/slow'])
+        # the crawl gets its share of the deadline
+        self.assertTrue(5 < crawler.timeouts[0] <= 6)
+        self.assertEqual(u'None http://example.com/1', pages['http://example.com/1']['content'])
+        self.assertTrue(pages['http://example.com/slow']['timed_out'])
+        self.assertEqual('Crawling timed out', pages['http://example.com/slow']['error'])
+        self.assertEqual(1, len(extraction_cache.local))
+
+    def test_disabled_by_default(self):
+        content_getter = ContentGetter(self.crawler, self.extractor)
+        content_getter.process(['http://example.com/1'])
+        content_getter.process(['http://example.com/1'])
+        self.assertEqual(2, len(self.crawler.crawled))
+        self.assertEqual(0, len(extraction_cache.local))
+
+
+class PageCacheBenchmarkTestCase(unittest.TestCase):
+    """Per-url GET/SET against MGET and pipelined SET, needs a local redis-server"""
+
+    def setUp(self):
+        self.redis = get_redis(15)
+        try:
+            self.redis.ping()
+        except ConnectionError:
+            self.skipTest('redis-server is not running')
+        self.redis.flushdb()
+        self.pages = {'http://example.com/page/%d' % i: {'content': '<html>%s</html>' % ('x' * 2000), 'error': False,
+                                                         'ok': True, 'code': 200} for i in range(300)}
+        self.urls = sorted(self.pages)
+
+    def tearDown(self):
+        self.redis.flushdb()
+
+    def test_benchmark(self):
+        start = time.time()
+        for url in self.urls:
+            self.redis.set(url, json.dumps(self.pages[url]), ex=60)
+        naive = {}
+        for url in self.urls:
+            naive[url] = json.loads(self.redis.get(url))
+        naive_time = time.time() - start
+        self.redis.flushdb()
+
+        start = time.time()
+        cache_pages(self.redis, self.pages, 60)
+        batched = get_cached_pages(self.redis, self.urls)
+        batched_time = time.time() - start
+
+        self.assertEqual(set(naive), set(batched))
+        self.assertEqual(naive['http://example.com/page/7']['content'], batched['http://example.com/page/7']['content'])
+        self.assertTrue(0 < self.redis.ttl(self.urls[0]) <= 60)
+        pprint('300 urls: GET/SET per url %.4fs, MGET + pipelined SET %.4fs' % (naive_time, batched_time))
+
+
+if __name__ == '__main__':
+    unittest.main()
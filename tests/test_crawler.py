@@ -0,0 +1,104 @@
+import threading
+import time
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from parser.crawl_engine import CrawlEngine
+from parser.http_session import get_session, connection_stats
+
+
+class FakeCrawler(object):
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def crawl_page(self, url):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+        return {url: {'content': 'content of %s' % url, 'error': False, 'ok': True}}
+
+
+class CrawlEngineTestCase(unittest.TestCase):
+
+    def test_crawl(self):
+        engine = CrawlEngine(max_concurrency=8, max_fan_out=4)
+        crawler = FakeCrawler()
+        urls = ['http://page/%d' % i for i in range(20)]
+        result = engine.crawl(crawler.crawl_page, urls)
+        self.assertEqual(set(urls), set(result))
+        self.assertEqual('content of http://page/3', result['http://page/3']['content'])
+        self.assertLessEqual(crawler.max_in_flight, 4)
+
+    def test_timeout(self):
+        engine = CrawlEngine(max_concurrency=8, max_fan_out=2)
+        crawler = FakeCrawler(delay=0.1)
+        urls = ['http://page/%d' % i for i in range(20)]
+        start = time.time()
+        result = engine.crawl(crawler.crawl_page, urls, timeout=0.25)
+        self.assertLess(time.time() - start, 0.3)
+        # the pages crawled in time, 2 at a time
+        self.assertEqual(4, len(result))
+        self.assertTrue(set(result) < set(urls))
+
+    def test_global_concurrency_limit(self):
+        engine = CrawlEngine(max_concurrency=6, max_fan_out=4)
+        crawler = FakeCrawler()
+        futures = [engine.submit(crawler.crawl_page, ['http://%d/%d' % (i, j) for j in range(8)]) for i in range(5)]
+        for future in futures:
+            self.assertEqual(8, len(future.result()))
+        self.assertLessEqual(crawler.max_in_flight, 6)
+        self.assertGreater(crawler.max_in_flight, 4)
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = 'ok'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Set-Cookie', 'session=secret')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class HttpSessionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_are_reused(self):
+        session = get_session('test-keep-alive', pool_size=2)
+        self.assertIs(session, get_session('test-keep-alive', pool_size=2))
+        for _ in range(5):
+            self.assertEqual('ok', session.get(self.url).content)
+        self.assertEqual((5, 1), connection_stats(session))
+        # cookies of crawled pages are never kept
+        self.assertEqual(0, len(session.cookies))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,220 @@
+import os
+import time
+import unittest
+from pprint import pprint
+
+from parser.document import ParsedDocument
+from parser.extraction_pool import ExtractionPool, run_task
+from util.deadline import Deadline, DeadlineExceeded, check_deadline, current_deadline, deadline
+
+
+def fake_extractor((url, raw_content)):
+    if raw_content == 'slow':
+        time.sleep(2)
+    elif raw_content == 'steps':
+        # a long extraction checking its deadline between steps
+        for _ in range(200):
+            time.sleep(0.01)
+            try:
+                check_deadline('next step')
+            except Exception:
+                pass
+    return url, '%s by %d' % (raw_content.upper(), os.getpid())
+
+
+class ExtractionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ExtractionPool(size=2, max_tasks_per_child=4, parallel_min_bytes=100, task_timeout=0.5)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_map(self):
+        tasks = [('http://example.com/%d' % i, 'page %d' % i) for i in range(3)]
+        results = self.pool.map(fake_extractor, tasks)
+        self.assertEqual([url for url, _ in tasks], [url for url, _ in results])
+        self.assertTrue(results[1][1].startswith('PAGE 1 by '))
+
+    def test_pool_is_reused(self):
+        workers = self.pool.workers
+        self.pool.map(fake_extractor, [('http://example.com/1', 'page')])
+        self.assertEqual(workers, self.pool.workers)
+
+    def test_workers_are_recycled(self):
+        tasks = [('http://example.com/%d' % i, 'page') for i in range(16)]
+        pids = {content.split(' by ')[1] for _, content in self.pool.map(fake_extractor, tasks)}
+        # 2 workers extract at most 4 pages each before being replaced
+        self.assertGreaterEqual(len(pids), 4)
+
+    def test_timeout(self):
+        results = dict(self.pool.map(fake_extractor, [('http://example.com/slow', 'slow'),
+                                                      ('http://example.com/fast', 'fast')]))
+        self.assertEqual(None, results['http://example.com/slow'])
+        self.assertTrue(results['http://example.com/fast'].startswith('FAST'))
+
+    def test_stuck_worker_is_replaced(self):
+        pids = {content.split(' by ')[1] for _, content in self.pool.map(fake_extractor, [
+            ('http://example.com/%d' % i, 'page') for i in range(2)])}
+        start = time.time()
+        results = dict(self.pool.map(fake_extractor, [('http://example.com/slow', 'slow')]))
+        self.assertEqual(None, results['http://example.com/slow'])
+        self.assertLess(time.time() - start, 1)
+        # the next batch does not wait for the stuck worker, which was killed and replaced
+        start = time.time()
+        results = self.pool.map(fake_extractor, [('http://example.com/%d' % i, 'page') for i in range(2)])
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(2, len(results))
+        self.assertTrue(all(content.startswith('PAGE') for _, content in results))
+        self.assertNotEqual(pids, {content.split(' by ')[1] for _, content in results})
+
+    def test_cooperative_deadline(self):
+        start = time.time()
+        results = dict(self.pool.map(fake_extractor, [('http://example.com/steps', 'steps'),
+                                                      ('http://example.com/fast', 'fast')]))
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(None, results['http://example.com/steps'])
+        self.assertTrue(results['http://example.com/fast'].startswith('FAST'))
+        # in this process too
+        self.assertEqual(('http://example.com/steps', None), self.pool.run(fake_extractor,
+                                                                          ('http://example.com/steps', 'steps')))
+
+    def test_batch_timeout(self):
+        start = time.time()
+        results = dict(self.pool.map(fake_extractor, [('http://example.com/steps', 'steps')], 0.1))
+        self.assertLess(time.time() - start, 0.4)
+        self.assertEqual(None, results['http://example.com/steps'])
+
+    def test_stuck_worker_of_short_batch_is_replaced(self):
+        workers = self.pool.workers
+        # stuck for less than the page timeout, but past the end of its batch
+        results = dict(self.pool.map(fake_extractor, [('http://example.com/slow', 'slow')], 0.1))
+        self.assertEqual(None, results['http://example.com/slow'])
+        self.assertEqual(1, len(workers - self.pool.workers))
+        self.assertEqual(2, len(self.pool.workers))
+
+    def test_pool_recovers_from_many_kills(self):
+        # pages overrunning their deadline by a little, the workers are killed at any point of their loop
+        for _ in range(5):
+            self.pool.map(fake_extractor, [('http://example.com/%d' % i, 'slow') for i in range(2)], 0.05)
+        results = self.pool.map(fake_extractor, [('http://example.com/%d' % i, 'page') for i in range(4)])
+        self.assertTrue(all(content.startswith('PAGE') for _, content in results))
+
+    def test_errors_are_raised(self):
+        self.assertRaises(RuntimeError, self.pool.map, fake_extractor, [('http://example.com/1', None)])
+        # the workers are still usable
+        self.assertEqual(2, len(self.pool.map(fake_extractor, [('http://example.com/%d' % i, 'page')
+                                                               for i in range(2)])))
+
+    def test_should_parallelize_by_cost(self):
+        self.assertFalse(self.pool.should_parallelize([('http://example.com/1', 'x' * 1000)]))
+        self.assertFalse(self.pool.should_parallelize([('http://example.com/%d' % i, 'x') for i in range(20)]))
+        self.assertTrue(self.pool.should_parallelize([('http://example.com/1', 'x' * 60),
+                                                      ('http://example.com/2', 'x' * 60)]))
+
+
+class DeadlineTestCase(unittest.TestCase):
+
+    def test_check(self):
+        check_deadline()
+        with deadline(0.05) as current:
+            self.assertIs(current, current_deadline())
+            check_deadline()
+            time.sleep(0.06)
+            self.assertTrue(current.expired())
+            self.assertRaises(DeadlineExceeded, check_deadline, 'step')
+        self.assertIsNone(current_deadline().remaining())
+
+    def test_inner_deadline_does_not_extend(self):
+        with deadline(0.1) as outer:
+            with deadline(10) as inner:
+                self.assertIs(outer, inner)
+            with deadline(0.01) as inner:
+                self.assertLess(inner.remaining(), outer.remaining())
+
+    def test_share(self):
+        self.assertIsNone(Deadline().share(0.5))
+        self.assertAlmostEqual(5, Deadline(10).share(0.5), places=2)
+
+    def test_not_swallowed(self):
+        def step():
+            try:
+                check_deadline()
+            except Exception:
+                pass
+            return 'done'
+
+        with deadline(0):
+            self.assertRaises(DeadlineExceeded, step)
+
+
+class ExtractionDeadlineBenchmarkTestCase(unittest.TestCase):
+    """Per page overhead of the deadline of an extraction"""
+
+    def test_benchmark(self):
+        try:
+            from timeout_decorator import timeout
+        except ImportError:
+            self.skipTest('timeout_decorator is not installed')
+        task = ('http://example.com/1', '<html>%s</html>' % ('x' * 100000))
+        num_pages = 20
+
+        decorated = timeout(5, use_signals=False)(fake_extractor)
+        start = time.time()
+        for _ in range(num_pages):
+            decorated(task)
+        decorator_time = (time.time() - start) / num_pages
+
+        start = time.time()
+        for _ in range(num_pages):
+            run_task(fake_extractor, task, 5)
+        deadline_time = (time.time() - start) / num_pages
+
+        self.assertLess(deadline_time, decorator_time)
+        pprint('Per page: timeout_decorator process %.2fms, cooperative deadline %.3fms' %
+               (decorator_time * 1000, deadline_time * 1000))
+
+
+class ParsedDocumentTestCase(unittest.TestCase):
+    html = """<!DOCTYPE html>
+<html><head><title>Hello World</title><meta name="Description" content="The description">
+<meta property="keywords" content="foo, bar"><style>.a {}</style><script>var a;</script></head>
+<body><!-- comment --> <p>First <b>bold</b> tail</p><div id="main">Second<script>b();</script>after</div></body>
+</html>"""
+
+    def setUp(self):
+        self.doc = ParsedDocument('http://www.example.com/news/some-page/index.html', self.html)
+
+    def test_common_info(self):
+        self.assertEqual([u'Hello World', u'The description', u'foo, bar', u'example news some page'],
+                         self.doc.common_info())
+
+    def test_visible_texts(self):
+        self.assertEqual(['First', 'bold', 'tail', 'Second', 'after'],
+                         [t.strip() for t in self.doc.visible_texts() if t.strip()])
+
+    def test_select(self):
+        self.assertEqual(['b'], [e.tag for e in self.doc.select('p b')])
+        self.assertEqual(['Second', 'after'], self.doc.select('//div[@id="main"]/text()', 'xpath'))
+
+    def test_parsed_once(self):
+        tree = self.doc.tree
+        self.doc.common_info()
+        self.doc.visible_texts()
+        self.assertIs(tree, self.doc.tree)
+
+    def test_unicode_with_xml_declaration(self):
+        doc = ParsedDocument('http://example.com', u'<?xml version="1.0" encoding="utf-8"?>\n' + self.html.decode('utf-8'))
+        self.assertEqual(u'Hello World', doc.title)
+        self.assertEqual(['First', 'bold', 'tail', 'Second', 'after'],
+                         [t.strip() for t in doc.visible_texts() if t.strip()])
+
+    def test_empty_document(self):
+        doc = ParsedDocument('http://example.com', '')
+        self.assertIsNone(doc.tree)
+        self.assertEqual([], doc.visible_texts())
+        self.assertEqual([u'example '], doc.common_info())
+
+
+if __name__ == '__main__':
+    unittest.main()
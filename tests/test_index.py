@@ -0,0 +1,178 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+from Queue import Queue
+
+from redis import ConnectionError
+
+from parser.content_getter import PageIndexer
+from similarity.minhash import MinHashLSH, optimal_bands
+from similarity.simhash_index import SimhashIndex, hamming_distance
+from similarity.storage import MemoryIndexStorage, RedisIndexStorage
+from util.redis_client import get_redis
+
+base_text = u' '.join('word%d' % i for i in range(300))
+near_text = base_text.replace('word10 ', 'other10 ').replace('word200 ', 'other200 ')
+other_text = u' '.join('term%d' % i for i in range(300))
+
+
+class MinHashLSHTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.snapshot_path = os.path.join(self.tmp_dir, 'lsh.pickle')
+        self.index = MinHashLSH(MemoryIndexStorage(snapshot_path=self.snapshot_path), threshold=0.5)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_optimal_bands(self):
+        bands, rows = optimal_bands(0.5, 128)
+        self.assertEqual(128, bands * rows)
+        self.assertAlmostEqual(0.5, (1.0 / bands) ** (1.0 / rows), delta=0.1)
+
+    def test_query_near_duplicates(self):
+        self.index.add('http://a', base_text)
+        self.index.add('http://b', near_text)
+        self.index.add('http://c', other_text)
+        self.assertEqual(['http://b'], self.index.query(base_text, exclude={'http://a'}))
+        # signatures only, not the contents
+        self.assertEqual(['signature'], self.index.storage.get_record('http://b').keys())
+
+    def test_unchanged_page_is_not_indexed_again(self):
+        self.index.add('http://a', base_text)
+        signature = self.index.signature
+        self.index.signature = None
+        self.index.add('http://a', base_text)
+        self.index.signature = signature
+        self.assertEqual(['http://a'], self.index.query(near_text))
+
+    def test_entries_expire(self):
+        index = MinHashLSH(MemoryIndexStorage(expire_time=0.1), threshold=0.5)
+        index.add('http://a', base_text)
+        self.assertEqual(['http://a'], index.query(near_text))
+        time.sleep(0.15)
+        self.assertEqual([], index.query(near_text))
+        index.add('http://b', other_text)
+        # purged by the next change
+        self.assertEqual(['http://b'], index.storage.records.keys())
+
+    def test_re_add_changed_page(self):
+        self.index.add('http://a', base_text)
+        self.index.add('http://a', other_text)
+        self.assertEqual([], self.index.query(base_text))
+        self.assertEqual(['http://a'], self.index.query(other_text))
+
+    def test_snapshot(self):
+        self.index.add('http://a', base_text)
+        self.index.storage.save()
+        index = MinHashLSH(MemoryIndexStorage(snapshot_path=self.snapshot_path), threshold=0.5)
+        self.assertEqual(['http://a'], index.query(near_text))
+
+    def test_snapshot_in_background(self):
+        storage = MemoryIndexStorage(snapshot_path=self.snapshot_path, snapshot_interval=0.05)
+        MinHashLSH(storage, threshold=0.5).add('http://a', base_text)
+        # pages are added without waiting for the snapshot
+        self.assertFalse(os.path.exists(self.snapshot_path))
+        time.sleep(0.2)
+        index = MinHashLSH(MemoryIndexStorage(snapshot_path=self.snapshot_path), threshold=0.5)
+        self.assertEqual(['http://a'], index.query(near_text))
+
+
+class SimhashIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.index = SimhashIndex(MemoryIndexStorage(), k=3)
+
+    def test_blocks_cover_fingerprint(self):
+        self.assertEqual(4, len(self.index.blocks))
+        self.assertEqual(64, sum(bin(mask).count('1') for _, mask in self.index.blocks))
+
+    def test_query_matches_linear_scan(self):
+        rnd = random.Random(7)
+        fingerprints = {}
+        for i in range(200):
+            base = rnd.getrandbits(64)
+            fingerprints['http://base/%d' % i] = base
+            # near-duplicates of the base fingerprint, 1 to 5 bits away
+            for bits in range(1, 6):
+                near = base
+                for bit in rnd.sample(range(64), bits):
+                    near ^= 1 << bit
+                fingerprints['http://near/%d/%d' % (i, bits)] = near
+        for url, fingerprint in fingerprints.items():
+            self.index.add_fingerprint(url, fingerprint)
+
+        for i in range(0, 200, 20):
+            fingerprint = fingerprints['http://base/%d' % i]
+            expected = sorted((url, hamming_distance(fingerprint, f)) for url, f in fingerprints.items()
+                              if hamming_distance(fingerprint, f) <= 3)
+            self.assertEqual(expected, sorted(self.index.query(fingerprint)))
+            self.assertTrue(all(distance <= 1 for _, distance in self.index.query(fingerprint, k=1)))
+
+    def test_add_pages(self):
+        self.index.add('http://a', base_text)
+        self.index.add('http://c', other_text)
+        self.assertEqual([('http://a', 0)], self.index.query(self.index.fingerprint(base_text)))
+        self.assertEqual([], self.index.query(self.index.fingerprint(base_text), exclude={'http://a'}))
+        # a changed page is moved to the buckets of its new fingerprint
+        self.index.add('http://a', other_text)
+        self.assertEqual([], self.index.query(self.index.fingerprint(base_text)))
+        self.assertEqual(self.index.fingerprint(other_text), self.index.get_fingerprint('http://a'))
+
+
+class PageIndexerTestCase(unittest.TestCase):
+
+    def test_pages_are_indexed_in_background(self):
+        indexes = [MinHashLSH(MemoryIndexStorage(), threshold=0.5), SimhashIndex(MemoryIndexStorage(), k=3)]
+        indexer = PageIndexer(batch_size=2)
+        indexer.add(indexes, {'http://a': base_text, 'http://b': near_text, 'http://c': other_text})
+        for _ in range(50):
+            if indexes[1].get_fingerprint('http://c') is not None:
+                break
+            time.sleep(0.01)
+        self.assertEqual(['http://b'], indexes[0].query(base_text, exclude={'http://a'}))
+        self.assertEqual([('http://c', 0)], indexes[1].query(indexes[1].fingerprint(other_text)))
+
+    def test_full_queue_drops_pages(self):
+        indexer = PageIndexer(max_pending=1)
+        # no thread taking the pages
+        indexer._queue = Queue(1)
+        indexer._pid = os.getpid()
+        indexer.add([], {'http://a': base_text, 'http://b': near_text})
+        self.assertEqual(1, indexer._queue.qsize())
+
+
+class RedisIndexStorageTestCase(unittest.TestCase):
+    """Needs a local redis-server"""
+
+    def setUp(self):
+        redis = get_redis(15)
+        try:
+            redis.ping()
+        except ConnectionError:
+            self.skipTest('redis-server is not running')
+        redis.flushdb()
+
+    def tearDown(self):
+        get_redis(15).flushdb()
+
+    def test_query_near_duplicates(self):
+        index = MinHashLSH(RedisIndexStorage(get_redis(15), prefix='test'), threshold=0.5)
+        index.add_many({'http://a': base_text, 'http://b': near_text, 'http://c': other_text})
+        self.assertEqual(['http://b'], index.query(base_text, exclude={'http://a'}))
+        self.assertLessEqual(get_redis(15).ttl('test:record:http://b'), index.storage.expire_time)
+
+    def test_entries_expire(self):
+        index = SimhashIndex(RedisIndexStorage(get_redis(15), prefix='test', expire_time=1), k=3)
+        index.add('http://a', base_text)
+        self.assertEqual([('http://a', 0)], index.query(index.fingerprint(base_text)))
+        time.sleep(1.1)
+        self.assertEqual([], index.query(index.fingerprint(base_text)))
+
+
+if __name__ == '__main__':
+    unittest.main()
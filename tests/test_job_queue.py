@@ -0,0 +1,93 @@
+import json
+import time
+import unittest
+
+from redis import ConnectionError
+
+from util.job_queue import JobQueue
+from util.redis_client import get_redis
+
+
+class JobQueueTestCase(unittest.TestCase):
+    """Needs a local redis-server"""
+
+    def setUp(self):
+        self.redis = get_redis(15)
+        try:
+            self.redis.ping()
+        except ConnectionError:
+            self.skipTest('redis-server is not running')
+        self.redis.flushdb()
+        self.queue = JobQueue(self.redis, 'test', lease_time=1, max_attempts=2)
+
+    def tearDown(self):
+        self.redis.flushdb()
+
+    def test_fifo(self):
+        for i in range(3):
+            self.queue.put('chunk', index=i)
+        self.assertEqual([0, 1, 2], [self.queue.get(1)['params']['index'] for _ in range(3)])
+        self.assertIsNone(self.queue.get(1))
+
+    def test_ack(self):
+        self.queue.put('chunk', index=0)
+        task = self.queue.get(1)
+        self.queue.ack(task)
+        self.assertEqual(0, self.redis.llen(self.queue.processing_key))
+        self.assertEqual(0, self.redis.hlen(self.queue.tasks_key))
+
+    def test_expired_lease_is_requeued(self):
+        self.queue.put('chunk', index=0)
+        task = self.queue.get(1)
+        self.assertIsNone(self.queue.get(1))
+        time.sleep(1.1)
+        # the worker holding the task died, another worker gets it
+        self.assertEqual(task['id'], self.queue.get(1)['id'])
+
+    def test_extended_lease_is_not_requeued(self):
+        self.queue.put('chunk', index=0)
+        task = self.queue.get(1)
+        for _ in range(3):
+            time.sleep(0.5)
+            self.assertTrue(self.queue.extend(task))
+        self.assertIsNone(self.queue.get(0))
+        self.queue.ack(task)
+        self.assertFalse(self.queue.extend(task))
+
+    def test_leased_with_the_pop(self):
+        self.queue.put('chunk', index=0)
+        task = self.queue.get(1)
+        self.assertEqual([task['id']], self.redis.lrange(self.queue.processing_key, 0, -1))
+        self.assertIsNotNone(self.redis.zscore(self.queue.leases_key, task['id']))
+
+    def test_retry(self):
+        self.queue.put('chunk', index=0)
+        task = self.queue.get(1)
+        self.assertTrue(self.queue.retry(task))
+        task = self.queue.get(1)
+        self.assertEqual(1, task['attempts'])
+        self.assertFalse(self.queue.retry(task, 'score error'))
+        self.assertIsNone(self.queue.get(1))
+        failed = json.loads(self.redis.lindex(self.queue.failed_key, 0))
+        self.assertEqual((task['id'], 'score error'), (failed['id'], failed['error']))
+
+    def test_task_losing_its_lease_fails(self):
+        failed = []
+        self.queue.on_failed = failed.append
+        self.queue.put('chunk', index=0)
+        for _ in range(2):
+            self.assertIsNotNone(self.queue.get(1))
+            # the worker crashed while running the task
+            time.sleep(1.1)
+        self.assertIsNone(self.queue.get(0))
+        self.assertEqual(['lease expired'], [task['error'] for task in failed])
+        self.assertEqual(1, self.redis.llen(self.queue.failed_key))
+
+    def test_put_once(self):
+        self.assertIsNotNone(self.queue.put_once('flag', 'merge', job_id=1))
+        self.assertIsNone(self.queue.put_once('flag', 'merge', job_id=1))
+        self.assertEqual(1, self.queue.size())
+
+
+if __name__ == '__main__':
+    unittest.main()
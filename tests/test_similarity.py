@@ -0,0 +1,448 @@
+import math
+import random
+import time
+import unittest
+from multiprocessing.pool import ThreadPool
+from pprint import pprint
+
+from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import ConnectionError
+from fuzzywuzzy import fuzz
+from simhash import Simhash
+
+from parser.content_getter import ContentGetter
+from similarity_checker import cosine_similarity, jaccard_similarity, tokenize_and_normalize_content, \
+    fuzzy_similarity, simhash_similarity, PreparedDocument, prepare_documents, SimilarityChecker, CosineSimilarity, \
+    CheckConfig
+from similarity.bm25 import BM25Index, analyze
+from similarity.fuzzy import bounded_ratio
+from similarity.matrix import cosine_similarity_batch, jaccard_similarity_batch
+from similarity.ngram import ngram_hashes, unit_hashes
+from util.deadline import Deadline
+
+texts = [
+    u'The quick brown fox jumps over the lazy dog, the dog sleeps.',
+    u'A quick brown dog jumps over the lazy fox and the fox runs away.',
+    u'Completely unrelated sentence about caf\xe9 prices in Paris.',
+    u'',
+]
+
+
+def random_tokens(rnd, vocabulary, max_len=200):
+    return [rnd.choice(vocabulary) for _ in range(rnd.randint(0, max_len))]
+
+
+class BatchSimilarityTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rnd = random.Random(42)
+        vocabulary = ['token%d' % i for i in range(300)]
+        self.main_tokens = random_tokens(rnd, vocabulary)
+        self.token_lists = [random_tokens(rnd, vocabulary) for _ in range(100)] + [[], self.main_tokens]
+
+    def test_cosine_batch_matches_pairwise(self):
+        expected = [cosine_similarity(self.main_tokens, tokens) for tokens in self.token_lists]
+        self.assertEqual(expected, cosine_similarity_batch(self.main_tokens, self.token_lists))
+
+    def test_jaccard_batch_matches_pairwise(self):
+        expected = [jaccard_similarity(self.main_tokens, tokens) for tokens in self.token_lists]
+        self.assertEqual(expected, jaccard_similarity_batch(self.main_tokens, self.token_lists))
+
+    def test_empty_main_tokens(self):
+        self.assertEqual([0.0] * len(self.token_lists), cosine_similarity_batch([], self.token_lists))
+        self.assertEqual([0.0] * len(self.token_lists), jaccard_similarity_batch([], self.token_lists))
+
+
+class HashedNgramTestCase(unittest.TestCase):
+
+    def test_hashes_are_distinct_like_strings(self):
+        for unit, min_ngram, max_ngram in [('word', 1, 3), ('character', 1, 20), ('character', 3, 5)]:
+            for text in texts:
+                tokens = tokenize_and_normalize_content(text, unit, min_ngram, max_ngram)
+                hashes = tokenize_and_normalize_content(text, unit, min_ngram, max_ngram, hashed=True)
+                self.assertEqual(len(tokens), len(hashes))
+                self.assertEqual(len(set(tokens)), len(set(hashes.tolist())))
+
+    def test_hashed_scores_match_string_scores(self):
+        for unit, min_ngram, max_ngram in [('word', 1, 2), ('character', 2, 4)]:
+            tokens = [tokenize_and_normalize_content(t, unit, min_ngram, max_ngram) for t in texts]
+            hashes = [tokenize_and_normalize_content(t, unit, min_ngram, max_ngram, hashed=True) for t in texts]
+            for similarity, batch in [(cosine_similarity, cosine_similarity_batch),
+                                      (jaccard_similarity, jaccard_similarity_batch)]:
+                expected = [similarity(tokens[0], t) for t in tokens]
+                self.assertEqual(expected, [similarity(hashes[0], h) for h in hashes])
+                self.assertEqual(expected, batch(hashes[0], hashes))
+
+
+class PreparedDocumentTestCase(unittest.TestCase):
+
+    def test_scores_match_token_scores(self):
+        for unit, min_ngram, max_ngram in [('word', 1, 2), ('character', 2, 4)]:
+            tokens = [tokenize_and_normalize_content(t, unit, min_ngram, max_ngram) for t in texts]
+            docs = prepare_documents(texts, unit, min_ngram, max_ngram)
+            for i in range(len(texts)):
+                for j in range(len(texts)):
+                    self.assertEqual(cosine_similarity(tokens[i], tokens[j]), cosine_similarity(docs[i], docs[j]))
+                    self.assertEqual(jaccard_similarity(tokens[i], tokens[j]), jaccard_similarity(docs[i], docs[j]))
+                    self.assertEqual(fuzz.token_sort_ratio(' '.join(tokens[i]), ' '.join(tokens[j])),
+                                     fuzzy_similarity(docs[i], docs[j]))
+                    expected = 100 - Simhash(tokens[i]).distance(Simhash(tokens[j])) \
+                        if tokens[i] and tokens[j] else 0
+                    self.assertEqual(expected, simhash_similarity(docs[i], docs[j]))
+                    # prepared documents and n-grams can be mixed
+                    self.assertEqual(fuzzy_similarity(tokens[i], tokens[j]), fuzzy_similarity(docs[i], tokens[j]))
+                    self.assertEqual(cosine_similarity(tokens[i], tokens[j]), cosine_similarity(tokens[i], docs[j]))
+
+    def test_prepared_lazily_once(self):
+        doc = PreparedDocument(texts[0])
+        self.assertIsNone(doc._tokens)
+        self.assertIsNone(doc._hashes)
+        cosine_similarity(doc, PreparedDocument(texts[1]))
+        self.assertIsNone(doc._tokens)
+        token_set = doc.token_set
+        simhash_similarity(doc, PreparedDocument(texts[1]))
+        jaccard_similarity(doc, PreparedDocument(texts[2]))
+        self.assertIs(token_set, doc.token_set)
+        self.assertIs(doc.simhash, doc.simhash)
+
+
+class BoundedFuzzyTestCase(unittest.TestCase):
+
+    def test_scores_above_cutoff_match_ratio(self):
+        rnd = random.Random(3)
+        for _ in range(200):
+            s1 = u''.join(rnd.choice(u'abcd \xe9') for _ in range(rnd.randint(0, 200)))
+            s2 = u''.join(rnd.choice(u'abcd \xe9') for _ in range(rnd.randint(0, 200)))
+            score = fuzz.ratio(s1, s2)
+            for min_score in [0, 40, score, score + 1, 101]:
+                expected = score if score >= min_score else 0
+                # min_cells=0 always runs the bit-parallel comparison
+                self.assertEqual(expected, bounded_ratio(s1, s2, min_score, check_every=8, min_cells=0))
+                self.assertEqual(expected, bounded_ratio(s1, s2, min_score))
+
+    def test_long_texts(self):
+        rnd = random.Random(5)
+        vocabulary = ['word%d' % i for i in range(500)]
+        text_1 = u' '.join(sorted(random_tokens(rnd, vocabulary, 2000)))
+        text_2 = u' '.join(sorted(random_tokens(rnd, vocabulary, 2000)))
+        score = fuzz.ratio(text_1, text_2)
+        self.assertEqual(score, bounded_ratio(text_1, text_2))
+        self.assertEqual(score, bounded_ratio(text_1, text_2, score))
+        self.assertEqual(0, bounded_ratio(text_1, text_2, score + 1))
+        # rejected by the length filter
+        self.assertEqual(0, bounded_ratio(text_1, text_1[:len(text_1) / 4], 50))
+
+    def test_fuzzy_similarity_min_score(self):
+        tokens_1 = tokenize_and_normalize_content(texts[0])
+        tokens_2 = tokenize_and_normalize_content(texts[1])
+        score = fuzzy_similarity(tokens_1, tokens_2)
+        self.assertEqual(score, fuzzy_similarity(tokens_1, tokens_2, min_score=score))
+        self.assertEqual(0, fuzzy_similarity(tokens_1, tokens_2, min_score=score + 1))
+
+
+def random_words(rnd, vocabulary, length):
+    # skewed word frequencies, like natural text
+    return [vocabulary[int(len(vocabulary) * rnd.random() ** 3)] for _ in range(length)]
+
+
+def prepared(words):
+    """Prepared document of already normalized words, skips the slow stemming of test documents"""
+    doc = PreparedDocument(u' '.join(words))
+    doc._tokens = words
+    doc._hashes = ngram_hashes(unit_hashes(words, 'word'), 1, 1)
+    return doc
+
+
+class RankTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rnd = random.Random(11)
+        vocabulary = [u'word%d' % i for i in range(20000)]
+        main_words = random_words(rnd, vocabulary, 1000)
+        # 20 near-duplicates of the main page among 1000 sub pages
+        word_lists = [[rnd.choice(vocabulary) if rnd.random() < rate else w for w in main_words]
+                      for rate in [rnd.random() * 0.6 for _ in range(20)]]
+        word_lists.extend(random_words(rnd, vocabulary, rnd.randint(50, 3000)) for _ in range(980))
+        rnd.shuffle(word_lists)
+        cls.main_doc = prepared(main_words)
+        cls.sub_docs = [prepared(words) for words in word_lists]
+
+    def exact(self, checker, min_similarity=0, top_k=None):
+        result = [(i, sim) for i, sim in enumerate(checker.score(self.main_doc, self.sub_docs))
+                  if sim >= min_similarity]
+        result.sort(key=lambda x: x[1], reverse=True)
+        return result[:top_k] if top_k else result
+
+    def test_rank_matches_exact_scores(self):
+        for similarity in [cosine_similarity, jaccard_similarity, simhash_similarity]:
+            checker = SimilarityChecker(None, similarity)
+            for min_similarity, top_k in [(0, None), (30, None), (60, None), (0, 5), (40, 5), (99, 3)]:
+                expected = self.exact(checker, min_similarity, top_k)
+                ranked = checker.rank(self.main_doc, self.sub_docs, min_similarity, top_k)
+                if top_k:
+                    self.assertEqual([sim for _, sim in expected], [sim for _, sim in ranked])
+                else:
+                    self.assertEqual(sorted(expected), sorted(ranked))
+
+    def test_fuzzy_rank(self):
+        checker = SimilarityChecker(None, fuzzy_similarity)
+        sub_docs = self.sub_docs[:20]
+        expected = sorted(((i, fuzzy_similarity(self.main_doc, doc)) for i, doc in enumerate(sub_docs)),
+                          key=lambda x: x[1], reverse=True)
+        self.assertEqual([sim for _, sim in expected[:3]],
+                         [sim for _, sim in checker.rank(self.main_doc, sub_docs, top_k=3)])
+        self.assertEqual(sorted(x for x in expected if x[1] >= 60),
+                         sorted(checker.rank(self.main_doc, sub_docs, min_similarity=60)))
+
+    def test_benchmark(self):
+        for similarity in [jaccard_similarity, cosine_similarity]:
+            for batch in [True, False]:
+                checker = SimilarityChecker(None, similarity, batch=batch)
+                for min_similarity, top_k in [(50, None), (80, None), (0, 10)]:
+                    start = time.time()
+                    expected = self.exact(checker, min_similarity, top_k)
+                    exact_time = time.time() - start
+                    start = time.time()
+                    ranked = checker.rank(self.main_doc, self.sub_docs, min_similarity, top_k)
+                    rank_time = time.time() - start
+                    self.assertEqual(sorted(sim for _, sim in expected), sorted(sim for _, sim in ranked))
+                    pprint('1000 sub urls, %s batch=%s min_similarity=%s top_k=%s: exact %.4fs, pruned %.4fs' %
+                           (similarity.__name__, batch, min_similarity, top_k, exact_time, rank_time))
+
+
+class FakeContentGetter(object):
+
+    def __init__(self, contents):
+        self.contents = contents
+        self.fetched = []
+
+    def process(self, urls, selector=None):
+        self.fetched.extend(urls)
+        return {url: {'content': self.contents.get(url, ''), 'error': False} for url in urls}
+
+    def process_groups(self, groups):
+        return [self.process(urls, selector) for urls, selector in groups]
+
+
+class WordsCrawler(object):
+
+    def settings(self):
+        return 'words',
+
+    def process(self, urls, timeout=None):
+        # some threads sleep here, so the requests interleave
+        time.sleep(random.random() * 0.01)
+        return {url: {'content': u' '.join(u'w%d' % ((int(url.rsplit('/', 1)[1]) * 7 + i) % 60) for i in range(40)),
+                      'ok': True, 'error': False} for url in urls}
+
+
+class WordsExtractor(object):
+    """Keeps the words whose number is a multiple of the selector, e.g. '2' keeps w0, w2, w4..."""
+    selector = None
+
+    def settings(self, selector=None):
+        return 'words', selector or self.selector
+
+    def process(self, pages, selector=None, timeout=None):
+        step = int(selector or self.selector or 1)
+        for page in pages.values():
+            page['content'] = u' '.join(w for w in page['content'].split() if int(w[1:]) % step == 0)
+        return pages
+
+
+class CountingCrawler(WordsCrawler):
+
+    def __init__(self):
+        self.crawled = []
+
+    def process(self, urls, timeout=None):
+        self.crawled.extend(urls)
+        return super(CountingCrawler, self).process(urls, timeout)
+
+
+class SelectorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.crawler = CountingCrawler()
+        self.content_getter = ContentGetter(self.crawler, WordsExtractor())
+        self.urls = ['http://example.com/%d' % i for i in range(3)]
+
+    def test_main_url_is_also_a_sub_url(self):
+        checker = SimilarityChecker(self.content_getter, jaccard_similarity, main_page_selector='2',
+                                    sub_page_selector='3')
+        result = dict(checker.process(self.urls[0], self.urls))
+        # the main page is compared with its own content of the other selector
+        self.assertLess(result[self.urls[0]], 100)
+        self.assertEqual(sorted(self.urls), sorted(self.crawler.crawled))
+
+    def test_cross_process_crawls_once(self):
+        checker = SimilarityChecker(self.content_getter, jaccard_similarity, url_1_selector='2', url_2_selector='3')
+        result = checker.cross_process(self.urls[0], self.urls[0], self.urls[0])
+        self.assertEqual([self.urls[0]], self.crawler.crawled)
+        for sim in result.values():
+            self.assertLess(sim, 100)
+
+
+class TimedOutCrawler(WordsCrawler):
+
+    def process(self, urls, timeout=None):
+        # no page is crawled before the deadline
+        return {}
+
+
+class DeadlineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.urls = ['http://example.com/%d' % i for i in range(3)]
+
+    def test_main_page_timed_out(self):
+        checker = SimilarityChecker(ContentGetter(TimedOutCrawler(), WordsExtractor(), deadline=Deadline(0)))
+        self.assertEqual('Main page timed out', checker.process(self.urls[0], self.urls[1:]))
+        self.assertEqual([(0, 'Main page timed out')], list(checker.batch_process([(self.urls[0], self.urls[1:])])))
+
+    def test_scoring_timed_out(self):
+        content_getter = FakeContentGetter({url: texts[i] for i, url in enumerate(self.urls)})
+        checker = SimilarityChecker(content_getter, jaccard_similarity)
+        self.assertEqual(2, len([sim for _, sim in checker.process(self.urls[0], self.urls[1:]) if sim != 'Timed out']))
+        # the pages are fetched, the deadline is over before they are scored
+        content_getter.deadline = Deadline(0)
+        self.assertEqual(sorted([[self.urls[1], 'Timed out'], [self.urls[2], 'Timed out']]),
+                         sorted(checker.process(self.urls[0], self.urls[1:])))
+
+
+class BM25ElasticsearchSimilarity(CosineSimilarity):
+    """Elasticsearch scoring with BM25, the in-process backend matches it rather than the default TF-IDF of ES 2"""
+    content_mapping = dict(CosineSimilarity.content_mapping, similarity='BM25')
+
+
+class BM25TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.contents = {'http://example.com/%d' % i: text for i, text in enumerate(texts)}
+        self.contents['http://example.com/main'] = texts[0]
+        self.sub_urls = sorted(url for url in self.contents if not url.endswith('main'))
+
+    def test_analyze(self):
+        self.assertEqual([u'the', u'quick', u'caf\xe9', u'42'], analyze(u'The quick, CAF\xc9! 42'))
+
+    def test_scores(self):
+        index = BM25Index()
+        index.add('a', u'fox fox dog')
+        index.add('b', u'dog cat')
+        index.add('c', u'bird')
+        hits = index.search(u'fox dog')
+        self.assertEqual(['a', 'b'], [doc_id for doc_id, _ in hits])
+        # idf(fox) = log(1 + 2.5 / 1.5), tf 2, |a| 3 and avgdl 2
+        fox = math.log(1 + 2.5 / 1.5) * 2 * 2.2 / (2 + 1.2 * (0.25 + 0.75 * 1.5))
+        dog = math.log(1 + 1.5 / 2.5) * 2.2 / (1 + 1.2 * (0.25 + 0.75 * 1.5))
+        self.assertAlmostEqual(fox + dog, hits[0][1])
+
+    def test_remove(self):
+        index = BM25Index()
+        index.add('a', u'fox')
+        index.add('b', u'fox dog')
+        index.add('b', u'dog')
+        self.assertEqual(['a'], [doc_id for doc_id, _ in index.search(u'fox')])
+        index.remove('a')
+        self.assertEqual([], index.search(u'fox'))
+        self.assertEqual(1, len(index))
+
+    def test_bm25_backend(self):
+        similarity = CosineSimilarity(FakeContentGetter(self.contents), backend='bm25')
+        result = dict(similarity.process('http://example.com/main', self.sub_urls))
+        self.assertEqual(100, result['http://example.com/0'])
+        self.assertTrue(0 < result['http://example.com/1'] < 100)
+        self.assertEqual(0, result['http://example.com/2'])
+        self.assertEqual('Page not found', result['http://example.com/3'])
+
+    def test_backends_agree(self):
+        es_client = Elasticsearch()
+        try:
+            es_client.info()
+        except ConnectionError:
+            self.skipTest('Elasticsearch is not running')
+        content_getter = FakeContentGetter(self.contents)
+        expected = dict(BM25ElasticsearchSimilarity(content_getter, es_client, 'elasticsearch')
+                        .process('http://example.com/main', self.sub_urls))
+        result = dict(CosineSimilarity(content_getter, backend='bm25')
+                      .process('http://example.com/main', self.sub_urls))
+        self.assertEqual(sorted(expected), sorted(result))
+        for url, score in expected.items():
+            if isinstance(score, float):
+                # Lucene stores document lengths with a lossy 1 byte encoding
+                self.assertAlmostEqual(score, result[url], delta=5)
+            else:
+                self.assertEqual(score, result[url])
+
+
+class BatchProcessTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.contents = {'http://example.com/%d' % i: text for i, text in enumerate(texts)}
+        self.content_getter = FakeContentGetter(self.contents)
+        self.checker = SimilarityChecker(self.content_getter, jaccard_similarity)
+        urls = sorted(self.contents)
+        self.groups = [(urls[0], urls[1:3]), (urls[1], [urls[0], urls[2]]), (urls[3], urls[:2]),
+                       (urls[2], [' %s ' % urls[0]])]
+
+    def test_results_match_process(self):
+        results = dict(self.checker.batch_process(self.groups, fetch_size=2))
+        self.assertEqual(range(len(self.groups)), sorted(results))
+        self.assertEqual('Main page is empty', results[2])
+        for index in [0, 1, 3]:
+            main_url, sub_urls = self.groups[index]
+            self.assertEqual(SimilarityChecker(FakeContentGetter(self.contents), jaccard_similarity)
+                             .process(main_url, sub_urls), results[index])
+
+    def test_each_url_fetched_once(self):
+        list(self.checker.batch_process(self.groups, fetch_size=2))
+        self.assertEqual(sorted(self.contents), sorted(self.content_getter.fetched))
+
+    def test_results_streamed_by_wave(self):
+        results = self.checker.batch_process(self.groups, fetch_size=1)
+        self.assertEqual(0, next(results)[0])
+        # only the urls of the first group are fetched before its result
+        self.assertEqual(3, len(self.content_getter.fetched))
+
+
+class ConcurrencyTestCase(unittest.TestCase):
+    """Concurrent requests with different options share one content getter and get the results of serial runs"""
+
+    def setUp(self):
+        self.content_getter = ContentGetter(WordsCrawler(), WordsExtractor())
+        rnd = random.Random(5)
+        urls = ['http://example.com/%d' % i for i in range(12)]
+        self.requests = []
+        for _ in range(40):
+            main_page_selector = rnd.choice([None, '2', '3'])
+            config = CheckConfig(similarity=rnd.choice([cosine_similarity, jaccard_similarity, fuzzy_similarity,
+                                                        simhash_similarity]),
+                                 unit=rnd.choice(['word', 'character']), min_ngram=1, max_ngram=rnd.randint(1, 2),
+                                 min_similarity=rnd.choice([0, 20]), top_k=rnd.choice([None, 3]), batch=True,
+                                 main_page_selector=main_page_selector,
+                                 sub_page_selector=main_page_selector and rnd.choice(['2', '3']),
+                                 url_1_selector=None, url_2_selector=None, url_3_selector=None)
+            self.requests.append((config, urls[rnd.randint(0, 11)], rnd.sample(urls, 5)))
+
+    def check(self, (config, main_url, sub_urls)):
+        return SimilarityChecker(self.content_getter, config=config).process(main_url, sub_urls)
+
+    def test_stress(self):
+        expected = [self.check(request) for request in self.requests]
+        pool = ThreadPool(8)
+        try:
+            for _ in range(3):
+                self.assertEqual(expected, pool.map(self.check, self.requests))
+        finally:
+            pool.close()
+            pool.join()
+
+    def test_config_is_immutable(self):
+        checker = SimilarityChecker(self.content_getter, jaccard_similarity)
+        with self.assertRaises(AttributeError):
+            checker.config.unit = 'character'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+import threading
+import time
+import unittest
+
+from redis import ConnectionError
+
+from parser.content_getter import ContentGetter
+from util.redis_client import get_redis
+from util.singleflight import SingleFlight
+
+
+class SlowCrawler(object):
+
+    def __init__(self):
+        self.crawled = []
+
+    def settings(self):
+        return 'slow',
+
+    def process(self, urls, timeout=None):
+        self.crawled.extend(urls)
+        time.sleep(0.2)
+        return {url: {'content': '<p>%s</p>' % url, 'ok': True, 'error': False} for url in urls}
+
+
+class FakeExtractor(object):
+    name = 'fake'
+
+    def __init__(self):
+        self.extracted = []
+
+    def settings(self, selector=None):
+        return self.name,
+
+    def process(self, pages, selector=None, timeout=None):
+        for url, page in pages.items():
+            self.extracted.append(url)
+            page['content'] = u'content of %s' % url
+        return pages
+
+
+def run_concurrently(funcs):
+    results = [None] * len(funcs)
+
+    def run(i):
+        results[i] = funcs[i]()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(funcs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class SingleFlightTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.flight = SingleFlight('test')
+        self.calls = []
+
+    def slow_square(self, keys):
+        self.calls.append(sorted(keys))
+        time.sleep(0.2)
+        return {key: key * key for key in keys}
+
+    def test_concurrent_calls_are_coalesced(self):
+        results = run_concurrently([lambda: self.flight.do_many([1, 2], self.slow_square),
+                                    lambda: self.flight.do_many([2, 3], self.slow_square),
+                                    lambda: self.flight.do(3, lambda key: self.slow_square([key])[key])])
+        self.assertEqual({1: 1, 2: 4}, results[0])
+        self.assertEqual({2: 4, 3: 9}, results[1])
+        self.assertEqual(9, results[2])
+        # every key is computed once
+        self.assertEqual([1, 2, 3], sorted(key for keys in self.calls for key in keys))
+
+    def test_later_calls_run_again(self):
+        self.flight.do_many([1], self.slow_square)
+        self.flight.do_many([1], self.slow_square)
+        self.assertEqual([[1], [1]], self.calls)
+
+    def test_errors_are_shared(self):
+        def fail(keys):
+            time.sleep(0.1)
+            raise ValueError('crawl error')
+
+        results = run_concurrently([lambda: self._error(fail), lambda: self._error(fail)])
+        self.assertEqual(['crawl error', 'crawl error'], results)
+        self.assertEqual({}, self.flight._calls)
+
+    def test_given_up_keys_run_again(self):
+        def give_up(keys):
+            # the first caller runs out of time before it gets the value
+            self.calls.append(sorted(keys))
+            time.sleep(0.2)
+            return {}
+
+        first = threading.Thread(target=lambda: self.flight.do_many([1], give_up))
+        first.start()
+        time.sleep(0.05)
+        self.assertEqual({1: 1}, self.flight.do_many([1], self.slow_square, timeout=5))
+        first.join()
+        self.assertEqual([[1], [1]], self.calls)
+
+    def _error(self, func):
+        try:
+            self.flight.do_many(['url'], func)
+        except ValueError as ex:
+            return str(ex)
+
+    def test_content_getter(self):
+        crawler = SlowCrawler()
+        extractor = FakeExtractor()
+        content_getter = ContentGetter(crawler, extractor)
+        urls = ['http://example.com/1', 'http://example.com/2']
+        results = run_concurrently([lambda: content_getter.process(urls) for _ in range(4)])
+        self.assertEqual(sorted(urls), sorted(crawler.crawled))
+        self.assertEqual(sorted(urls), sorted(extractor.extracted))
+        for result in results:
+            self.assertEqual(u'content of http://example.com/1', result['http://example.com/1']['content'])
+        # each request gets its own copy of the pages
+        self.assertIsNot(results[0]['http://example.com/1'], results[1]['http://example.com/1'])
+
+
+class RedisSingleFlightTestCase(unittest.TestCase):
+    """Two flights stand for two replicas, needs a local redis-server"""
+
+    def setUp(self):
+        redis = get_redis(15)
+        try:
+            redis.ping()
+        except ConnectionError:
+            self.skipTest('redis-server is not running')
+        redis.flushdb()
+        self.flights = [SingleFlight('test', poll_interval=0.01), SingleFlight('test', poll_interval=0.01)]
+        for flight in self.flights:
+            flight.active_redis_lock(2, db=15)
+        self.calls = []
+
+    def tearDown(self):
+        get_redis(15).flushdb()
+
+    def slow_upper(self, keys):
+        self.calls.extend(keys)
+        time.sleep(0.3)
+        return {key: key.upper() for key in keys}
+
+    def test_replicas_share_result(self):
+        results = run_concurrently([lambda: self.flights[0].do_many(['a', 'b'], self.slow_upper),
+                                    lambda: self.flights[1].do_many(['b', 'c'], self.slow_upper)])
+        self.assertEqual({'a': 'A', 'b': 'B'}, results[0])
+        self.assertEqual({'b': 'B', 'c': 'C'}, results[1])
+        self.assertEqual(['a', 'b', 'c'], sorted(self.calls))
+
+    def test_expired_lock_is_taken_over(self):
+        redis = get_redis(15)
+        # a replica died while holding the lock
+        redis.set(self.flights[0]._lock_key('a'), 'dead', ex=1)
+        self.assertEqual({'a': 'A'}, self.flights[0].do_many(['a'], self.slow_upper))
+        self.assertEqual(['a'], self.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from util.redis_client import get_redis
+from util.utils import get_logger
+
+
+class LRUCache(object):
+    """Thread-safe in-process LRU cache, bounded by number of entries and by total cost (e.g. number of tokens)
+
+    Entries set with an `expire_time` (seconds) are dropped once expired.
+    """
+
+    def __init__(self, max_size=1024, max_cost=None, cost=len):
+        self.max_size = max_size
+        self.max_cost = max_cost
+        self.cost = cost
+        self.total_cost = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            value, cost, expire_at = self._data.pop(key)
+            if expire_at is not None and expire_at <= time.time():
+                self.total_cost -= cost
+                return None
+            # move to the most recently used position
+            self._data[key] = (value, cost, expire_at)
+            return value
+
+    def set(self, key, value, expire_time=None):
+        cost = self.cost(value) if self.max_cost else 0
+        if self.max_cost and cost > self.max_cost:
+            # never let one entry flush the whole cache
+            return
+        expire_at = time.time() + expire_time if expire_time else None
+        with self._lock:
+            if key in self._data:
+                self.total_cost -= self._data.pop(key)[1]
+            self._data[key] = (value, cost, expire_at)
+            self.total_cost += cost
+            while len(self._data) > self.max_size or (self.max_cost and self.total_cost > self.max_cost):
+                self.total_cost -= self._data.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.total_cost = 0
+
+
+def json_dumps(value):
+    return json.dumps(value, ensure_ascii=False, encoding='utf-8')
+
+
+class TieredCache(object):
+    """Two tiers cache: in-process LRU first, then an optional shared Redis tier (json values by default)"""
+
+    def __init__(self, namespace, max_size=1024, max_cost=None, cost=len, dumps=json_dumps, loads=json.loads):
+        self.logger = get_logger(self.__class__.__name__)
+        self.namespace = namespace
+        self.dumps = dumps
+        self.loads = loads
+        self.local = LRUCache(max_size=max_size, max_cost=max_cost, cost=cost)
+        self.redis = None
+        self.expire_time = None
+
+    def active_redis_cache(self, expire_time, db=4):
+        self.logger.info('Redis tier of %s cache is enabled' % self.namespace)
+        self.expire_time = expire_time
+        if self.redis is None:
+            self.redis = get_redis(db)
+
+    def make_key(self, *parts):
+        digest = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            digest.update(str(part))
+            digest.update('\x00')
+        return '%s:%s' % (self.namespace, digest.hexdigest())
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """Return {key: value} of the cached keys, the keys missed locally are fetched with one MGET"""
+        result = {}
+        missed = []
+        for key in keys:
+            value = self.local.get(key)
+            if value is not None:
+                result[key] = value
+            else:
+                missed.append(key)
+        if not missed or self.redis is None:
+            return result
+
+        try:
+            values = self.redis.mget(missed)
+        except Exception as ex:
+            self.logger.error('Get %s cache from redis error: %s' % (self.namespace, ex))
+            return result
+        for key, value in zip(missed, values):
+            if value is None:
+                continue
+            value = self.loads(value)
+            self.local.set(key, value, self.expire_time)
+            result[key] = value
+        return result
+
+    def set(self, key, value, expire_time=None):
+        self.set_many({key: value}, expire_time)
+
+    def set_many(self, items, expire_time=None):
+        """Cache all {key: value} items, `expire_time` overrides the default expire time of the cache"""
+        expire_time = expire_time or self.expire_time
+        for key, value in items.items():
+            self.local.set(key, value, expire_time)
+        if self.redis is None or not items:
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for key, value in items.items():
+                pipe.set(key, self.dumps(value), ex=expire_time)
+            pipe.execute()
+        except Exception as ex:
+            self.logger.error('Set %s cache to redis error: %s' % (self.namespace, ex))
+
+    def clear(self):
+        self.local.clear()
@@ -0,0 +1,73 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class DeadlineExceeded(BaseException):
+    """Raised by `check_deadline` once the deadline of the thread is over
+
+    A `BaseException`, so the broad `except Exception` of the extraction steps do not swallow it.
+    """
+    pass
+
+
+class Deadline(object):
+    """Point in time a piece of work must be done by, `seconds` None is no deadline"""
+
+    def __init__(self, seconds=None):
+        self.expire_at = None if seconds is None else time.time() + seconds
+
+    def remaining(self):
+        """Seconds left, None without deadline"""
+        if self.expire_at is None:
+            return None
+        return max(self.expire_at - time.time(), 0)
+
+    def expired(self):
+        return self.expire_at is not None and time.time() >= self.expire_at
+
+    def share(self, fraction):
+        """Seconds given to a stage taking `fraction` of the remaining time, None without deadline"""
+        remaining = self.remaining()
+        return None if remaining is None else remaining * fraction
+
+    def check(self, stage=None):
+        if self.expired():
+            raise DeadlineExceeded('Deadline exceeded%s' % (' before %s' % stage if stage else ''))
+
+
+NO_DEADLINE = Deadline()
+
+_local = threading.local()
+
+
+def current_deadline():
+    return getattr(_local, 'deadline', None) or NO_DEADLINE
+
+
+@contextmanager
+def deadline(seconds):
+    """Run the block with a cooperative deadline of `seconds`, checked by the `check_deadline` calls of the thread
+
+    An inner deadline never extends the deadline of the enclosing block.
+    """
+    previous = getattr(_local, 'deadline', None)
+    current = Deadline(seconds)
+    if previous is not None and previous.expire_at is not None and \
+            (current.expire_at is None or previous.expire_at < current.expire_at):
+        current = previous
+    _local.deadline = current
+    try:
+        yield current
+    finally:
+        _local.deadline = previous
+
+
+def timed_out_page(stage):
+    """Fields of a page whose `stage` did not finish before the deadline of the request, it is never cached"""
+    return {'content': '', 'error': '%s timed out' % stage, 'code': 408, 'ok': False, 'timed_out': True}
+
+
+def check_deadline(stage=None):
+    """Raise `DeadlineExceeded` if the deadline of the thread is over, call it between the steps of long work"""
+    current_deadline().check(stage)
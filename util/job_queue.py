@@ -0,0 +1,169 @@
+import json
+import time
+from uuid import uuid4
+
+from util.utils import get_logger
+
+# move the next task to the processing list and lease it in one step, so a worker dying in between leaves no task
+# without a lease
+LEASE_SCRIPT = """
+local task_id = redis.call('rpoplpush', KEYS[1], KEYS[2])
+if task_id then
+    redis.call('zadd', KEYS[3], ARGV[1], task_id)
+end
+return task_id
+"""
+
+# renew the lease of a task only if it still holds one
+EXTEND_SCRIPT = """
+if redis.call('zscore', KEYS[1], ARGV[2]) then
+    redis.call('zadd', KEYS[1], ARGV[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# put a task unless its flag is set, and set the flag in the same step, so a worker dying in between leaves no flag
+# without its task
+PUT_ONCE_SCRIPT = """
+if redis.call('set', KEYS[1], 1, 'NX') then
+    redis.call('hset', KEYS[2], ARGV[1], ARGV[2])
+    redis.call('lpush', KEYS[3], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+
+class JobQueue(object):
+    """Durable task queue in Redis, shared by the worker processes of all replicas
+
+    A task taken by `get` is moved to the processing list and leased for `lease_time` seconds, its worker renews the
+    lease with `extend` while it runs. It is deleted by `ack` once done. Tasks whose lease expires (the worker died
+    or was restarted) are put back in the queue by `requeue_expired`, so every task is processed at least once: task
+    handlers must be idempotent.
+
+    A task failing, or losing its lease, `max_attempts` times is moved to the failed list with its error and passed
+    to `on_failed`.
+    """
+
+    def __init__(self, redis, name='jobs', lease_time=600, max_attempts=3, poll_interval=0.2, on_failed=None):
+        self.logger = get_logger(self.__class__.__name__)
+        self.redis = redis
+        self.name = name
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.on_failed = on_failed
+        self.pending_key = 'queue:%s:pending' % name
+        self.processing_key = 'queue:%s:processing' % name
+        self.leases_key = 'queue:%s:leases' % name
+        self.tasks_key = 'queue:%s:tasks' % name
+        self.failed_key = 'queue:%s:failed' % name
+        self._lease = redis.register_script(LEASE_SCRIPT)
+        self._extend = redis.register_script(EXTEND_SCRIPT)
+        self._put_once = redis.register_script(PUT_ONCE_SCRIPT)
+
+    def put(self, task_type, **params):
+        task = {'id': str(uuid4()), 'type': task_type, 'params': params, 'attempts': 0}
+        pipe = self.redis.pipeline()
+        pipe.hset(self.tasks_key, task['id'], json.dumps(task))
+        pipe.lpush(self.pending_key, task['id'])
+        pipe.execute()
+        return task
+
+    def put_once(self, flag_key, task_type, **params):
+        """Put a task unless `flag_key` is set, return the task or None if the flag was set before"""
+        task = {'id': str(uuid4()), 'type': task_type, 'params': params, 'attempts': 0}
+        if self._put_once(keys=[flag_key, self.tasks_key, self.pending_key], args=[task['id'], json.dumps(task)]):
+            return task
+        return None
+
+    def get(self, timeout=5):
+        """Lease the next task, None if there is none after `timeout` seconds"""
+        self.requeue_expired()
+        expire_at = time.time() + timeout
+        # polled, a blocking pop can not be run in the script leasing the task
+        while True:
+            task_id = self._lease(keys=[self.pending_key, self.processing_key, self.leases_key],
+                                  args=[time.time() + self.lease_time])
+            if task_id is not None or time.time() >= expire_at:
+                break
+            time.sleep(self.poll_interval)
+        if task_id is None:
+            return None
+        task = self.redis.hget(self.tasks_key, task_id)
+        if task is None:
+            # acknowledged by another worker after its lease expired
+            self._release(task_id)
+            return None
+        return json.loads(task)
+
+    def extend(self, task):
+        """Renew the lease of a long running task, False if the task lost its lease (e.g. it was requeued)"""
+        return bool(self._extend(keys=[self.leases_key], args=[time.time() + self.lease_time, task['id']]))
+
+    def ack(self, task):
+        pipe = self.redis.pipeline()
+        pipe.hdel(self.tasks_key, task['id'])
+        pipe.lrem(self.processing_key, 0, task['id'])
+        pipe.zrem(self.leases_key, task['id'])
+        pipe.execute()
+
+    def retry(self, task, error=None):
+        """Put a failed task back in the queue, return False (and move it to the failed list) after `max_attempts`"""
+        task['attempts'] += 1
+        if task['attempts'] >= self.max_attempts:
+            self._fail(task, error)
+            return False
+        pipe = self.redis.pipeline()
+        pipe.hset(self.tasks_key, task['id'], json.dumps(task))
+        pipe.lrem(self.processing_key, 0, task['id'])
+        pipe.zrem(self.leases_key, task['id'])
+        pipe.lpush(self.pending_key, task['id'])
+        pipe.execute()
+        return True
+
+    def requeue_expired(self):
+        for task_id in self.redis.zrangebyscore(self.leases_key, 0, time.time()):
+            # only the worker removing the lease requeues the task
+            if not self.redis.zrem(self.leases_key, task_id):
+                continue
+            task = self.redis.hget(self.tasks_key, task_id)
+            if task is None:
+                # acknowledged right before its lease expired
+                self._release(task_id)
+                continue
+            task = json.loads(task)
+            # a task crashing its worker every time is not leased forever
+            task['attempts'] += 1
+            if task['attempts'] >= self.max_attempts:
+                self._fail(task, 'lease expired')
+                continue
+            pipe = self.redis.pipeline()
+            pipe.hset(self.tasks_key, task_id, json.dumps(task))
+            pipe.lrem(self.processing_key, 0, task_id)
+            pipe.rpush(self.pending_key, task_id)
+            pipe.execute()
+            self.logger.info('Requeue task %s of an expired lease' % task_id)
+
+    def _fail(self, task, error):
+        task['error'] = error
+        pipe = self.redis.pipeline()
+        pipe.hdel(self.tasks_key, task['id'])
+        pipe.lrem(self.processing_key, 0, task['id'])
+        pipe.zrem(self.leases_key, task['id'])
+        pipe.lpush(self.failed_key, json.dumps(task))
+        pipe.execute()
+        self.logger.error('Task %s failed %d times: %s' % (task['id'], task['attempts'], error))
+        if self.on_failed is not None:
+            self.on_failed(task)
+
+    def _release(self, task_id):
+        pipe = self.redis.pipeline()
+        pipe.lrem(self.processing_key, 0, task_id)
+        pipe.zrem(self.leases_key, task_id)
+        pipe.execute()
+
+    def size(self):
+        return self.redis.llen(self.pending_key)
@@ -0,0 +1,40 @@
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from redis import BlockingConnectionPool, StrictRedis
+
+_clients = {}
+_clients_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+
+
+def get_redis(db):
+    """Shared `StrictRedis` client of `db`, one blocking connection pool per db for the whole process
+
+    The pool waits for a free connection instead of failing when REDIS_MAX_CONNECTIONS are in use.
+    """
+    with _clients_lock:
+        client = _clients.get(db)
+        if client is None:
+            pool = BlockingConnectionPool(db=db, host=os.environ.get('REDIS_HOST', 'localhost'),
+                                          port=int(os.environ.get('REDIS_PORT', 6379)),
+                                          max_connections=int(os.environ.get('REDIS_MAX_CONNECTIONS', 64)),
+                                          timeout=20)
+            client = StrictRedis(connection_pool=pool)
+            _clients[db] = client
+    return client
+
+
+def get_redis_executor():
+    """Shared executor of the Redis calls of coroutines, so the blocking calls do not run on the IOLoop
+
+    Created again after a fork (e.g. gunicorn workers), threads do not survive fork.
+    """
+    global _executor, _executor_pid
+    with _clients_lock:
+        if _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(int(os.environ.get('REDIS_THREADS', 16)))
+            _executor_pid = os.getpid()
+    return _executor
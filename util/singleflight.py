@@ -0,0 +1,294 @@
+import hashlib
+import json
+import threading
+import time
+from uuid import uuid4
+
+from datetime import timedelta
+
+from concurrent.futures import Future, TimeoutError
+from tornado import gen
+
+from util.cache import json_dumps
+from util.redis_client import get_redis, get_redis_executor
+from util.utils import get_logger
+
+# delete the lock only if it is still held by the same owner
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls for the same keys, so the work of a key runs once and its callers share the result
+
+    In the process, the first caller of a key runs the work and the others wait on its future. With the Redis lock
+    enabled, the caller also takes a short `SET NX` lock of the key, callers of other replicas wait for the result it
+    publishes, and take over the keys whose lock expired without a result.
+    """
+
+    def __init__(self, namespace, dumps=json_dumps, loads=json.loads, poll_interval=0.05, result_time=30):
+        self.logger = get_logger(self.__class__.__name__)
+        self.namespace = namespace
+        self.dumps = dumps
+        self.loads = loads
+        self.poll_interval = poll_interval
+        # seconds the published results are kept for the waiters of other replicas
+        self.result_time = result_time
+        self.redis = None
+        self.lock_time = None
+        self._release = None
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def active_redis_lock(self, lock_time, db=4):
+        """Coalesce calls across processes and replicas, a key is locked at most `lock_time` seconds"""
+        self.logger.info('Redis lock of %s single flight is enabled' % self.namespace)
+        self.lock_time = lock_time
+        if self.redis is None:
+            self.redis = get_redis(db)
+            self._release = self.redis.register_script(RELEASE_SCRIPT)
+
+    def make_key(self, *parts):
+        digest = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            digest.update(str(part))
+            digest.update('\x00')
+        return digest.hexdigest()
+
+    def do(self, key, func):
+        """Value of `func(key)`, run once for concurrent callers of `key`"""
+        return self.do_many([key], lambda keys: {keys[0]: func(keys[0])})[key]
+
+    def do_many(self, keys, func, timeout=None):
+        """Return {key: value} of `func(keys)`, which returns {key: value} of a list of keys
+
+        `func` is only called with the keys no other caller is working on, the values of the others are the values
+        their callers get. Values are shared by all callers, they must not be modified. The keys of other callers
+        are awaited at most `timeout` seconds, their value is None after that. A key another caller gave up on (its
+        value is None) is run again while `timeout` is not over.
+        """
+        expire_at = None if timeout is None else time.time() + timeout
+        futures, owned = self._claim(keys)
+        if owned:
+            try:
+                self._resolve(futures, owned, self._run(owned, func, timeout))
+            except Exception as ex:
+                self._resolve(futures, owned, error=ex)
+                raise
+        result = {}
+        for key, future in futures.items():
+            try:
+                result[key] = future.result(None if expire_at is None else max(expire_at - time.time(), 0))
+            except TimeoutError:
+                result[key] = None
+        retry = self._given_up(result, owned, expire_at)
+        if retry:
+            result.update(self.do_many(retry, func, None if expire_at is None else expire_at - time.time()))
+        return result
+
+    @gen.coroutine
+    def do_many_async(self, keys, func, timeout=None):
+        """Coroutine version of `do_many`, `func` is a coroutine function
+
+        The keys of other callers (coroutines or threads) are awaited without blocking the IOLoop.
+        """
+        expire_at = None if timeout is None else time.time() + timeout
+        futures, owned = self._claim(keys)
+        if owned:
+            try:
+                self._resolve(futures, owned, (yield self._run_async(owned, func, timeout)))
+            except Exception as ex:
+                self._resolve(futures, owned, error=ex)
+                raise
+        result = {}
+        for key, future in futures.items():
+            if expire_at is None or future.done():
+                # one at a time, the futures of other threads are resolved through the IOLoop
+                result[key] = yield future
+                continue
+            try:
+                result[key] = yield gen.with_timeout(timedelta(seconds=max(expire_at - time.time(), 0)),
+                                                     _wrap(future))
+            except gen.TimeoutError:
+                result[key] = None
+        retry = self._given_up(result, owned, expire_at)
+        if retry:
+            values = yield self.do_many_async(retry, func, None if expire_at is None else expire_at - time.time())
+            result.update(values)
+        raise gen.Return(result)
+
+    @staticmethod
+    def _given_up(result, owned, expire_at):
+        """Keys of other callers without a value, their caller gave up at its own deadline, to be run again unless
+        the deadline of this caller is over too"""
+        if expire_at is not None and time.time() >= expire_at:
+            return []
+        return [key for key, value in result.items() if value is None and key not in owned]
+
+    def _claim(self, keys):
+        """Futures of the keys, and the keys whose future is set by this caller"""
+        futures = {}
+        owned = []
+        with self._lock:
+            for key in set(keys):
+                future = self._calls.get(key)
+                if future is None:
+                    future = Future()
+                    self._calls[key] = future
+                    owned.append(key)
+                futures[key] = future
+        return futures, owned
+
+    def _resolve(self, futures, owned, values=None, error=None):
+        for key in owned:
+            if futures[key].done():
+                continue
+            if error is None:
+                futures[key].set_result(values.get(key))
+            else:
+                futures[key].set_exception(error)
+        with self._lock:
+            for key in owned:
+                self._calls.pop(key, None)
+        self.logger.debug('%s: %d keys run, %d keys shared' % (self.namespace, len(owned), len(futures) - len(owned)))
+
+    def _lock_key(self, key):
+        return 'singleflight:%s:lock:%s' % (self.namespace, key)
+
+    def _result_key(self, key):
+        return 'singleflight:%s:result:%s' % (self.namespace, key)
+
+    def _run(self, keys, func, timeout=None):
+        expire_at = None if timeout is None else time.time() + timeout
+        if self.redis is None:
+            return func(keys)
+
+        token, locked = self._lock_keys(keys)
+        if locked is None:
+            return func(keys)
+
+        values = {}
+        if locked:
+            try:
+                values.update(func(locked))
+            finally:
+                self._publish(locked, values, token)
+
+        waiting = [key for key in keys if key not in values and key not in locked]
+        if waiting:
+            values.update(self._wait(waiting, timeout))
+            # the lock of these keys expired (or was released) without a result, run them unless the timeout is over
+            remaining = [key for key in waiting if key not in values]
+            if remaining and (expire_at is None or time.time() < expire_at):
+                values.update(func(remaining))
+        return values
+
+    @gen.coroutine
+    def _run_async(self, keys, func, timeout=None):
+        """Coroutine version of `_run`, the Redis calls run on the Redis executor"""
+        expire_at = None if timeout is None else time.time() + timeout
+        if self.redis is None:
+            values = yield func(keys)
+            raise gen.Return(values)
+
+        token, locked = yield get_redis_executor().submit(self._lock_keys, keys)
+        if locked is None:
+            values = yield func(keys)
+            raise gen.Return(values)
+
+        values = {}
+        if locked:
+            try:
+                values.update((yield func(locked)))
+            finally:
+                yield get_redis_executor().submit(self._publish, locked, values, token)
+
+        waiting = [key for key in keys if key not in values and key not in locked]
+        if waiting:
+            values.update((yield self._wait_async(waiting, timeout)))
+            remaining = [key for key in waiting if key not in values]
+            if remaining and (expire_at is None or time.time() < expire_at):
+                values.update((yield func(remaining)))
+        raise gen.Return(values)
+
+    def _lock_keys(self, keys):
+        """Return (token, locked keys), the locked keys are None when Redis fails"""
+        token = uuid4().hex
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.set(self._lock_key(key), token, nx=True, ex=self.lock_time)
+            return token, [key for key, ok in zip(keys, pipe.execute()) if ok]
+        except Exception as ex:
+            self.logger.error('Lock %s keys error: %s' % (self.namespace, ex))
+            return token, None
+
+    def _publish(self, keys, values, token):
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for key in keys:
+                if values.get(key) is not None:
+                    pipe.set(self._result_key(key), self.dumps(values[key]), ex=self.result_time)
+            for key in keys:
+                self._release(keys=[self._lock_key(key)], args=[token], client=pipe)
+            pipe.execute()
+        except Exception as ex:
+            self.logger.error('Publish %s results error: %s' % (self.namespace, ex))
+
+    def _wait(self, keys, timeout=None):
+        """Values published by the lock owners of the keys, until no lock is left or `timeout` seconds"""
+        values = {}
+        deadline = time.time() + min(self.lock_time, self.lock_time if timeout is None else timeout)
+        try:
+            while keys and time.time() < deadline:
+                keys = self._poll(keys, values)
+                if keys:
+                    time.sleep(self.poll_interval)
+        except Exception as ex:
+            self.logger.error('Wait %s results error: %s' % (self.namespace, ex))
+        return values
+
+    @gen.coroutine
+    def _wait_async(self, keys, timeout=None):
+        values = {}
+        deadline = time.time() + min(self.lock_time, self.lock_time if timeout is None else timeout)
+        try:
+            while keys and time.time() < deadline:
+                keys = yield get_redis_executor().submit(self._poll, keys, values)
+                if keys:
+                    yield gen.sleep(self.poll_interval)
+        except Exception as ex:
+            self.logger.error('Wait %s results error: %s' % (self.namespace, ex))
+        raise gen.Return(values)
+
+    def _poll(self, keys, values):
+        """Add the published values of the keys to `values`, return the keys still locked"""
+        results = self.redis.mget([self._result_key(key) for key in keys])
+        for key, value in zip(keys, results):
+            if value is not None:
+                values[key] = self.loads(value)
+        keys = [key for key in keys if key not in values]
+        if not keys:
+            return keys
+        locks = self.redis.mget([self._lock_key(key) for key in keys])
+        released = [key for key, lock in zip(keys, locks) if lock is None]
+        if released:
+            # the result may be published right before the lock is released
+            for key, value in zip(released, self.redis.mget([self._result_key(k) for k in released])):
+                if value is not None:
+                    values[key] = self.loads(value)
+            keys = [key for key in keys if key not in released]
+        return keys
+
+
+@gen.coroutine
+def _wrap(future):
+    """Tornado future of a `concurrent.futures.Future`, resolved on the IOLoop"""
+    result = yield future
+    raise gen.Return(result)
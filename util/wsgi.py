@@ -0,0 +1,60 @@
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.web import RequestHandler
+from tornado.wsgi import WSGIContainer
+
+
+class WSGIResource(RequestHandler):
+    """Serves a WSGI application (e.g. the flask api and web ui) from a thread of `executor`, so its blocking
+    requests do not block the IOLoop. The body is written to the client as the application yields it."""
+
+    def initialize(self, wsgi_application, executor):
+        self.wsgi_application = wsgi_application
+        self.executor = executor
+
+    def compute_etag(self):
+        return None
+
+    @gen.coroutine
+    def prepare(self):
+        environ = WSGIContainer.environ(self.request)
+        environ['wsgi.multithread'] = True
+        written = Future()
+        yield self.executor.submit(self._call, environ, IOLoop.current(), written)
+        # the call may be done before the IOLoop runs the callbacks writing its response
+        yield written
+        self.finish()
+
+    def _call(self, environ, io_loop, written):
+        # the response is written on the IOLoop, in the order of the callbacks
+        def start_response(status, headers, exc_info=None):
+            io_loop.add_callback(self._start, status, headers)
+            return write
+
+        def write(chunk):
+            if chunk:
+                io_loop.add_callback(self._write, chunk)
+
+        try:
+            app_response = self.wsgi_application(environ, start_response)
+            try:
+                for chunk in app_response:
+                    write(chunk)
+            finally:
+                if hasattr(app_response, 'close'):
+                    app_response.close()
+        finally:
+            io_loop.add_callback(written.set_result, None)
+
+    def _start(self, status, headers):
+        status_code, reason = status.split(' ', 1)
+        self.set_status(int(status_code), reason)
+        for name in set(name for name, _ in headers):
+            self.clear_header(name)
+        for name, value in headers:
+            self.add_header(name, value)
+
+    def _write(self, chunk):
+        self.write(chunk)
+        self.flush()
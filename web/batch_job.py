@@ -0,0 +1,313 @@
+import os
+import shutil
+import threading
+import time
+from StringIO import StringIO
+from multiprocessing import Pool, cpu_count
+
+import pandas as pd
+import xlrd
+
+from api import get_similarity_checker
+from similarity_checker import prepare_documents
+from util.job_queue import JobQueue
+from util.redis_client import get_redis
+from util.utils import get_logger
+
+# uploaded inputs, part files and outputs of the jobs, read by the web and worker processes of all nodes, so a volume
+# shared by the nodes with several of them
+UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 'web/upload')
+# rows of the input file scored in one task
+JOB_CHUNK_SIZE = int(os.environ.get('JOB_CHUNK_SIZE', 1000))
+
+logger = get_logger(__name__)
+
+# job status hashes, listed by the web ui
+job_redis = get_redis(1)
+# ids of the jobs by start time
+JOB_INDEX_KEY = 'jobs:by-start'
+# finished (or failed) jobs are forgotten after this many seconds
+JOB_EXPIRE_TIME = int(os.environ.get('JOB_EXPIRE_TIME', 7 * 86400))
+# queue and intermediate data of the jobs
+queue_redis = get_redis(2)
+# a task failing too many times fails its job
+job_queue = JobQueue(queue_redis, 'batch-jobs', lease_time=int(os.environ.get('JOB_LEASE_TIME', 600)),
+                     on_failed=lambda task: fail_job(task))
+
+
+def read_header(file_path, excel):
+    if excel:
+        # only the first row of the first sheet, the rows are read by the job
+        book = xlrd.open_workbook(file_path, on_demand=True)
+        try:
+            return book.sheet_by_index(0).row_values(0)
+        finally:
+            book.release_resources()
+    return list(pd.read_csv(file_path, delimiter='\t', encoding='utf-8', nrows=1).columns)
+
+
+def excel_to_csv(file_path):
+    """Path of a tab separated copy of the first sheet of an excel file, the workbook is read once"""
+    csv_path = '%s.tsv' % file_path
+    if not os.path.exists(csv_path):
+        tmp_path = '%s.%d.tmp' % (csv_path, os.getpid())
+        pd.read_excel(file_path, encoding='utf-8').to_csv(tmp_path, sep='\t', index=False, encoding='utf-8')
+        os.rename(tmp_path, csv_path)
+    return csv_path
+
+
+def count_rows(file_path):
+    with open(file_path, 'rb') as f:
+        return max(sum(1 for _ in f) - 1, 0)
+
+
+def read_row(f):
+    """Lines of the next row of a csv file, '' at the end of the file, a quoted field may span lines"""
+    row = f.readline()
+    while row.count('"') % 2:
+        line = f.readline()
+        if not line:
+            break
+        row += line
+    return row
+
+
+def split_rows(file_path, chunk_size=JOB_CHUNK_SIZE):
+    """(start, end, number of rows) byte ranges of at most `chunk_size` rows of a tab separated file, after its
+    header row"""
+    with open(file_path, 'rb') as f:
+        read_row(f)
+        start = f.tell()
+        rows = 0
+        while read_row(f):
+            rows += 1
+            if rows == chunk_size:
+                end = f.tell()
+                yield start, end, rows
+                start = end
+                rows = 0
+        if rows:
+            yield start, f.tell(), rows
+
+
+def read_rows(file_path, start, end):
+    """Data frame of the rows in the byte range [start, end) of a tab separated file, with the columns of its
+    header row"""
+    with open(file_path, 'rb') as f:
+        header = read_row(f)
+        f.seek(start)
+        data = f.read(end - start)
+    return pd.read_csv(StringIO(header + data), delimiter='\t', encoding='utf-8')
+
+
+def part_path(output_file, index):
+    """Path of the scored rows of chunk `index`, merged into `output_file` once every chunk is scored"""
+    return os.path.join(UPLOAD_FOLDER, '%s.part%d' % (output_file, index))
+
+
+def gen_distance_cols(columns):
+    distance_cols = []
+    no_col = len(columns)
+    for i in range(no_col):
+        for j in range(i + 1, no_col):
+            distance_cols.append('Distance-%s-%s' % (columns[i], columns[j]))
+
+    return distance_cols
+
+
+def cross_check_similarity_wrapper(args):
+    return cross_check_similarity(*args)
+
+
+def cross_check_similarity(contents, selected_dm, unit, min_ngram, max_ngram):
+    sim_checker = get_similarity_checker(selected_dm)
+
+    # each content is prepared once for all of its pairs
+    docs = prepare_documents(contents, unit=unit, min_ngram=min_ngram, max_ngram=max_ngram)
+
+    no_col = len(contents)
+    distances = []
+    for i in range(no_col):
+        for j in range(i + 1, no_col):
+            distances.append(sim_checker(docs[i], docs[j]))
+
+    return distances
+
+
+def get_jobs(page=1, per_page=20):
+    """Return (jobs of the page, number of jobs), the latest jobs first"""
+    start = (page - 1) * per_page
+    job_ids = job_redis.zrevrange(JOB_INDEX_KEY, start, start + per_page - 1)
+    pipe = job_redis.pipeline()
+    for job_id in job_ids:
+        pipe.hgetall(job_id)
+    jobs = []
+    expired = []
+    for job_id, job in zip(job_ids, pipe.execute()):
+        if not job:
+            expired.append(job_id)
+            continue
+        job['id'] = job_id
+        jobs.append(job)
+
+    if expired:
+        # the hashes of finished jobs expire, their ids are removed from the index when listed
+        job_redis.zrem(JOB_INDEX_KEY, *expired)
+    return jobs, job_redis.zcard(JOB_INDEX_KEY)
+
+
+def index_existing_jobs():
+    """Add the jobs created before the index to it, scanned incrementally"""
+    for job_id in job_redis.scan_iter(count=1000):
+        if job_id != JOB_INDEX_KEY and job_redis.type(job_id) == 'hash':
+            job_redis.zadd(JOB_INDEX_KEY, float(job_redis.hget(job_id, 'start') or 0), job_id)
+
+
+def end_job(job_id, **fields):
+    pipe = job_redis.pipeline()
+    pipe.hmset(job_id, fields)
+    pipe.expire(job_id, JOB_EXPIRE_TIME)
+    pipe.execute()
+
+
+def fail_job(task):
+    """Mark the job of a task dropped by the queue as failed, with the error of the task"""
+    end_job(task['params']['job_id'], error='%s failed: %s' % (task['type'], task['error']), finish=1)
+
+
+def job_key(job_id, name):
+    return 'job:%s:%s' % (job_id, name)
+
+
+def submit_job(file_path, excel, selected_dm, unit, min_ngram, max_ngram, job_id, output_file):
+    start = time.time()
+    pipe = job_redis.pipeline()
+    pipe.hmset(job_id, {'size': 0, 'start': start, 'file': output_file, 'finish': 0, 'progress': 0})
+    pipe.zadd(JOB_INDEX_KEY, start, job_id)
+    pipe.execute()
+    job_queue.put('split', job_id=job_id, file_path=file_path, excel=excel, selected_dm=selected_dm, unit=unit,
+                  min_ngram=min_ngram, max_ngram=max_ngram, output_file=output_file)
+
+
+class BatchJobWorker(object):
+    """Runs the tasks of batch cross-check jobs
+
+    A job is split into chunks, byte ranges of rows of the input file in the upload folder shared with the web
+    processes (`split`). Each chunk is scored by any worker into a part file (`chunk`) and the part files are
+    written to the output file in order (`merge`). The number of queued chunks and the set of scored chunks are
+    the checkpoints of a job: a task run again after a worker died skips the work already done. The lease of a
+    task is renewed while it runs, so a long task is not given to another worker.
+    """
+
+    def __init__(self, queue=job_queue, pool_size=None):
+        self.logger = get_logger(self.__class__.__name__)
+        self.queue = queue
+        self.pool = Pool(pool_size or cpu_count())
+        self.handlers = {'split': self.split, 'chunk': self.score_chunk, 'merge': self.merge}
+
+    def run(self):
+        self.logger.info('Batch job worker started')
+        try:
+            while True:
+                self.run_once()
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+    def run_once(self, timeout=5):
+        task = self.queue.get(timeout)
+        if task is None:
+            return False
+        params = task['params']
+        renewing = self.renew_lease(task)
+        try:
+            self.handlers[task['type']](**params)
+            self.queue.ack(task)
+        except Exception as ex:
+            self.logger.exception('Task %s of job %s failed: %s' % (task['type'], params['job_id'], ex))
+            self.queue.retry(task, '%s' % ex)
+        finally:
+            renewing.set()
+        return True
+
+    def renew_lease(self, task):
+        """Renew the lease of `task` from a thread until the returned event is set"""
+        done = threading.Event()
+
+        def renew():
+            while not done.wait(self.queue.lease_time / 3.0):
+                if not self.queue.extend(task) and not done.is_set():
+                    self.logger.warning('Task %s lost its lease' % task['id'])
+                    return
+
+        thread = threading.Thread(target=renew, name='lease-%s' % task['id'])
+        thread.setDaemon(True)
+        thread.start()
+        return done
+
+    def split(self, job_id, file_path, excel, selected_dm, unit, min_ngram, max_ngram, output_file):
+        # the copy of an excel sheet is read by the chunks, it is removed by the merge
+        input_copy = None
+        if excel:
+            file_path = input_copy = excel_to_csv(file_path)
+        job_redis.hset(job_id, 'size', count_rows(file_path))
+        # chunks queued by an interrupted split are not queued again
+        queued = int(queue_redis.get(job_key(job_id, 'split')) or 0)
+        size = 0
+        index = -1
+        for index, (start, end, rows) in enumerate(split_rows(file_path)):
+            size += rows
+            if index < queued:
+                continue
+            self.queue.put('chunk', job_id=job_id, index=index, file_path=file_path, start=start, end=end,
+                           selected_dm=selected_dm, unit=unit, min_ngram=min_ngram, max_ngram=max_ngram,
+                           output_file=output_file, input_copy=input_copy)
+            queue_redis.set(job_key(job_id, 'split'), index + 1)
+
+        # the line count of the input is an estimate when fields contain line breaks
+        job_redis.hset(job_id, 'size', size)
+        queue_redis.set(job_key(job_id, 'chunks'), index + 1)
+        self.merge_when_scored(job_id, output_file, input_copy)
+
+    def score_chunk(self, job_id, index, file_path, start, end, selected_dm, unit, min_ngram, max_ngram,
+                    output_file, input_copy=None):
+        if not queue_redis.sismember(job_key(job_id, 'scored'), index):
+            df = read_rows(file_path, start, end).fillna('')
+            tasks = [(tuple(row), selected_dm, unit, min_ngram, max_ngram) for row in df.values.tolist()]
+            result = self.pool.map(cross_check_similarity_wrapper, tasks)
+            df = pd.concat([df, pd.DataFrame(result, index=df.index, columns=gen_distance_cols(df.columns))], axis=1)
+            path = part_path(output_file, index)
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            df.to_csv(tmp_path, header=index == 0, index=False, sep='\t', encoding='utf-8')
+            # atomic replace, a chunk scored again never leaves a partial part file
+            os.rename(tmp_path, path)
+            if queue_redis.sadd(job_key(job_id, 'scored'), index):
+                job_redis.hincrby(job_id, 'progress', len(tasks))
+        self.merge_when_scored(job_id, output_file, input_copy)
+
+    def merge_when_scored(self, job_id, output_file, input_copy=None):
+        chunks = queue_redis.get(job_key(job_id, 'chunks'))
+        if chunks is None or queue_redis.scard(job_key(job_id, 'scored')) < int(chunks):
+            return
+        # the last chunk and the end of the split may both get here, the flag is set with the task
+        self.queue.put_once(job_key(job_id, 'merge'), 'merge', job_id=job_id, output_file=output_file,
+                            input_copy=input_copy)
+
+    def merge(self, job_id, output_file, input_copy=None):
+        chunks = queue_redis.get(job_key(job_id, 'chunks'))
+        if chunks is None:
+            # merged before the task was delivered again
+            return
+        chunks = int(chunks)
+        with open(os.path.join(UPLOAD_FOLDER, output_file), 'wb') as output:
+            for index in range(chunks):
+                with open(part_path(output_file, index), 'rb') as part:
+                    shutil.copyfileobj(part, output)
+
+        end_job(job_id, finish=1)
+        queue_redis.delete(*[job_key(job_id, name) for name in ['split', 'chunks', 'scored', 'merge']])
+        for index in range(chunks):
+            os.remove(part_path(output_file, index))
+        if input_copy:
+            os.remove(input_copy)
+        self.logger.info('Job %s finished, %d chunks merged to %s' % (job_id, chunks, output_file))
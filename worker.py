@@ -0,0 +1,5 @@
+from web.batch_job import BatchJobWorker, index_existing_jobs
+
+if __name__ == '__main__':
+    index_existing_jobs()
+    BatchJobWorker().run()